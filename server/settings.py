@@ -27,6 +27,19 @@ except:
 # Basic config
 DEBUG = _config.get("DEBUG", False)
 MAX_PAGE_SIZE = _config.get("MAX_PAGE_SIZE", 1000)
+MAX_BATCH_SIZE = _config.get("MAX_BATCH_SIZE", 500)
+MAX_SWEEP_SIZE = _config.get("MAX_SWEEP_SIZE", 1000)
+MAX_WORKFLOW_SIZE = _config.get("MAX_WORKFLOW_SIZE", 100)
+MAX_STATUS_IDS = _config.get("MAX_STATUS_IDS", 1000)
+# Seconds a task creation is remembered by its Idempotency-Key
+IDEMPOTENCY_KEY_TTL = _config.get("IDEMPOTENCY_KEY_TTL", 86400)
+# Seconds after which the Idempotency-Key of a request that has not created its task yet can be taken by a retry
+# It must exceed the longest task creation, i.e. the timeout of the proxy in front of the server plus the DRM submission
+IDEMPOTENCY_KEY_LEASE = _config.get("IDEMPOTENCY_KEY_LEASE", 60)
+
+# Streams of the task changes
+TASK_EVENTS_POLL_INTERVAL = _config.get("TASK_EVENTS_POLL_INTERVAL", 2)
+TASK_EVENTS_TIMEOUT = _config.get("TASK_EVENTS_TIMEOUT", 300)
 
 # CLUSTER config
 CLUSTER_CONFIG = _config.get("CLUSTER", {})
@@ -103,6 +116,11 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'submission.drm': {
+            'handlers': ['drm'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
         'submission': {
             'level': 'INFO',
             'handlers': ['ip_request'],
@@ -120,6 +138,33 @@ LOGGING = {
 REMOVE_TASK_FILES_ON_DELETE = CLUSTER_CONFIG.get(
     'REMOVE_TASK_FILES_ON_DELETE', True)
 
+# Set true if the DRM status of the tasks is refreshed out of band by the poll_drm_status command,
+# the endpoints then read the status stored in the database
+DRM_STATUS_POLLER = CLUSTER_CONFIG.get('DRM_STATUS_POLLER', False)
+# Seconds between two consecutive refreshes of the poll_drm_status command
+DRM_STATUS_POLL_INTERVAL = CLUSTER_CONFIG.get('DRM_STATUS_POLL_INTERVAL', 10)
+# Seconds a DRM job status is cached before asking the DRM again, and the same for terminal statuses
+DRM_STATUS_CACHE_TTL = CLUSTER_CONFIG.get('DRM_STATUS_CACHE_TTL', 5)
+DRM_STATUS_CACHE_TERMINAL_TTL = CLUSTER_CONFIG.get('DRM_STATUS_CACHE_TERMINAL_TTL', 3600)
+
+# Seconds a DRMAA session can stay unused before being checked again
+DRM_SESSION_CHECK_INTERVAL = CLUSTER_CONFIG.get('DRM_SESSION_CHECK_INTERVAL', 60)
+
+# Set true to accept the tasks immediately and send them to the DRM with the run_submission_workers command
+ASYNC_SUBMISSION = CLUSTER_CONFIG.get('ASYNC_SUBMISSION', False)
+# Number of submission workers and seconds they wait when the queue is empty
+SUBMISSION_WORKERS = CLUSTER_CONFIG.get('SUBMISSION_WORKERS', 4)
+SUBMISSION_QUEUE_POLL_INTERVAL = CLUSTER_CONFIG.get('SUBMISSION_QUEUE_POLL_INTERVAL', 1)
+# Attempts to start a queued task in the DRM before rejecting it
+SUBMISSION_MAX_ATTEMPTS = CLUSTER_CONFIG.get('SUBMISSION_MAX_ATTEMPTS', 3)
+# Seconds a submission worker has to start a job in the DRM and record it, then the job is considered lost
+SUBMISSION_CLAIM_TIME = CLUSTER_CONFIG.get('SUBMISSION_CLAIM_TIME', 600)
+
+# Seconds the sacct command can take to read the resource usage of the finished jobs
+SACCT_TIMEOUT = CLUSTER_CONFIG.get('SACCT_TIMEOUT', 30)
+# Attempts to read the resource usage of a finished job before giving up
+RESOURCE_USAGE_MAX_ATTEMPTS = CLUSTER_CONFIG.get('RESOURCE_USAGE_MAX_ATTEMPTS', 5)
+
 
 # Security confifg
 SECURITY_CONFIG = _config.get("SECURITY", {})
@@ -151,6 +196,38 @@ DATABASES = {
     }
 }
 
+# Webhooks, called when the status of the tasks changes
+WEBHOOK_CONFIG = _config.get("WEBHOOK", {})
+
+# Key of the HMAC signature of the payloads, the payloads are not signed if empty
+WEBHOOK_SECRET = WEBHOOK_CONFIG.get("SECRET", "")
+WEBHOOK_WORKERS = WEBHOOK_CONFIG.get("WORKERS", 2)
+# Seconds a webhook worker waits when there is nothing to deliver
+WEBHOOK_POLL_INTERVAL = WEBHOOK_CONFIG.get("POLL_INTERVAL", 1)
+# Maximum number of status changes sent to an endpoint with a single request
+WEBHOOK_BATCH_SIZE = WEBHOOK_CONFIG.get("BATCH_SIZE", 100)
+WEBHOOK_TIMEOUT = WEBHOOK_CONFIG.get("TIMEOUT", 10)
+# Attempts to deliver a status change before dropping it
+WEBHOOK_MAX_ATTEMPTS = WEBHOOK_CONFIG.get("MAX_ATTEMPTS", 8)
+# Hosts that can be called even if they resolve to a loopback, private or link-local address
+WEBHOOK_ALLOWED_HOSTS = WEBHOOK_CONFIG.get("ALLOWED_HOSTS", [])
+
+# Cache, shared by the server processes when a shared backend is configured
+# https://docs.djangoproject.com/en/4.2/ref/settings/#caches
+CACHE_CONFIG = _config.get("CACHE", {})
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_CONFIG.get("BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': CACHE_CONFIG.get("LOCATION", ''),
+    }
+}
+
+# Seconds the rendered script catalog is kept in the cache
+SCRIPT_CATALOG_CACHE_TTL = CACHE_CONFIG.get("SCRIPT_CATALOG_TTL", 300)
+# Seconds the submission plan of a script is kept in the cache
+SUBMISSION_PLAN_CACHE_TTL = CACHE_CONFIG.get("SUBMISSION_PLAN_TTL", 300)
+
 DEFAULT_RENDERER_CLASSES = (
     'rest_framework.renderers.JSONRenderer',
     'submission.renderers.CustomBrowsableAPIRenderer',
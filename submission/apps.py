@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class SubmissionConfig(AppConfig):
     default_auto_field = 'django.db.models.AutoField'
     name = 'submission'
+
+    def ready(self):
+        # Connect the signal receivers
+        from submission.script import signals  # noqa: F401
+        from submission.task import receivers  # noqa: F401
@@ -0,0 +1,34 @@
+import time
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def is_cache_shared():
+    # The local memory cache is not shared by the server processes, the changes would not be seen by all of them
+    return not isinstance(caches['default'], LocMemCache)
+
+
+class CacheVersion:
+    """
+    Version in the keys of a family of cached entries, which are discarded all together by changing it
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def get(self):
+        version = cache.get(self.key)
+        if version is None:
+            # The version starts from the current time, it never goes back to a used value if it is evicted
+            version = time.time_ns()
+            if not cache.add(self.key, version, None):
+                version = cache.get(self.key, version)
+        return version
+
+    def invalidate(self):
+        try:
+            cache.incr(self.key)
+        except ValueError:
+            # The version is not in the cache, the next one is new anyway
+            pass
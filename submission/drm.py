@@ -0,0 +1,415 @@
+import atexit
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import drmaa
+
+from server.settings import DRM_SESSION_CHECK_INTERVAL, SACCT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Status of the DRM jobs, as stored in the tasks
+JOB_STATUS = {
+        drmaa.JobState.UNDETERMINED       : "process status cannot be determined",
+        drmaa.JobState.QUEUED_ACTIVE      : "job is queued and active",
+        drmaa.JobState.SYSTEM_ON_HOLD     : "job is queued and in system hold",
+        drmaa.JobState.USER_ON_HOLD       : "job is queued and in user hold",
+        drmaa.JobState.USER_SYSTEM_ON_HOLD: "job is queued and in user and system hold",
+        drmaa.JobState.RUNNING            : "job is running",
+        drmaa.JobState.SYSTEM_SUSPENDED   : "job is system suspended",
+        drmaa.JobState.USER_SUSPENDED     : "job is user suspended",
+        drmaa.JobState.DONE               : "job finished normally",
+        drmaa.JobState.FAILED             : "job finished, but failed",
+}
+
+# States of the DRM jobs that have not ended yet, as given by the SLURM accounting
+ACCOUNTING_ACTIVE_STATES = {"PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "STAGE_OUT", "SUSPENDED", "REQUEUED",
+                            "RESIZING"}
+
+# Placeholder replaced by the index of the array job element, e.g. in the output file names
+PARAMETRIC_INDEX = drmaa.JobTemplate.PARAMETRIC_INDEX
+
+# DRM errors after which the session is considered broken and initialised again
+SESSION_ERRORS = (drmaa.errors.DrmCommunicationException, drmaa.errors.NoActiveSessionException,
+                  drmaa.errors.DrmsExitException, drmaa.errors.InternalException)
+
+
+class SessionManager:
+    """
+    Process-wide DRMAA session, opened on first use and kept open across the requests
+
+    DRMAA allows a single session per process, so the threads take turns using it and nested blocks of the same
+    thread reuse it. The session is checked before being used if it has not been used for a while, and it is
+    initialised again after a DRM error that may have broken it, or in a process forked from the one that opened it.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+
+        self._lock = threading.RLock()
+        self._pid = None
+        self._depth = 0
+        self._last_used = 0
+
+        self.initializations = 0
+        self.failed_checks = 0
+        self.resets = 0
+
+    @contextmanager
+    def session(self):
+        with self._lock:
+            if self._depth == 0:
+                self._ensure_session()
+            self._depth += 1
+            try:
+                yield drmaa.Session
+            except SESSION_ERRORS as e:
+                if self._pid is not None:
+                    logger.warning("DRM session error, the session will be initialised again: {}".format(e))
+                    self._reset()
+                raise
+            finally:
+                self._depth -= 1
+                self._last_used = time.monotonic()
+
+    def _ensure_session(self):
+        if self._pid != os.getpid():
+            # The session has never been opened, or it belongs to the parent process
+            self._initialize()
+        elif time.monotonic() - self._last_used > self.check_interval and not self._is_healthy():
+            self.failed_checks += 1
+            self._reset()
+            self._initialize()
+
+    def _initialize(self):
+        try:
+            drmaa.Session.initialize()
+        except drmaa.errors.AlreadyActiveSessionException:
+            pass
+        self._pid = os.getpid()
+        self.initializations += 1
+        logger.debug("DRM session initialised in process {}".format(self._pid))
+
+    def _is_healthy(self):
+        try:
+            drmaa.Session().drmsInfo
+            return True
+        except drmaa.errors.DrmaaException as e:
+            logger.warning("DRM session check failed: {}".format(e))
+            return False
+
+    def _reset(self):
+        self.resets += 1
+        self._pid = None
+        try:
+            drmaa.Session.exit()
+        except drmaa.errors.DrmaaException:
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._pid = None
+                try:
+                    drmaa.Session.exit()
+                except drmaa.errors.DrmaaException:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active'         : self._pid == os.getpid(),
+                'initializations': self.initializations,
+                'failed_checks'  : self.failed_checks,
+                'resets'         : self.resets,
+            }
+
+
+session_manager = SessionManager(check_interval=DRM_SESSION_CHECK_INTERVAL)
+atexit.register(session_manager.close)
+
+
+def session():
+    """
+    Block using the DRMAA session of the process, many DRM operations can be executed inside a single block
+    """
+    return session_manager.session()
+
+
+def get_seconds(clock_time_limit):
+    """
+    The clock time limit in seconds, DRMAA wants an integer while the scripts give it as HH:MM
+    """
+    if isinstance(clock_time_limit, int):
+        return clock_time_limit
+    if isinstance(clock_time_limit, bytes):
+        clock_time_limit = clock_time_limit.decode()
+    hours, minutes = clock_time_limit.split(":")
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+def start_job(task_name, script_dir, out_dir, command, script_args, working_dir, queue='', cpus_per_task=1, n_tasks=1,
+              mem_per_node=None, mem_per_cpu=None, clock_time_limit=None, dependencies=None, dependency_type=None,
+              account=None, is_array=False, begin_index=None, end_index=None, step_index=None, stdout_file=None,
+              stderr_file=None, **kwargs):
+    """
+    Submits a job to the DRM, returns the DRM job id and the name of the job
+
+    The job runs the command inside the working directory, a subdirectory of out_dir. The resources are passed to
+    SLURM through the native specification. Array jobs return the id of the whole array.
+    """
+    work_dir = os.path.join(out_dir, str(working_dir))
+
+    native_specification = ["--ntasks={}".format(n_tasks), "--cpus-per-task={}".format(cpus_per_task)]
+    if queue:
+        native_specification.append("--partition={}".format(queue))
+    if mem_per_node:
+        native_specification.append("--mem={}".format(mem_per_node))
+    if mem_per_cpu:
+        native_specification.append("--mem-per-cpu={}".format(mem_per_cpu))
+    if account:
+        native_specification.append("--account={}".format(account))
+    if dependencies:
+        native_specification.append("--dependency={}:{}".format(dependency_type or "afterany",
+                                                                 ":".join(str(d) for d in dependencies)))
+
+    with session() as s:
+        jt = s.createJobTemplate()
+        try:
+            jt.jobName = task_name
+            jt.remoteCommand = os.path.join(script_dir, command)
+            jt.args = [str(arg) for arg in script_args]
+            jt.workingDirectory = work_dir
+            if stdout_file:
+                jt.outputPath = ":" + os.path.join(work_dir, stdout_file)
+            if stderr_file:
+                jt.errorPath = ":" + os.path.join(work_dir, stderr_file)
+            if clock_time_limit:
+                jt.hardWallclockTimeLimit = get_seconds(clock_time_limit)
+            jt.nativeSpecification = " ".join(native_specification)
+
+            if is_array:
+                job_ids = s.runBulkJobs(jt, begin_index, end_index, step_index)
+                # The elements of an array are identified as <array id>_<index>
+                job_id = job_ids[0].split("_")[0] if job_ids else None
+            else:
+                job_id = s.runJob(jt)
+        finally:
+            s.deleteJobTemplate(jt)
+
+    logger.debug("Job {} submitted to the DRM as {}".format(task_name, job_id))
+    return (int(job_id) if job_id else None), task_name
+
+
+def get_job_status(job_id):
+    """
+    Returns the status of a DRM job
+    """
+    with session() as s:
+        return JOB_STATUS.get(s.jobStatus(str(job_id)), JOB_STATUS[drmaa.JobState.UNDETERMINED])
+
+
+def get_jobs_accounting(job_ids):
+    """
+    Returns the resource usage of the ended DRM jobs by job id, read from the SLURM accounting with a single sacct call
+
+    Unlike the DRMAA wait, the accounting can be read from any process, also long after the job has ended. The jobs
+    that have not ended, or are not in the accounting yet, are left out. The memory is the peak of the job steps in MB.
+    """
+    if not job_ids:
+        return {}
+    output = subprocess.run(["sacct", "--jobs={}".format(",".join(str(job_id) for job_id in job_ids)), "--noheader",
+                             "--parsable2", "--format=JobID,State,ElapsedRaw,TotalCPU,MaxRSS,ExitCode"],
+                            capture_output=True, text=True, timeout=SACCT_TIMEOUT, check=True).stdout
+
+    jobs, max_rss = {}, {}
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) != 6:
+            continue
+        job_id, state, elapsed, cpu_time, rss, exit_code = fields
+        job_id, _, step = job_id.partition(".")
+        if not job_id.isdigit():
+            continue
+        if step:
+            # The memory is measured only for the job steps
+            rss = parse_memory(rss)
+            if rss is not None:
+                max_rss[job_id] = max(rss, max_rss.get(job_id, 0))
+            continue
+        # e.g. CANCELLED by 1000
+        if state.split(" ")[0] in ACCOUNTING_ACTIVE_STATES:
+            continue
+        exit_status, _, signal_number = exit_code.partition(":")
+        jobs[job_id] = {
+                'cpu_time'   : parse_duration(cpu_time),
+                'wall_time'  : float(elapsed) if elapsed.isdigit() else None,
+                'exit_status': int(exit_status) if exit_status.isdigit() and signal_number in ("", "0") else None,
+                'signal'     : get_signal_name(signal_number),
+        }
+
+    return {int(job_id): dict(usage, max_rss=max_rss.get(job_id)) for job_id, usage in jobs.items()}
+
+
+def parse_duration(value):
+    """
+    Seconds of a sacct time as [DD-][HH:]MM:SS[.mmm], None if it is not one
+    """
+    days, _, value = value.rpartition("-")
+    try:
+        seconds = sum(float(part) * 60 ** i for i, part in enumerate(reversed(value.split(":"))))
+        return seconds + int(days or 0) * 86400
+    except ValueError:
+        return None
+
+
+def parse_memory(value):
+    """
+    MB of a sacct memory, in bytes or with a K, M, G or T suffix, None if it is not given
+    """
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 ** 2}
+    try:
+        if value and value[-1] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value) / 1024 ** 2 if value else None
+    except ValueError:
+        return None
+
+
+def get_signal_name(number):
+    if not number.isdigit() or number == "0":
+        return ""
+    try:
+        return signal.Signals(int(number)).name
+    except ValueError:
+        return number
+
+
+def terminate_job(job_id):
+    """
+    Stops a DRM job
+    """
+    with session() as s:
+        s.control(str(job_id), drmaa.JobControlAction.TERMINATE)
+
+
+class _PendingLookup:
+    """
+    A DRM lookup in progress, shared by all the threads asking for the same job
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.status = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.status
+
+
+class JobStatusCache:
+    """
+    Process-wide TTL cache of the DRM job statuses
+
+    Statuses are kept for `ttl` seconds, or for `terminal_ttl` seconds once the job has reached a terminal status.
+    Concurrent lookups of the same job id that miss the cache share a single call to the DRM.
+    """
+
+    def __init__(self, lookup, ttl, terminal_ttl, terminal_statuses=(), max_entries=10000):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.terminal_ttl = terminal_ttl
+        self.terminal_statuses = set(terminal_statuses)
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # job id -> (status, expiration time)
+        self._entries = {}
+        # job id -> _PendingLookup
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.drm_calls = 0
+        self.drm_errors = 0
+
+    def get(self, job_id):
+        job_id = str(job_id)
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+
+            pending = self._pending.get(job_id)
+            if pending is not None:
+                # Another thread is already asking the DRM for this job, wait for its answer
+                self.coalesced += 1
+                is_owner = False
+            else:
+                pending = self._pending[job_id] = _PendingLookup()
+                self.misses += 1
+                self.drm_calls += 1
+                is_owner = True
+
+        if not is_owner:
+            return pending.wait()
+
+        try:
+            pending.status = self.lookup(job_id)
+        except Exception as e:
+            pending.error = e
+            with self._lock:
+                self.drm_errors += 1
+            raise
+        else:
+            self.set(job_id, pending.status)
+        finally:
+            with self._lock:
+                self._pending.pop(job_id, None)
+            pending.event.set()
+
+        return pending.status
+
+    def set(self, job_id, status):
+        ttl = self.terminal_ttl if status in self.terminal_statuses else self.ttl
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._prune()
+            self._entries[str(job_id)] = (status, time.monotonic() + ttl)
+
+    def invalidate(self, job_id):
+        with self._lock:
+            self._entries.pop(str(job_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _prune(self):
+        now = time.monotonic()
+        self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries'   : len(self._entries),
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'coalesced' : self.coalesced,
+                'drm_calls' : self.drm_calls,
+                'drm_errors': self.drm_errors,
+                'hit_rate'  : (self.hits + self.coalesced) / lookups if lookups else None,
+            }
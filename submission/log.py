@@ -11,6 +11,9 @@ class IPAddressFilter(logging.Filter):
                 record.ip = record.request.META.get('REMOTE_ADDR')
         if hasattr(record, 'ident'):
             record.ip = record.ident
+        if not hasattr(record, 'ip'):
+            # Records logged outside a request, e.g. by the management commands
+            record.ip = '-'
         return True
 
 
@@ -18,6 +21,8 @@ class NameFilter(logging.Filter):
     def filter(self, record):
         if "submission_lib" in record.name:
             record.name = record.name.replace("submission_lib.", "drm_lib.")
+        elif record.name == "submission.drm":
+            record.name = "drm_lib"
         else:
             record.name = record.name.replace("submission.", "")
         return True
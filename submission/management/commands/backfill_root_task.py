@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from submission.task.models import Task
+
+
+class Command(BaseCommand):
+    help = "Set the root task of the tasks created before it was stored, walking the task trees in memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of tasks written back at once")
+
+    def handle(self, *args, **options):
+        parents = dict(Task.objects.filter(parent_task__isnull=False).values_list('id', 'parent_task_id'))
+        missing = set(Task.objects.filter(parent_task__isnull=False, root_task__isnull=True).values_list('id', flat=True))
+
+        roots = {}
+        for task_id in missing:
+            root_id = task_id
+            while root_id in parents:
+                root_id = parents[root_id]
+            roots[task_id] = root_id
+
+        tasks = [Task(id=task_id, root_task_id=root_id) for task_id, root_id in roots.items()]
+        with transaction.atomic():
+            Task.objects.bulk_update(tasks, ['root_task'], batch_size=options['batch_size'])
+
+        self.stdout.write("Root task set for {} tasks".format(len(tasks)))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from submission.task.models import ResourceUsageCollection
+
+
+class Command(BaseCommand):
+    help = "Read from the DRM accounting the resource usage of the finished tasks, out of the request cycle"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of tasks whose usage is read at once")
+
+    def handle(self, *args, **options):
+        collected = self.collect(options['batch_size'])
+        self.stdout.write("Read the resource usage of {} tasks".format(collected))
+
+    @staticmethod
+    def collect(batch_size):
+        """
+        Read the usage of the queued tasks that are due, in batches ordered by primary key, returns the number of
+        usages stored
+        """
+        due = ResourceUsageCollection.objects.filter(Q(not_before__isnull=True) | Q(not_before__lte=timezone.now())) \
+            .select_related('task').only('id', 'attempts', 'not_before', 'task__id', 'task___drm_job_id') \
+            .order_by('id')
+
+        collected, last_id = 0, 0
+        while True:
+            batch = list(due.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            collected += len(ResourceUsageCollection.collect(batch))
+            last_id = batch[-1].id
+
+        return collected
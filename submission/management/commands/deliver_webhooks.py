@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from server.settings import WEBHOOK_BATCH_SIZE, WEBHOOK_MAX_ATTEMPTS, WEBHOOK_POLL_INTERVAL, WEBHOOK_TIMEOUT, \
+    WEBHOOK_WORKERS
+from submission.task.models import WebhookDelivery
+from submission.task.webhooks import build_request, check_url, get_session, pin_url
+
+logger = logging.getLogger(__name__)
+
+# Time a worker has to deliver the changes it has taken
+CLAIM_TIME = timedelta(seconds=5 * WEBHOOK_TIMEOUT)
+
+
+class Command(BaseCommand):
+    help = "Send the queued task status changes to their callback URLs with a pool of webhook workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=WEBHOOK_WORKERS, help="Number of webhook workers")
+        parser.add_argument('--interval', type=float, default=WEBHOOK_POLL_INTERVAL,
+                            help="Seconds a worker waits when there is nothing to deliver")
+        parser.add_argument('--once', action='store_true', help="Deliver the queued changes and exit")
+
+    def handle(self, *args, **options):
+        workers = [threading.Thread(target=self.work, args=(options['interval'], options['once']), daemon=True)
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, interval, once):
+        # Each worker keeps its connections to the endpoints open between the deliveries
+        session = get_session()
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    processed = self.process_next(session)
+                except Exception as e:
+                    logger.error("Webhook worker failed: {}".format(e))
+                    processed = False
+
+                if not processed:
+                    if once:
+                        break
+                    time.sleep(interval)
+        finally:
+            session.close()
+            connection.close()
+
+    @staticmethod
+    def process_next(session):
+        """
+        Takes the oldest queued change that is not taken by another worker and sends it to its endpoint, together
+        with the other changes queued for the same endpoint
+
+        The changes are claimed in a short transaction and sent after it has been committed, the other workers skip
+        them until CLAIM_TIME has passed, when they are sent again if this worker has died. Returns False if there is
+        nothing to deliver.
+        """
+        with transaction.atomic():
+            now = timezone.now()
+            due = WebhookDelivery.objects.select_for_update(skip_locked=True) \
+                .filter(Q(not_before__isnull=True) | Q(not_before__lte=now))
+            first = due.first()
+            if first is None:
+                return False
+            deliveries = list(due.filter(url=first.url)[:WEBHOOK_BATCH_SIZE])
+            claimed = WebhookDelivery.objects.filter(id__in=[delivery.id for delivery in deliveries])
+            claimed.update(not_before=now + CLAIM_TIME)
+
+        try:
+            address = check_url(first.url)
+        except ValueError as e:
+            logger.error("Dropping {} status changes for the webhook {}: {}".format(len(deliveries), first.url, e))
+            claimed.delete()
+            return True
+
+        body, headers = build_request(deliveries)
+        # The request is sent to the checked address, the host could resolve to another one now
+        url, host = pin_url(first.url, address)
+        if host:
+            headers['Host'] = host
+        try:
+            # The redirects are not followed, they could lead to an address refused by check_url
+            response = session.post(url, data=body, headers=headers, timeout=WEBHOOK_TIMEOUT, allow_redirects=False)
+            response.raise_for_status()
+            if response.is_redirect:
+                raise requests.HTTPError("Redirected to {}".format(response.headers.get('Location')),
+                                         response=response)
+        except requests.RequestException as e:
+            attempts = max(delivery.attempts for delivery in deliveries) + 1
+            logger.warning("Attempt {} to call the webhook {} failed: {}".format(attempts, first.url, e))
+            if attempts < WEBHOOK_MAX_ATTEMPTS:
+                # Retry later, backing off exponentially
+                claimed.update(attempts=attempts, not_before=timezone.now() + timedelta(seconds=2 ** attempts))
+                return True
+            logger.error("Dropping {} status changes for the webhook {}".format(len(deliveries), first.url))
+
+        claimed.delete()
+        return True
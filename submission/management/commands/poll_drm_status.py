@@ -0,0 +1,61 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from server.settings import DRM_STATUS_POLL_INTERVAL
+from submission.management.commands.collect_resource_usage import Command as CollectResourceUsage
+from submission.task.models import Task
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Periodically refresh the DRM status of every unfinished task, out of the request cycle"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=DRM_STATUS_POLL_INTERVAL,
+                            help="Seconds between two consecutive refreshes")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of tasks loaded and written back at once")
+        parser.add_argument('--once', action='store_true', help="Refresh the statuses once and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            # The command is long-running, drop the connections that the database may have closed in the meantime
+            close_old_connections()
+            try:
+                changed = self.poll(options['batch_size'])
+                logger.debug("Status poller updated {} tasks".format(changed))
+                # The usage of the tasks that have just finished is read while the accounting still has it
+                collected = CollectResourceUsage.collect(options['batch_size'])
+                logger.debug("Status poller read the resource usage of {} tasks".format(collected))
+            except Exception as e:
+                logger.error("Status poller failed: {}".format(e))
+
+            if options['once']:
+                break
+
+            time.sleep(max(0.0, options['interval'] - (time.monotonic() - started)))
+
+    @staticmethod
+    def poll(batch_size):
+        """
+        Refresh the unfinished tasks with a DRM job, in batches ordered by primary key
+        """
+        unfinished = Task.objects.filter(_drm_job_id__isnull=False, deleted=False) \
+            .exclude(_status__in=[Task.Status.DONE.value, Task.Status.FAILED.value]) \
+            .only('id', 'uuid', '_status', '_drm_job_id', 'deleted', 'is_sweep', 'user', 'callback_url') \
+            .order_by('id')
+
+        changed, last_id = 0, 0
+        while True:
+            batch = list(unfinished.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            changed += len(Task.update_drm_statuses(batch))
+            last_id = batch[-1].id
+
+        return changed
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from submission.task.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Delete the expired Idempotency-Key records of the task creations"
+
+    def handle(self, *args, **options):
+        deleted, _ = IdempotencyKey.objects.filter(expiry_date__lte=timezone.now()).delete()
+        self.stdout.write("Deleted {} expired keys".format(deleted))
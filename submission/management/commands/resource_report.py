@@ -0,0 +1,136 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, ExpressionWrapper, F, FloatField, Max, Sum
+from django.utils import timezone
+from pytimeparse.timeparse import timeparse
+
+from submission.drm_job_template.models import DRMJobTemplate
+from submission.management.commands.task_timings import Command as TaskTimingsCommand
+from submission.script.models import Script
+from submission.task.models import TaskResourceUsage
+
+# Cpus used on average while the job is running
+CPUS_USED = ExpressionWrapper(F('cpu_time') / F('wall_time'), output_field=FloatField())
+
+
+def get_requested_memory(job):
+    """
+    Memory requested by the job template in MB, None if it does not set it
+    """
+    cpus = job.cpus_per_task * job.n_tasks
+    try:
+        if job.mem_per_cpu:
+            return float(job.mem_per_cpu) * cpus
+        if job.mem_per_node:
+            return float(job.mem_per_node)
+    except ValueError:
+        pass
+    return None
+
+
+def is_low(used, requested, threshold):
+    return used is not None and bool(requested) and used < threshold * requested
+
+
+class Command(BaseCommand):
+    help = "Compare the resources used by the finished tasks with the ones requested by their job templates and " \
+           "scripts, flagging the over-provisioned ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Start of the time window of the task creation, defaults to 30 days ago")
+        parser.add_argument('--until', help="End of the time window of the task creation, defaults to now")
+        parser.add_argument('--threshold', type=float, default=0.5,
+                            help="Fraction of the requested resource under which the peak usage is flagged")
+        parser.add_argument('--min-tasks', type=int, default=10,
+                            help="Minimum number of accounted tasks to flag a job template or a script")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        until = TaskTimingsCommand.parse_date(options['until']) if options['until'] else timezone.now()
+        since = TaskTimingsCommand.parse_date(options['since']) if options['since'] else until - timedelta(days=30)
+        usages = TaskResourceUsage.objects.filter(task__creation_date__gte=since, task__creation_date__lt=until)
+
+        report = {
+                'jobs'   : self.report_jobs(usages, options['threshold'], options['min_tasks']),
+                'scripts': self.report_scripts(usages, options['threshold'], options['min_tasks']),
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for row in report['jobs']:
+            self.stdout.write("Job template {} ({} tasks){}".format(
+                    row['name'], row['tasks'], " OVER-PROVISIONED" if row['flags'] else ""))
+            self.stdout.write("    cpus    requested={} avg={} peak={}".format(
+                    row['cpus'], self.format_value(row['avg_cpus']), self.format_value(row['peak_cpus'])))
+            self.stdout.write("    memory  requested={} avg={} peak={} (MB)".format(
+                    self.format_value(row['memory']), self.format_value(row['avg_rss']),
+                    self.format_value(row['peak_rss'])))
+        for row in report['scripts']:
+            self.stdout.write("Script {} ({} tasks){}".format(
+                    row['name'], row['tasks'], " OVER-PROVISIONED" if row['flags'] else ""))
+            self.stdout.write("    wall time  limit={} avg={} peak={} (s)".format(
+                    self.format_value(row['max_clock_time']), self.format_value(row['avg_wall_time']),
+                    self.format_value(row['peak_wall_time'])))
+
+    @staticmethod
+    def report_jobs(usages, threshold, min_tasks):
+        """
+        Cpus and memory used by the tasks of each job template, with a single aggregate query
+        """
+        rows = usages.filter(task__task_name__job__isnull=False).values('task__task_name__job').annotate(
+                tasks=Count('task'), total_cpu_time=Sum('cpu_time'), total_wall_time=Sum('wall_time'),
+                peak_cpus=Max(CPUS_USED), avg_rss=Avg('max_rss'), peak_rss=Max('max_rss'),
+        )
+        jobs = DRMJobTemplate.objects.in_bulk([row['task__task_name__job'] for row in rows])
+
+        report = []
+        for row in rows:
+            job = jobs[row['task__task_name__job']]
+            cpus = job.cpus_per_task * job.n_tasks
+            memory = get_requested_memory(job)
+            avg_cpus = None
+            if row['total_cpu_time'] is not None and row['total_wall_time']:
+                avg_cpus = row['total_cpu_time'] / row['total_wall_time']
+
+            flags = []
+            if row['tasks'] >= min_tasks:
+                if is_low(row['peak_cpus'], cpus, threshold):
+                    flags.append('cpus')
+                if is_low(row['peak_rss'], memory, threshold):
+                    flags.append('memory')
+            report.append({
+                    'name'     : job.name, 'tasks': row['tasks'], 'cpus': cpus, 'avg_cpus': avg_cpus,
+                    'peak_cpus': row['peak_cpus'], 'memory': memory, 'avg_rss': row['avg_rss'],
+                    'peak_rss' : row['peak_rss'], 'flags': flags,
+            })
+        return sorted(report, key=lambda r: r['name'])
+
+    @staticmethod
+    def report_scripts(usages, threshold, min_tasks):
+        """
+        Wall time of the tasks of each script compared with its maximum clock time, with a single aggregate query
+        """
+        rows = usages.values('task__task_name').annotate(
+                tasks=Count('task'), avg_wall_time=Avg('wall_time'), peak_wall_time=Max('wall_time'))
+        scripts = Script.objects.in_bulk([row['task__task_name'] for row in rows], field_name='name')
+
+        report = []
+        for row in rows:
+            script = scripts[row['task__task_name']]
+            max_clock_time = timeparse(script._max_clock_time)
+
+            flags = []
+            if row['tasks'] >= min_tasks and is_low(row['peak_wall_time'], max_clock_time, threshold):
+                flags.append('max_clock_time')
+            report.append({
+                    'name'         : script.name, 'tasks': row['tasks'], 'max_clock_time': max_clock_time,
+                    'avg_wall_time': row['avg_wall_time'], 'peak_wall_time': row['peak_wall_time'], 'flags': flags,
+            })
+        return sorted(report, key=lambda r: r['name'])
+
+    @staticmethod
+    def format_value(value):
+        return "{:.1f}".format(value) if value is not None else "-"
@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from server.settings import SUBMISSION_CLAIM_TIME, SUBMISSION_MAX_ATTEMPTS, SUBMISSION_QUEUE_POLL_INTERVAL, \
+    SUBMISSION_WORKERS
+from submission.task.models import Task, TaskSubmission
+from submission.task.submit import start_task
+
+logger = logging.getLogger(__name__)
+
+# Time a worker has to start the job of the task it has taken and record it
+CLAIM_TIME = timedelta(seconds=SUBMISSION_CLAIM_TIME)
+
+
+class Command(BaseCommand):
+    help = "Send the queued tasks to the DRM with a pool of submission workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=SUBMISSION_WORKERS, help="Number of submission workers")
+        parser.add_argument('--interval', type=float, default=SUBMISSION_QUEUE_POLL_INTERVAL,
+                            help="Seconds a worker waits when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Drain the queue and exit")
+
+    def handle(self, *args, **options):
+        workers = [threading.Thread(target=self.work, args=(options['interval'], options['once']), daemon=True)
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, interval, once):
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    processed = self.process_next()
+                except Exception as e:
+                    logger.error("Submission worker failed: {}".format(e))
+                    processed = False
+
+                if not processed:
+                    if once:
+                        break
+                    time.sleep(interval)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def process_next():
+        """
+        Takes the oldest queued task that is not taken by another worker and sends it to the DRM
+
+        The tasks wait in the queue until all their dependencies have been sent to the DRM. The task is claimed in a
+        short transaction and its job is started after it has been committed, then the job is recorded in the task and
+        the task is removed from the queue in a second transaction. The other workers skip the task until CLAIM_TIME
+        has passed, then it is given up instead of being sent again. Returns False if the queue is empty.
+        """
+        with transaction.atomic():
+            now = timezone.now()
+            submission = TaskSubmission.objects.select_for_update(skip_locked=True) \
+                .filter(Q(not_before__isnull=True) | Q(not_before__lte=now)) \
+                .exclude(task__dependencies__submission__isnull=False) \
+                .select_related('task', 'task__task_name', 'task__user') \
+                .first()
+            if submission is None:
+                return False
+
+            task = submission.task
+            if task.deleted:
+                submission.delete()
+                return True
+            if submission.claimed:
+                Command.give_up(submission)
+                return True
+
+            submission.claimed = True
+            submission.not_before = now + CLAIM_TIME
+            submission.save(update_fields=['claimed', 'not_before'])
+
+        with task.deferred_save():
+            try:
+                start_task(task)
+            except Exception as e:
+                if task.drm_job_id is None:
+                    Command.retry(submission, e)
+                    return True
+                logger.warning("Task {}, {}, DRM job {} was started with an error: {}"
+                               .format(task.uuid, task.task_name.name, task.drm_job_id, e))
+            Command.record(submission)
+        return True
+
+    @staticmethod
+    def record(submission):
+        """
+        Stores the job started for a claimed task and removes the task from the queue
+
+        If this fails the task stays claimed, so the job is not started again, and it is given up later
+        """
+        task = submission.task
+        try:
+            with transaction.atomic():
+                task.save_deferred()
+                claimed = TaskSubmission.objects.filter(id=submission.id, not_before=submission.not_before).delete()[0]
+        except Exception as e:
+            logger.error("Task {}, {}, DRM job {} was started but it could not be recorded: {}"
+                         .format(task.uuid, task.task_name.name, task.drm_job_id, e))
+            raise
+        if not claimed:
+            logger.warning("Task {}, {}, DRM job {} was recorded after its claim expired"
+                           .format(task.uuid, task.task_name.name, task.drm_job_id))
+
+    @staticmethod
+    def retry(submission, error):
+        """
+        Releases a claimed task whose job could not be started, to retry later or to reject it after the last attempt
+        """
+        task = submission.task
+        attempts = submission.attempts + 1
+        logger.warning("Task {}, {}, attempt {} to start this job failed: {}"
+                       .format(task.uuid, task.task_name.name, attempts, error))
+        claimed = TaskSubmission.objects.filter(id=submission.id, not_before=submission.not_before)
+        if attempts < SUBMISSION_MAX_ATTEMPTS:
+            # Retry later, backing off exponentially
+            claimed.update(attempts=attempts, claimed=False,
+                           not_before=timezone.now() + timedelta(seconds=2 ** attempts))
+            return
+
+        with transaction.atomic():
+            task.status = Task.Status.REJECTED.value
+            task.save_deferred()
+            claimed.delete()
+        task.delete_from_file_system()
+
+    @staticmethod
+    def give_up(submission):
+        """
+        Removes a task whose claim has expired, because its worker died or could not record the job
+
+        The job may have been started, so the task is not sent again. It is rejected if the job was not recorded, and
+        its files are kept since the job may be running in them.
+        """
+        task = submission.task
+        if task.drm_job_id is None:
+            logger.error("Task {}, {}, was rejected, its job may have been started in the DRM without being recorded"
+                         .format(task.uuid, task.task_name.name))
+            task.status = Task.Status.REJECTED.value
+        submission.delete()
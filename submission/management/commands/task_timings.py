@@ -0,0 +1,143 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Avg, Count, DateTimeField, DurationField, ExpressionWrapper, F, OuterRef, Q, Subquery, \
+    Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from submission.task.models import Task, TaskStatusTransition
+
+# Fields the tasks can be grouped by
+GROUPINGS = {
+        'script': 'task_name__name',
+        'job'   : 'task_name__job__name',
+        'group' : 'user__group__name',
+}
+
+METRICS = ('queue_wait', 'run_time', 'end_to_end')
+
+
+def first_transition(*statuses):
+    """
+    Date the task has entered one of the statuses for the first time
+    """
+    return Subquery(TaskStatusTransition.objects.filter(task=OuterRef('pk'), status__in=statuses)
+                    .order_by('date').values('date')[:1], output_field=DateTimeField())
+
+
+def get_timed_tasks(since, until):
+    """
+    Tasks created in the time window, annotated with the time waited in the DRM queue, the run time and the time from
+    the submission to the end. The times are null if the task has not been seen in the statuses they depend on.
+    """
+    return Task.objects.filter(creation_date__gte=since, creation_date__lt=until).annotate(
+            created_at=first_transition(Task.Status.CREATED.value),
+            started_at=first_transition(Task.Status.RUNNING.value),
+            finished_at=first_transition(Task.Status.DONE.value, Task.Status.FAILED.value),
+    ).annotate(
+            queue_wait=ExpressionWrapper(F('started_at') - F('created_at'), output_field=DurationField()),
+            run_time=ExpressionWrapper(F('finished_at') - F('started_at'), output_field=DurationField()),
+            end_to_end=ExpressionWrapper(F('finished_at') - F('creation_date'), output_field=DurationField()),
+    )
+
+
+class Command(BaseCommand):
+    help = "Report the queue wait, run time and end-to-end time of the tasks by script, job template or group"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--by', choices=GROUPINGS.keys(), default='script', help="Grouping of the tasks")
+        parser.add_argument('--since', help="Start of the time window of the task creation, defaults to 7 days ago")
+        parser.add_argument('--until', help="End of the time window of the task creation, defaults to now")
+        parser.add_argument('--percentiles', default='50,90,99', help="Percentiles to report, separated by commas")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        until = self.parse_date(options['until']) if options['until'] else timezone.now()
+        since = self.parse_date(options['since']) if options['since'] else until - timedelta(days=7)
+        try:
+            percentiles = [float(p) for p in options['percentiles'].split(',')]
+        except ValueError:
+            raise CommandError("The percentiles have to be numbers")
+
+        report = self.report(get_timed_tasks(since, until), GROUPINGS[options['by']], percentiles)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for row in report:
+            self.stdout.write("{} ({} tasks)".format(row['name'], row['tasks']))
+            for metric in METRICS:
+                stats = row[metric]
+                values = " ".join("{}={}".format(k, self.format_seconds(v)) for k, v in stats.items() if k != 'count')
+                self.stdout.write("    {:<11} n={} {}".format(metric, stats['count'], values))
+
+    @staticmethod
+    def report(tasks, key, percentiles):
+        """
+        Count and average of each group with a single aggregate query, then the percentiles of each metric of all the
+        groups with a single query, as the values at their positions in the sorted times of each group
+        """
+        aggregates = {}
+        for metric in METRICS:
+            aggregates[metric + '_count'] = Count(metric)
+            aggregates[metric + '_avg'] = Avg(metric)
+
+        report, entries = [], {}
+        for row in tasks.values(key).annotate(tasks=Count('id'), **aggregates).order_by(key):
+            entry = entries[row[key]] = {'name': row[key], 'tasks': row['tasks']}
+            for metric in METRICS:
+                entry[metric] = {'count': row[metric + '_count'], 'avg': Command.to_seconds(row[metric + '_avg']),
+                                 **{'p{:g}'.format(p): None for p in percentiles}}
+            report.append(entry)
+
+        for metric in METRICS:
+            for name, value, position, size in Command.get_percentile_values(tasks, key, metric, percentiles):
+                for p in percentiles:
+                    if Command.is_percentile_position(p, position, size):
+                        entries[name][metric]['p{:g}'.format(p)] = Command.to_seconds(value)
+        return report
+
+    @staticmethod
+    def get_percentile_values(tasks, key, metric, percentiles):
+        """
+        Values of the metric at the position of any of the percentiles in their group, with the position and the size
+        of the group. The times of each group are numbered in the database with a window function.
+        """
+        ranked = tasks.filter(**{metric + '__isnull': False}).annotate(
+                position=Window(RowNumber(), partition_by=F(key), order_by=F(metric).asc()),
+                size=Window(Count('id'), partition_by=F(key)),
+        )
+        at_percentiles = Q()
+        for p in percentiles:
+            # Same condition as is_percentile_position
+            share = F('size') * p / 100
+            at_percentiles |= Q(position__gte=share) & (Q(position__lt=share + 1) | Q(position=1))
+        return ranked.filter(at_percentiles).values_list(key, metric, 'position', 'size')
+
+    @staticmethod
+    def is_percentile_position(p, position, size):
+        """
+        The percentile is the first position reaching its share of the group, the first one for the percentile 0
+        """
+        share = size * p / 100
+        return position >= share and (position < share + 1 or position == 1)
+
+    @staticmethod
+    def to_seconds(value):
+        return value.total_seconds() if value is not None else None
+
+    @staticmethod
+    def format_seconds(value):
+        return "{:.1f}s".format(value) if value is not None else "-"
+
+    @staticmethod
+    def parse_date(value):
+        date = parse_datetime(value)
+        if date is None and parse_date(value) is not None:
+            date = parse_datetime(value + "T00:00:00")
+        if date is None:
+            raise CommandError("Not a valid date: {}".format(value))
+        return timezone.make_aware(date) if timezone.is_naive(date) else date
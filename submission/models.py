@@ -39,6 +39,8 @@ class Group(models.Model):
     throttling_rate_burst = models.CharField(max_length=30, default="10/s", null=False, blank=False)
     throttling_rate_sustained = models.CharField(max_length=30, default="100/day", null=False, blank=False)
     token_renewal_time = models.CharField(default="1 day", null=False, blank=False, max_length=40)
+    # Called when the status of the tasks of the group users changes, unless the task has its own callback
+    callback_url = models.URLField(max_length=500, null=True, blank=True)
 
     def __str__(self):
         return self.name
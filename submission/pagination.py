@@ -1,4 +1,4 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 from server.settings import MAX_PAGE_SIZE
 
@@ -7,3 +7,15 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = MAX_PAGE_SIZE
+
+
+class TaskCursorPagination(CursorPagination):
+    """
+    Pages of tasks from the most recent, addressed by an opaque cursor instead of the page number
+
+    No total count is returned, and deep pages cost the same as the first one
+    """
+    ordering = ('-creation_date', '-id')
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
@@ -54,17 +54,24 @@ class TaskParameter(models.Model):
 
     # Validate the value passed in input, that has to be of the type specified in the Param
     def validate_value(self, value: str):
-        try:
-            if self.param.type == Parameter.Type.INTEGER.value:
-                int(value)
-            if self.param.type == Parameter.Type.BOOL.value:
-                if isinstance(self.value, bool):
-                    raise ValueError
-            if self.param.type == Parameter.Type.FLOAT.value:
-                float(value)
-            # TODO : if self.param.type == Parameter.Type.FILE:
+        return validate_type(self.param.name, self.param.type, value)
 
-        except ValueError:
-            raise serializers.ValidationError(
-                    "The value for the {} parameter has to be of type {}".format(self.param.name, self.param.type))
-        return value
+
+def validate_type(name, param_type, value):
+    """
+    Check the value passed for the parameter with the given name is of its type
+    """
+    try:
+        if param_type == Parameter.Type.INTEGER.value:
+            int(value)
+        if param_type == Parameter.Type.BOOL.value:
+            if isinstance(value, bool):
+                raise ValueError
+        if param_type == Parameter.Type.FLOAT.value:
+            float(value)
+        # TODO : if param_type == Parameter.Type.FILE:
+
+    except ValueError:
+        raise serializers.ValidationError(
+                "The value for the {} parameter has to be of type {}".format(name, param_type))
+    return value
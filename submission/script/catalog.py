@@ -0,0 +1,59 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from rest_framework.utils.encoders import JSONEncoder
+
+from server.settings import SCRIPT_CATALOG_CACHE_TTL
+from submission.caching import CacheVersion, is_cache_shared
+
+VERSION_KEY = 'script_catalog_version'
+version = CacheVersion(VERSION_KEY)
+
+
+def get_visibility_class(user):
+    """
+    Users in the same visibility class see the same scripts and fields
+    """
+    if user is None:
+        return 'public'
+    if user.is_admin():
+        return 'admin'
+    return 'group:{}'.format(user.group_name())
+
+
+def get_catalog_key(request, query=None):
+    """
+    Key of the catalog in the cache, query has the normalised parameters the catalog depends on, the other parameters
+    of the request are ignored
+    """
+    query = '&'.join('{}={}'.format(k, v) for k, v in sorted((query or {}).items()))
+    return 'script_catalog:{}:{}:{}?{}'.format(version.get(), get_visibility_class(request.user), request.path, query)
+
+
+def get_etag(data):
+    return '"{}"'.format(hashlib.sha256(json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()).hexdigest())
+
+
+def get_cached_catalog(request, render, query=None):
+    """
+    Returns the catalog data and its ETag for the request, calling render only if it is not in the cache
+
+    The catalogs are cached only in a cache shared by all the server processes, otherwise they are rendered for each
+    request.
+    """
+    if not is_cache_shared():
+        data = render()
+        return data, get_etag(data)
+
+    key = get_catalog_key(request, query)
+    cached = cache.get(key)
+    if cached is None:
+        data = render()
+        cached = (data, get_etag(data))
+        cache.set(key, cached, SCRIPT_CATALOG_CACHE_TTL)
+    return cached
+
+
+def invalidate_catalog():
+    version.invalidate()
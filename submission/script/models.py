@@ -2,11 +2,39 @@ from datetime import timedelta
 
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import Exists, OuterRef, Prefetch, Q
 from pytimeparse.timeparse import timeparse
 
 from submission.drm_job_template.models import DRMJobTemplate
 
 
+class ScriptQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Scripts without groups can be used by everyone, otherwise the user must be an admin or belong to one of them
+        """
+        if user is not None and user.is_admin():
+            return self
+
+        script_groups = Script.groups.through.objects.filter(script=OuterRef('pk'))
+        visible = ~Exists(script_groups)
+        if user is not None:
+            visible |= Exists(script_groups.filter(group__name=user.group_name()))
+        return self.filter(visible)
+
+    def for_catalog(self, user):
+        """
+        The scripts visible to the user with what the serializers read, the private parameters only for admins
+        """
+        from submission.parameter.models import Parameter
+
+        if user is not None and user.is_admin():
+            return self.select_related('job').prefetch_related('groups', 'param')
+        return self.visible_to(user).prefetch_related(
+                Prefetch('param', queryset=Parameter.objects.filter(private=False)))
+
+
 class Script(models.Model):
     # Create your models here.
     # Identifier name of the script
@@ -27,9 +55,20 @@ class Script(models.Model):
 
     is_output_visible = models.BooleanField(default=False)
 
+    objects = ScriptQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
+    def is_visible_to(self, user):
+        """
+        Scripts without groups can be used by everyone, otherwise the user must be an admin or belong to one of them
+        """
+        groups = self.groups.all()
+        if not groups:
+            return True
+        return user is not None and (user.is_admin() or user.group_name() in {group.name for group in groups})
+
     @property
     def max_clock_time(self) -> [str, None]:
         def period(delta, pattern):
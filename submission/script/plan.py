@@ -0,0 +1,152 @@
+from django.core.cache import cache
+from rest_framework import exceptions
+
+from server.settings import SUBMISSION_PLAN_CACHE_TTL, SUBMISSION_SCRIPT_DIR
+from submission.caching import CacheVersion, is_cache_shared
+from submission.parameter.models import Parameter, TaskParameter, validate_type
+from submission.script.models import Script
+from submission.utils import format_value
+
+VERSION_KEY = 'submission_plan_version'
+version = CacheVersion(VERSION_KEY)
+
+
+class ParameterSpec:
+    """
+    How the value of a parameter is validated and passed to the command of the script
+    """
+
+    def __init__(self, param):
+        self.id = param.id
+        self.name = param.name
+        self.flag = param.flag or ''
+        self.type = param.type
+        self.private = param.private
+        self.required = param.required
+        self.default = param.default
+
+    def validate(self, value):
+        value = str(value)
+        # Check that the length of the value is not greater than the max length of the field (5000)
+        if len(value) > 5000:
+            raise exceptions.NotAcceptable(
+                    "The value for the parameter {} is too long, the maximum permitted length is 5000"
+                    .format(self.name))
+        return validate_type(self.name, self.type, value)
+
+    def format(self, value):
+        if not self.flag:
+            return [value]
+        # If the param is of type Bool and is positive, no value has to be passed, only the flag
+        if self.type == Parameter.Type.BOOL.value:
+            return [self.flag]
+
+        value = format_value(value, self.type)
+        if self.flag[-1] == '=':
+            return ["{}{}".format(self.flag, value)]
+        return [self.flag, value]
+
+
+class SubmissionPlan:
+    """
+    Everything needed to send the tasks of a script to the DRM that does not depend on the task, compiled once from
+    the script, its parameters and its job template
+    """
+
+    def __init__(self, script, parameters):
+        self.script_name = script.name
+        self.command = script.command
+        # If the command is defined as absolute then do not add the submission script dir first
+        self.script_dir = '' if script.command[0] == '/' else SUBMISSION_SCRIPT_DIR
+        self.clock_time_limit = bytes(script.max_clock_time, encoding='utf8')
+        self.is_array = script.is_array
+        self.begin_index = script.begin_index
+        self.end_index = script.end_index
+        self.step_index = script.step_index
+        # Resources of the job template, passed as they are to start_job
+        self.drm_params = None
+        if script.job is not None:
+            self.drm_params = {k: v for k, v in script.job.__dict__.items() if not k.startswith('_')}
+        # The parameters with a flag come after the positional ones, sorted by flag
+        self.parameters = {p.id: ParameterSpec(p) for p in sorted(parameters, key=lambda p: p.flag or '')}
+
+    def build_params(self, values, skip=()):
+        """
+        Validate the values passed for the parameters of the script, the ones in skip are left out
+
+        Returns the TaskParameter objects without saving them. File parameters cannot be passed this way.
+        """
+        task_params = []
+        for spec in self.parameters.values():
+            if spec.id in skip:
+                continue
+            # Param not private and user has set it
+            if not spec.private and spec.name in values.keys():
+                if spec.type == Parameter.Type.FILE.value:
+                    raise exceptions.NotAcceptable(
+                            "The parameter {} is a file, files cannot be uploaded in this request".format(spec.name))
+                task_params.append(TaskParameter(param_id=spec.id, value=spec.validate(values[spec.name])))
+            # Param is required and user did not set it
+            elif spec.required and spec.name not in values.keys():
+                raise exceptions.NotAcceptable("The parameter {} must be specified for the {} task"
+                                               .format(spec.name, self.script_name))
+            # Param is private and has to be set
+            elif spec.private:
+                task_params.append(TaskParameter(param_id=spec.id, value=spec.default))
+        return task_params
+
+    def has_parameters(self, param_ids):
+        return all(param_id in self.parameters for param_id in param_ids)
+
+    def format_args(self, task_params):
+        """
+        Arguments of the command for the values of the parameters of a task, in the order of the parameters
+        """
+        values = {task_param.param_id: task_param.value for task_param in task_params}
+        args = []
+        for param_id, spec in self.parameters.items():
+            if param_id in values:
+                args.extend(spec.format(values[param_id]))
+        return args
+
+    def get_job_args(self):
+        return dict(task_name=self.script_name, script_dir=self.script_dir, command=self.command,
+                    clock_time_limit=self.clock_time_limit, is_array=self.is_array, begin_index=self.begin_index,
+                    end_index=self.end_index, step_index=self.step_index)
+
+
+def get_plan_key(script_name):
+    return 'submission_plan:{}:{}'.format(version.get(), script_name)
+
+
+def compile_plan(script_name, script=None, parameters=None):
+    """
+    The plan of the script, compiled from the script and the parameters already loaded if given
+    """
+    if script is None:
+        script = Script.objects.select_related('job').get(name=script_name)
+    if parameters is None:
+        parameters = script.param.all()
+    return SubmissionPlan(script, parameters)
+
+
+def get_plan(script_name, param_ids=(), script=None, parameters=None):
+    """
+    The submission plan of the script, compiled again if it is not in the cache or it does not know some parameters
+
+    The plans are cached only in a cache shared by all the server processes. Otherwise they are compiled for each
+    request, from the script, its job template and its parameters if they have already been loaded.
+    """
+    if not is_cache_shared():
+        return compile_plan(script_name, script, parameters)
+
+    key = get_plan_key(script_name)
+    plan = cache.get(key)
+    if plan is None or not plan.has_parameters(param_ids):
+        plan = compile_plan(script_name, script, parameters)
+        cache.set(key, plan, SUBMISSION_PLAN_CACHE_TTL)
+    return plan
+
+
+def invalidate_plans():
+    version.invalidate()
@@ -0,0 +1,31 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from submission.drm_job_template.models import DRMJobTemplate
+from submission.models import Group
+from submission.parameter.models import Parameter
+from submission.script.catalog import invalidate_catalog
+from submission.script.models import Script
+from submission.script.plan import invalidate_plans
+
+
+@receiver([post_save, post_delete], sender=Script)
+@receiver([post_save, post_delete], sender=Parameter)
+@receiver([post_save, post_delete], sender=Group)
+@receiver([post_save, post_delete], sender=DRMJobTemplate)
+@receiver(m2m_changed, sender=Script.groups.through)
+def script_catalog_changed(**kwargs):
+    """
+    Discard the cached script catalogs when a script, or anything shown with it, is changed
+    """
+    invalidate_catalog()
+
+
+@receiver([post_save, post_delete], sender=Script)
+@receiver([post_save, post_delete], sender=Parameter)
+@receiver([post_save, post_delete], sender=DRMJobTemplate)
+def submission_plan_changed(**kwargs):
+    """
+    Discard the cached submission plans when a script, its parameters or its job template are changed
+    """
+    invalidate_plans()
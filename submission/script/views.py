@@ -1,9 +1,15 @@
-from rest_framework import viewsets
+import math
+
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import status, viewsets
 from rest_framework.decorators import throttle_classes
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 from submission.authentication import BearerAuthentication
+from submission.script.catalog import get_cached_catalog
 from submission.script.models import Script
 from submission.script.serializers import ScriptSerializer, SuperScriptSerializer
 from submission.throttles import IPRateThrottleBurst, UserBasedThrottleBurst
@@ -32,30 +38,70 @@ class ScriptViewSet(viewsets.ReadOnlyModelViewSet):
             serializer = self.get_serializer(queryset, many=True)
             return Response(serializer.data)
 
-    @throttle_classes([IPRateThrottleBurst, UserBasedThrottleBurst])
-    def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+    def get_queryset(self):
+        return Script.objects.for_catalog(self.request.user)
 
-        allowed_scripts = []
-        for script in queryset:
-            if script.groups.count() == 0:
-                allowed_scripts.append(script.name)
-            elif request.user and (request.user.is_admin() or script.groups.filter(name=request.user.group).exists()):
-                allowed_scripts.append(script.name)
+    def get_catalog_query(self, request):
+        """
+        The page of the list, normalised not to cache the same page under many keys
+        """
+        if self.action != 'list' or self.paginator is None:
+            return {}
+        page = request.query_params.get(self.paginator.page_query_param, '1')
+        return {'page': str(int(page)) if page.isdigit() else page, 'page_size': self.paginator.get_page_size(request)}
 
-        queryset = queryset.filter(name__in=allowed_scripts)
+    def get_catalog_response(self, request, render):
+        """
+        Serve the catalog from the cache of the visibility class of the user, with 304 if the client has it already
+        """
+        data, etag = get_cached_catalog(request, render, self.get_catalog_query(request))
+        etags = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in etags or '*' in etags:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(data)
+        response['ETag'] = etag
+        # The catalog depends on the user
+        patch_vary_headers(response, ['Authorization', 'Cookie'])
+        return response
 
-        return self.get_response(queryset)
+    def render_list(self):
+        """
+        The page of the catalog without the links to the other pages, which depend on the URL of each request
+        """
+        data = self.get_response(self.filter_queryset(self.get_queryset())).data
+        if self.paginator is not None:
+            data = {k: v for k, v in data.items() if k not in ('next', 'previous')}
+        return data
+
+    def add_page_links(self, request, data):
+        """
+        The page of the catalog with the links to the next and previous pages built for this request, the same ones
+        the paginator builds
+        """
+        paginator = self.paginator
+        page_size = paginator.get_page_size(request)
+        last = max(math.ceil(data['count'] / page_size), 1) if page_size else 1
+        page = request.query_params.get(paginator.page_query_param, 1)
+        number = last if page in paginator.last_page_strings else int(page)
+
+        url = request.build_absolute_uri()
+        next_link, previous_link = None, None
+        if number < last:
+            next_link = replace_query_param(url, paginator.page_query_param, number + 1)
+        if number > 1:
+            previous_link = remove_query_param(url, paginator.page_query_param) if number == 2 \
+                else replace_query_param(url, paginator.page_query_param, number - 1)
+        return {'count': data['count'], 'next': next_link, 'previous': previous_link, 'results': data['results']}
 
     @throttle_classes([IPRateThrottleBurst, UserBasedThrottleBurst])
-    def retrieve(self, request, *args, **kwargs):
-        script = self.get_object()
-        serializer = self.get_serializer(script)
-        user = request.user
+    def list(self, request, *args, **kwargs):
+        response = self.get_catalog_response(request, self.render_list)
+        if self.paginator is not None and response.data is not None:
+            response.data = self.add_page_links(request, response.data)
+        return response
 
-        if script.groups.count() == 0:
-            return Response(serializer.data)
-        elif user and (user.is_admin() or script.groups.filter(name=user.group).exists()):
-            return Response(serializer.data)
-        else:
-            return Response(status=404)
+    @throttle_classes([IPRateThrottleBurst, UserBasedThrottleBurst])
+    def retrieve(self, request, *args, **kwargs):
+        # The scripts that are not visible to the user are not found
+        return self.get_catalog_response(request, lambda: self.get_serializer(self.get_object()).data)
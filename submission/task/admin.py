@@ -1,10 +1,32 @@
 from django.contrib import admin
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from rangefilter.filters import DateRangeFilter
 
+from submission.drm import terminate_job
 from submission.parameter.admin import TaskParamAdminInline
-from submission.task.models import Task
-from submission_lib.manage import terminate_job
+from submission.task.models import Task, TaskResourceUsage, TaskStatusTransition
+
+
+class TaskStatusTransitionInline(admin.TabularInline):
+    model = TaskStatusTransition
+    fields = ('status', 'date')
+    readonly_fields = ('status', 'date')
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class TaskResourceUsageInline(admin.TabularInline):
+    model = TaskResourceUsage
+    fields = ('cpu_time', 'wall_time', 'max_rss', 'exit_status', 'signal')
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(Task)
@@ -32,7 +54,7 @@ class TaskAdmin(admin.ModelAdmin):
 
     readonly_fields = ()
 
-    inlines = [TaskParamAdminInline]
+    inlines = [TaskParamAdminInline, TaskResourceUsageInline, TaskStatusTransitionInline]
 
     def outputs(self, obj):
         out_file = "{}_out.txt".format(str(obj.uuid)[:8])
@@ -64,18 +86,17 @@ class TaskAdmin(admin.ModelAdmin):
             # Delete task folder and all files
             task.delete_from_file_system()
 
-        # Set the tasks to deleted
-        queryset.update(deleted=True)
+        # Set the tasks to deleted, the update does not set the auto_now fields
+        queryset.update(deleted=True, update_date=timezone.now())
 
     @admin.action(description="Delete and remove from database")
     def delete_and_remove(self, request, queryset):
         self.delete_queryset(request, queryset)
         queryset.delete()
 
-    def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-        # Update the drm status of the task
-        for task in queryset:
-            task.update_drm_status()
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        # Update the drm status only of the tasks in the displayed page
+        Task.refresh_drm_statuses(changelist.result_list)
 
-        return queryset
+        return changelist
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.utils.encoders import JSONEncoder
+
+from server.settings import TASK_EVENTS_POLL_INTERVAL, TASK_EVENTS_TIMEOUT
+from submission.authentication import BearerAuthentication
+from submission.task.models import Task
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = {Task.Status.DONE.value, Task.Status.FAILED.value}
+
+
+class Subscription:
+    """
+    Changes of a task, of the tasks of a user or of all the tasks if neither is given, waiting to be streamed
+    """
+
+    def __init__(self, task_id=None, user_id=None):
+        self.task_id = task_id
+        self.user_id = user_id
+        self.queue = asyncio.Queue()
+
+    def matches(self, change):
+        if self.task_id is not None:
+            return change['id'] == self.task_id
+        return self.user_id is None or change['user_id'] == self.user_id
+
+
+class TaskEventHub:
+    """
+    Fan-out of the task changes to the streams open in this process
+
+    A single loop polls the database for the tasks changed since a little before the last change it has seen, among
+    the ones watched by the subscriptions, and dispatches each change to the queues of the matching subscriptions. The
+    loop runs only while there are subscriptions. Without the status poller, it also refreshes the DRM status of the
+    tasks watched one by one, the changes of the tasks watched through their user are seen once the poller has written
+    them.
+    """
+
+    # Overlap between consecutive polls, the transactions committed late are seen if their update date is not older
+    overlap = timedelta(seconds=5)
+
+    def __init__(self, interval):
+        self.interval = interval
+
+        self._subscriptions = set()
+        self._loop_task = None
+        # Update date the next polls start from
+        self._since = None
+        # task id -> update date of the changes dispatched since _since
+        self._dispatched = {}
+
+    def subscribe(self, task_id=None, user_id=None, since=None):
+        """
+        Subscribe to the changes after since, or after now if not given
+        """
+        subscription = Subscription(task_id, user_id)
+        self._subscriptions.add(subscription)
+        since = since or timezone.now()
+        if self._loop_task is None or self._loop_task.done():
+            self._since = since
+            self._loop_task = asyncio.get_running_loop().create_task(self._run())
+        else:
+            self._since = min(self._since, since)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.discard(subscription)
+
+    async def _run(self):
+        while self._subscriptions:
+            await asyncio.sleep(self.interval)
+            task_ids = {s.task_id for s in self._subscriptions if s.task_id is not None}
+            user_ids = {s.user_id for s in self._subscriptions if s.task_id is None}
+            try:
+                changes = await sync_to_async(self.poll)(task_ids, user_ids)
+            except Exception as e:
+                logger.warning("Cannot poll the changes of the tasks: {}".format(e))
+                continue
+
+            for change in changes:
+                for subscription in list(self._subscriptions):
+                    if subscription.matches(change):
+                        subscription.queue.put_nowait(change)
+
+        self._dispatched.clear()
+
+    def poll(self, task_ids, user_ids):
+        """
+        Returns the watched tasks changed since the last change seen, user ids include None to watch all the tasks
+        """
+        # The loop runs for a long time, drop the connections that the database may have closed in the meantime
+        close_old_connections()
+
+        if self._since is None:
+            self._since = timezone.now()
+        watched = Task.objects.all()
+        if None not in user_ids:
+            watched = watched.filter(Q(id__in=task_ids) | Q(user_id__in=user_ids))
+
+        Task.refresh_drm_statuses(list(
+                Task.objects.filter(id__in=task_ids, _drm_job_id__isnull=False, deleted=False)
+                .exclude(_status__in=FINISHED_STATUSES)
+                .only('id', 'uuid', '_status', '_drm_job_id', 'deleted', 'is_sweep', 'user', 'callback_url')))
+
+        changes, latest = [], None
+        for change in watched.filter(update_date__gte=self._since).order_by('update_date', 'id') \
+                .values('id', 'uuid', 'user_id', '_status', 'update_date', 'deleted'):
+            latest = change['update_date']
+            # The changes in the overlap may have already been dispatched by the previous polls
+            if self._dispatched.get(change['id']) != change['update_date']:
+                self._dispatched[change['id']] = change['update_date']
+                changes.append(change)
+
+        if latest is not None:
+            self._since = max(self._since, latest - self.overlap)
+            self._dispatched = {k: v for k, v in self._dispatched.items() if v >= self._since}
+        return changes
+
+
+# Shared by all the streams served by this process
+hub = TaskEventHub(TASK_EVENTS_POLL_INTERVAL)
+
+
+def format_event(change):
+    data = {'uuid': change['uuid'], 'status': change['_status'], 'update_date': change['update_date'],
+            'deleted': change['deleted']}
+    return "event: status\ndata: {}\n\n".format(json.dumps(data, cls=JSONEncoder))
+
+
+def has_finished(change):
+    return change['_status'] in FINISHED_STATUSES or change['deleted']
+
+
+async def stream(subscription, initial=None, until_finished=False):
+    """
+    Server-Sent Events of the changes of the subscription, a comment is sent when idle to keep the connection open
+
+    The stream is closed after TASK_EVENTS_TIMEOUT seconds, the clients reconnect by themselves.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TASK_EVENTS_TIMEOUT
+    try:
+        yield "retry: {}\n\n".format(int(TASK_EVENTS_POLL_INTERVAL * 1000))
+        if initial is not None:
+            yield format_event(initial)
+            if until_finished and has_finished(initial):
+                return
+
+        while loop.time() < deadline:
+            try:
+                change = await asyncio.wait_for(subscription.queue.get(), min(15, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if initial is not None and change['id'] == initial['id'] \
+                    and change['update_date'] <= initial['update_date']:
+                # Already sent as the initial change
+                continue
+            yield format_event(change)
+            if until_finished and has_finished(change):
+                return
+    finally:
+        hub.unsubscribe(subscription)
+
+
+def get_user(request):
+    """
+    The user of the token, or the admin logged in the admin site
+    """
+    user, _ = BearerAuthentication().authenticate(request)
+    if user is None and request.user.is_authenticated:
+        user = request.user
+    return user, user is not None and user.is_admin()
+
+
+def get_task(request, uuid):
+    """
+    The task with the given UUID if the user can see it, as the initial change of its stream
+    """
+    user, is_admin = get_user(request)
+    task = Task.objects.filter(uuid=uuid).values('id', 'uuid', 'user_id', '_status', 'update_date', 'deleted').first()
+    if task is None or not (is_admin or task['user_id'] is None or (user and task['user_id'] == user.id)):
+        return None
+    if task['deleted'] and not is_admin:
+        return None
+    return task
+
+
+def event_response(subscription, initial=None, until_finished=False):
+    response = StreamingHttpResponse(stream(subscription, initial, until_finished), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Do not let the proxies buffer the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def task_events(request, uuid):
+    """
+    Stream the status changes of a task, until it has finished
+    """
+    read_date = timezone.now()
+    try:
+        task = await sync_to_async(get_task)(request, uuid)
+    except (AuthenticationFailed, ValueError):
+        return HttpResponse(status=401)
+    if task is None:
+        return HttpResponse(status=404)
+
+    # The changes after the initial one are streamed, also the ones made before subscribing. Its update date is not
+    # used when older than the overlap, not to dispatch again the old changes of the other subscriptions.
+    since = max(task['update_date'], read_date - hub.overlap)
+    return event_response(hub.subscribe(task_id=task['id'], since=since), initial=task, until_finished=True)
+
+
+async def user_events(request):
+    """
+    Stream the status changes of all the tasks of the user, of all the tasks for admins
+    """
+    try:
+        user, is_admin = await sync_to_async(get_user)(request)
+    except AuthenticationFailed:
+        return HttpResponse(status=401)
+    if user is None:
+        return HttpResponse(status=401)
+
+    return event_response(hub.subscribe(user_id=None if is_admin else user.id))
@@ -0,0 +1,80 @@
+import hashlib
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from server.settings import IDEMPOTENCY_KEY_LEASE, IDEMPOTENCY_KEY_TTL
+from submission.task.models import IdempotencyKey
+from submission.utils import get_ip
+
+
+def get_scope(request):
+    if request.user is not None:
+        return 'user:{}'.format(request.user.id)
+    return 'ip:{}'.format(get_ip(request))
+
+
+def get_request_hash(request):
+    """
+    Digest of the values of the request, the files are represented by their name and size
+    """
+    digest = hashlib.sha256()
+    for name, values in sorted(request.data.lists()):
+        for value in values:
+            if hasattr(value, 'size'):
+                value = "{}:{}".format(value.name, value.size)
+            digest.update("{}\0{}\0".format(name, value).encode())
+    return digest.hexdigest()
+
+
+def claim_key(request, key):
+    """
+    Stores the key for the request, returns it and whether it was stored now or by a previous request
+
+    The key of a previous request is taken over if it has expired, or if that request has not stored its task within
+    IDEMPOTENCY_KEY_LEASE seconds, e.g. because its process has died, so the lease must exceed the longest time a task
+    creation can take. The key of a previous request is None if that request has just failed and released it.
+    """
+    now = timezone.now()
+    scope = get_scope(request)
+    request_hash = get_request_hash(request)
+    expiry_date = now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+    try:
+        # Savepoint, the insert fails if the key is already stored
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(scope=scope, key=key, request_hash=request_hash,
+                                                 expiry_date=expiry_date), True
+    except IntegrityError:
+        pass
+
+    # Only one of the concurrent requests can take the key over
+    released = Q(expiry_date__lte=now) | Q(task__isnull=True,
+                                           creation_date__lt=now - timedelta(seconds=IDEMPOTENCY_KEY_LEASE))
+    if IdempotencyKey.objects.filter(released, scope=scope, key=key) \
+            .update(request_hash=request_hash, task=None, creation_date=now, expiry_date=expiry_date):
+        return IdempotencyKey.objects.get(scope=scope, key=key), True
+    return IdempotencyKey.objects.select_related('task').filter(scope=scope, key=key).first(), False
+
+
+def get_claimed(record):
+    """
+    The key claimed by a request, as long as it has not been taken over by another request
+    """
+    return IdempotencyKey.objects.filter(id=record.id, creation_date=record.creation_date)
+
+
+def release_key(record):
+    """
+    Deletes the key claimed by a request that has failed, the request can be retried
+    """
+    get_claimed(record).delete()
+
+
+def store_task(record, task):
+    """
+    Stores the task created by the request that claimed the key, the retries return it from now on
+    """
+    if get_claimed(record).update(task=task):
+        record.task = task
@@ -1,14 +1,22 @@
+import logging
 import shutil
 import uuid
+from contextlib import contextmanager
+from datetime import timedelta
 from os.path import join
 
 from django.db import models
+from django.utils import timezone
 from django_filters import CharFilter, ChoiceFilter
 from django_filters.rest_framework import FilterSet
 
-from server.settings import REMOVE_TASK_FILES_ON_DELETE, SUBMISSION_OUTPUT_DIR
+from server.settings import DRM_STATUS_CACHE_TERMINAL_TTL, DRM_STATUS_CACHE_TTL, DRM_STATUS_POLLER, \
+    REMOVE_TASK_FILES_ON_DELETE, RESOURCE_USAGE_MAX_ATTEMPTS, SUBMISSION_OUTPUT_DIR
+from submission.drm import JobStatusCache, get_job_status, get_jobs_accounting
 from submission.models import User
-from submission_lib.manage import get_job_status
+from submission.task.signals import task_status_changed
+
+logger = logging.getLogger(__name__)
 
 
 class Task(models.Model):
@@ -52,30 +60,211 @@ class Task(models.Model):
     deleted = models.BooleanField(default=False, null=False, blank=False)
 
     parent_task = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True)
+    # First ancestor of the task, null for the tasks without a parent. It is set at creation, so that the whole tree
+    # of a task can be loaded with a single query
+    root_task = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='tree_tasks')
     _drm_job_id = models.PositiveIntegerField(null=True, blank=True)
 
     dependencies = models.ManyToManyField('self', symmetrical=False, blank=True, related_name='dependents')
     dependency_type = models.CharField(max_length=20, choices=DependencyTypes.choices, blank=True, null=True,
                                        default=None)
 
+    # Parameter sweep, each element is an index of the same DRM array job
+    is_sweep = models.BooleanField(default=False)
+
+    # Called when the status of the task changes, see WebhookDelivery
+    callback_url = models.URLField(max_length=500, null=True, blank=True)
+
+    # Fields changed inside a deferred_save block, None when the setters save immediately
+    _deferred_fields = None
+
     def has_finished(self):
         return self.status in {self.Status.DONE.value, self.Status.FAILED.value} or self.deleted
 
     def update_drm_status(self):
-        if self.drm_job_id is not None and not self.has_finished():
-            self.status = get_job_status(str(self.drm_job_id))
+        self.update_drm_statuses([self])
+
+    @classmethod
+    def update_drm_statuses(cls, tasks):
+        """
+        Query the DRM for the status of the unfinished tasks and write the changed ones with a single bulk update
+
+        The status of a parameter sweep is derived from the status of its elements. Returns the list of tasks whose
+        status has changed
+        """
+        unfinished = [task for task in tasks if task.drm_job_id is not None and not task.has_finished()]
+
+        sweeps = {task.id: task for task in unfinished if task.is_sweep}
+        elements, changed_sweeps = TaskArrayElement.update_drm_statuses(sweeps) if sweeps else ({}, set())
+
+        changed_tasks, changed_statuses = [], []
+        for task in unfinished:
+            if task.is_sweep:
+                status = task.get_sweep_status(elements.get(task.id, []))
+            else:
+                try:
+                    status = status_cache.get(task.drm_job_id)
+                except Exception as e:
+                    logger.warning(
+                            "Task {}, cannot get the status of DRM job {}: {}".format(task.uuid, task.drm_job_id, e))
+                    continue
+            # A sweep is changed also when only the status of some of its elements is
+            if status != task._status:
+                changed_statuses.append(task)
+            if status != task._status or task.id in changed_sweeps:
+                task._status = status
+                changed_tasks.append(task)
+
+        if changed_tasks:
+            # The bulk update does not set the auto_now fields
+            now = timezone.now()
+            for task in changed_tasks:
+                task.update_date = now
+            cls.objects.bulk_update(changed_tasks, ['_status', 'update_date'])
+            if changed_statuses:
+                task_status_changed.send(sender=cls, tasks=changed_statuses)
+
+        return changed_tasks
+
+    def get_sweep_status(self, elements):
+        """
+        The sweep is finished when all its elements are, and it is DONE only if all of them are
+        """
+        statuses = {element.status for element in elements}
+        finished = {self.Status.DONE.value, self.Status.FAILED.value}
+        if not statuses:
+            return self._status
+        if statuses <= finished:
+            return self.Status.FAILED.value if self.Status.FAILED.value in statuses else self.Status.DONE.value
+        if self.Status.RUNNING.value in statuses:
+            return self.Status.RUNNING.value
+        return self.Status.QUEUED_ACTIVE.value
+
+    @classmethod
+    def refresh_drm_statuses(cls, tasks):
+        """
+        Update the DRM status of the tasks inside the request, unless it is already done by the status poller
+        """
+        if not DRM_STATUS_POLLER:
+            cls.update_drm_statuses(tasks)
 
     def delete_from_user(self):
         self.deleted = True
         self.save()
 
+    @contextmanager
+    def deferred_save(self):
+        """
+        Collect the fields changed through the setters inside the block and write them with a single update at the end
+
+        Nothing is written if the block raises an exception
+        """
+        self._deferred_fields = set()
+        try:
+            yield self
+        except BaseException:
+            self._deferred_fields = None
+            raise
+
+        try:
+            self.save_deferred()
+        finally:
+            self._deferred_fields = None
+
+    def save_deferred(self):
+        """
+        Write the fields changed so far inside the deferred_save block, the block goes on collecting the next changes
+        """
+        fields, self._deferred_fields = self._deferred_fields, set()
+        if fields:
+            self.save(update_fields=[*fields, 'update_date'])
+            if '_status' in fields:
+                task_status_changed.send(sender=self.__class__, tasks=[self])
+
+    @classmethod
+    @contextmanager
+    def deferred_save_all(cls, tasks):
+        """
+        Same as deferred_save for many tasks, the changed fields of all the tasks are written with a single bulk update
+        """
+        for task in tasks:
+            task._deferred_fields = set()
+        try:
+            yield tasks
+        except BaseException:
+            for task in tasks:
+                task._deferred_fields = None
+            raise
+
+        fields = set()
+        changed_statuses = []
+        now = timezone.now()
+        for task in tasks:
+            fields.update(task._deferred_fields)
+            if '_status' in task._deferred_fields:
+                changed_statuses.append(task)
+            task._deferred_fields = None
+            # The bulk update does not set the auto_now fields
+            task.update_date = now
+        if fields:
+            cls.objects.bulk_update(tasks, [*fields, 'update_date'])
+        if changed_statuses:
+            task_status_changed.send(sender=cls, tasks=changed_statuses)
+
+    def save_fields(self, *fields):
+        """
+        Save the given fields, or postpone it to the end of the deferred_save block if inside one
+        """
+        if self._deferred_fields is not None:
+            self._deferred_fields.update(fields)
+        else:
+            self.save(update_fields=[*fields, 'update_date'])
+            if '_status' in fields:
+                task_status_changed.send(sender=self.__class__, tasks=[self])
+
     def get_first_ancestor(self):
+        if self.root_task_id is not None:
+            return self.root_task
+
+        # Tasks created before the root task was stored, see the backfill_root_task command
         current_task = self
         while current_task.parent_task is not None:
             current_task = current_task.parent_task
 
         return current_task
 
+    def get_root_id(self):
+        """
+        Id of the root task of the tree, to be set as root_task of the children of this task
+        """
+        return self.root_task_id or self.id
+
+    @classmethod
+    def get_descendants_of(cls, tasks):
+        """
+        Returns the UUIDs of all the descendants of each task, by task id, loading the trees of the tasks with a single
+        query. The descendants are listed depth first, the children of each task from the most recent.
+        """
+        roots = {task.get_root_id() for task in tasks}
+        if not roots:
+            return {}
+
+        children = {}
+        for task_id, task_uuid, parent_id in cls.objects.filter(root_task__in=roots) \
+                .order_by('-creation_date', '-id').values_list('id', 'uuid', 'parent_task_id'):
+            children.setdefault(parent_id, []).append((task_id, task_uuid))
+
+        descendants = {}
+        for task in tasks:
+            found = []
+            stack = list(reversed(children.get(task.id, [])))
+            while stack:
+                child_id, child_uuid = stack.pop()
+                found.append(child_uuid)
+                stack.extend(reversed(children.get(child_id, [])))
+            descendants[task.id] = found
+        return descendants
+
     @property
     def status(self):
         return self._status
@@ -83,7 +272,7 @@ class Task(models.Model):
     @status.setter
     def status(self, status):
         self._status = status
-        self.save(update_fields=['_status'])
+        self.save_fields('_status')
 
     @property
     def drm_job_id(self):
@@ -92,7 +281,7 @@ class Task(models.Model):
     @drm_job_id.setter
     def drm_job_id(self, job_id):
         self._drm_job_id = job_id
-        self.save(update_fields=['_drm_job_id'])
+        self.save_fields('_drm_job_id')
 
     @property
     def task_description(self):
@@ -101,7 +290,7 @@ class Task(models.Model):
     @task_description.setter
     def task_description(self, description):
         self._task_description = description
-        self.save(update_fields=['_task_description'])
+        self.save_fields('_task_description')
 
     @property
     def sender_ip_addr(self):
@@ -110,7 +299,7 @@ class Task(models.Model):
     @sender_ip_addr.setter
     def sender_ip_addr(self, ip_addr):
         self._sender_ip_addr = ip_addr
-        self.save(update_fields=['_sender_ip_addr'])
+        self.save_fields('_sender_ip_addr')
 
     @property
     def files_name(self):
@@ -119,7 +308,7 @@ class Task(models.Model):
     @files_name.setter
     def files_name(self, files_name):
         self._files_name = files_name
-        self.save(update_fields=['_files_name'])
+        self.save_fields('_files_name')
 
     def __str__(self):
         return "{} - {}".format(self.uuid, self.task_name.name)
@@ -133,6 +322,277 @@ class Task(models.Model):
 
     class Meta:
         ordering = ['-creation_date']
+        indexes = [
+            # Listing of the tasks, as used by the cursor pagination
+            models.Index(fields=['-creation_date', '-id'], name='task_creation_idx'),
+            models.Index(fields=['user', 'deleted', '-creation_date', '-id'], name='task_user_creation_idx'),
+            # Changes since a given time, for the delta sync of the task listing
+            models.Index(fields=['update_date', 'id'], name='task_update_idx'),
+            models.Index(fields=['user', 'update_date', 'id'], name='task_user_update_idx'),
+        ]
+
+
+class TaskSubmission(models.Model):
+    """
+    Queue of the tasks accepted by the ws that are waiting to be sent to the DRM by the submission workers
+    """
+    task = models.OneToOneField(Task, on_delete=models.CASCADE, related_name='submission')
+    creation_date = models.DateTimeField(auto_now_add=True)
+    # Number of failed attempts to start the task in the DRM
+    attempts = models.PositiveIntegerField(default=0)
+    # The submission is not taken by the workers before this time, used to retry failed attempts later
+    not_before = models.DateTimeField(null=True, blank=True)
+    # Taken by a worker that may have started the job in the DRM, until not_before
+    claimed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return str(self.task)
+
+    class Meta:
+        ordering = ['id']
+
+
+class TaskStatusTransition(models.Model):
+    """
+    History of the statuses of a task, one row for each status change, never updated
+    """
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='transitions')
+    status = models.CharField(max_length=200, choices=Task.Status.choices)
+    date = models.DateTimeField()
+
+    @classmethod
+    def record(cls, tasks):
+        cls.objects.bulk_create([cls(task=task, status=task.status, date=task.update_date or timezone.now())
+                                 for task in tasks])
+
+    def __str__(self):
+        return "{} {}: {}".format(self.task_id, self.date, self.status)
+
+    class Meta:
+        ordering = ['date', 'id']
+        indexes = [models.Index(fields=['task', 'status', 'date'], name='transition_task_status_idx')]
+
+
+class TaskResourceUsage(models.Model):
+    """
+    Resources used by the DRM job of a finished task, read once from the DRM accounting, see ResourceUsageCollection
+    """
+    task = models.OneToOneField(Task, on_delete=models.CASCADE, primary_key=True, related_name='resource_usage')
+    # CPU time of all the cpus of the job in seconds
+    cpu_time = models.FloatField(null=True, blank=True)
+    # Elapsed time of the job in seconds
+    wall_time = models.FloatField(null=True, blank=True)
+    # Maximum resident memory of the job in MB
+    max_rss = models.FloatField(null=True, blank=True)
+    exit_status = models.IntegerField(null=True, blank=True)
+    # Signal that terminated the job, empty if it exited by itself
+    signal = models.CharField(max_length=20, default="", blank=True)
+
+    def __str__(self):
+        return str(self.task_id)
+
+
+class ResourceUsageCollection(models.Model):
+    """
+    Queue of the finished tasks whose resource usage has not been read yet from the DRM accounting, the sweeps are not
+    accounted
+    """
+    task = models.OneToOneField(Task, on_delete=models.CASCADE, related_name='resource_usage_collection')
+    creation_date = models.DateTimeField(auto_now_add=True)
+    # Number of attempts that did not find the job in the accounting
+    attempts = models.PositiveIntegerField(default=0)
+    # The collection is not attempted before this time, used to retry later
+    not_before = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def enqueue(cls, tasks):
+        cls.objects.bulk_create([cls(task=task) for task in tasks
+                                 if task.status in (Task.Status.DONE.value, Task.Status.FAILED.value)
+                                 and not task.is_sweep and task.drm_job_id], ignore_conflicts=True)
+
+    @classmethod
+    def collect(cls, collections):
+        """
+        Store the usage of the queued tasks with a single read of the DRM accounting, returns the stored usages
+
+        The jobs that are not in the accounting yet are tried again later, waiting longer each time, and dropped after
+        RESOURCE_USAGE_MAX_ATTEMPTS attempts.
+        """
+        try:
+            accounting = get_jobs_accounting([collection.task.drm_job_id for collection in collections])
+        except Exception as e:
+            logger.warning("Cannot read the DRM accounting: {}".format(e))
+            accounting = {}
+
+        usages, retried, dropped = [], [], []
+        now = timezone.now()
+        for collection in collections:
+            usage = accounting.get(collection.task.drm_job_id)
+            if usage is not None:
+                usages.append(TaskResourceUsage(task_id=collection.task_id, **usage))
+                dropped.append(collection.id)
+                continue
+            collection.attempts += 1
+            if collection.attempts < RESOURCE_USAGE_MAX_ATTEMPTS:
+                collection.not_before = now + timedelta(minutes=2 ** collection.attempts)
+                retried.append(collection)
+            else:
+                logger.warning("Job {} not found in the DRM accounting, its resource usage is not collected"
+                               .format(collection.task.drm_job_id))
+                dropped.append(collection.id)
+
+        TaskResourceUsage.objects.bulk_create(usages, ignore_conflicts=True)
+        cls.objects.bulk_update(retried, ['attempts', 'not_before'])
+        cls.objects.filter(id__in=dropped).delete()
+        return usages
+
+    def __str__(self):
+        return str(self.task_id)
+
+    class Meta:
+        ordering = ['id']
+
+
+class WebhookDelivery(models.Model):
+    """
+    Outbox of the status changes waiting to be sent to the callback URL of their task by the webhook workers
+    """
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='webhook_deliveries')
+    url = models.URLField(max_length=500)
+    payload = models.JSONField(default=dict)
+    creation_date = models.DateTimeField(auto_now_add=True)
+    # Number of failed attempts to deliver the payload
+    attempts = models.PositiveIntegerField(default=0)
+    # The delivery is not taken by the workers before this time, used to retry failed attempts later
+    not_before = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def enqueue(cls, tasks):
+        """
+        Queue the current status of the tasks with a callback URL, their own or the one of the group of their user
+        """
+        group_urls = {}
+        users = {task.user_id for task in tasks if not task.callback_url and task.user_id is not None}
+        if users:
+            group_urls = dict(User.objects.filter(id__in=users, group__callback_url__isnull=False)
+                              .exclude(group__callback_url='').values_list('id', 'group__callback_url'))
+
+        deliveries = []
+        for task in tasks:
+            url = task.callback_url or group_urls.get(task.user_id)
+            if url:
+                deliveries.append(cls(task=task, url=url, payload={
+                        'uuid'       : str(task.uuid),
+                        'status'     : task.status,
+                        'update_date': task.update_date.isoformat() if task.update_date else None,
+                }))
+        cls.objects.bulk_create(deliveries)
+
+    def __str__(self):
+        return "{} -> {}".format(self.task_id, self.url)
+
+    class Meta:
+        ordering = ['id']
+
+
+class IdempotencyKey(models.Model):
+    """
+    Key sent by a client along with the creation of a task, the retries of the request with the same key return the
+    task created by the first one. The task is null while the first request is in progress.
+    """
+    # The user of the request, or the IP address for the anonymous users
+    scope = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    # Digest of the request, the same key cannot be used for a different request
+    request_hash = models.CharField(max_length=64)
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    creation_date = models.DateTimeField(auto_now_add=True)
+    expiry_date = models.DateTimeField()
+
+    def __str__(self):
+        return "{} {}".format(self.scope, self.key)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['scope', 'key'], name='idempotency_scope_key')]
+        indexes = [models.Index(fields=['expiry_date'], name='idempotency_expiry_idx')]
+
+
+class TaskArrayElement(models.Model):
+    """
+    Element of a parameter sweep, executed as the index of the DRM array job of its task
+    """
+    task = models.ForeignKey(Task, related_name='elements', on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    params = models.JSONField(default=dict)
+    _status = models.CharField(max_length=200, choices=Task.Status.choices, blank=False, null=False,
+                               default=Task.Status.RECEIVED)
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def drm_job_id(self):
+        # The indexes of an array job are identified as <array id>_<index>
+        return "{}_{}".format(self.task.drm_job_id, self.index)
+
+    @property
+    def stdout_file(self):
+        return "{}_out_{}.txt".format(str(self.task.uuid)[:8], self.index)
+
+    @property
+    def stderr_file(self):
+        return "{}_err_{}.txt".format(str(self.task.uuid)[:8], self.index)
+
+    def has_finished(self):
+        return self._status in {Task.Status.DONE.value, Task.Status.FAILED.value}
+
+    @classmethod
+    def update_drm_statuses(cls, sweeps):
+        """
+        Query the DRM for the unfinished elements of the given sweeps, by task id, and write the changed ones with a
+        single bulk update. Returns the elements of each sweep by task id, and the ids of the sweeps with changed elements.
+        """
+        if all('elements' in getattr(task, '_prefetched_objects_cache', {}) for task in sweeps.values()):
+            # The elements have been loaded along with the tasks
+            elements = [element for task in sweeps.values() for element in task.elements.all()]
+        else:
+            elements = list(cls.objects.filter(task__in=sweeps.keys()))
+
+        changed_elements = []
+        for element in elements:
+            element.task = sweeps[element.task_id]
+            if element.has_finished():
+                continue
+            try:
+                status = status_cache.get(element.drm_job_id)
+            except Exception as e:
+                logger.warning("Task {}, cannot get the status of DRM job {}: {}"
+                               .format(element.task.uuid, element.drm_job_id, e))
+                continue
+            if status != element._status:
+                element._status = status
+                changed_elements.append(element)
+
+        if changed_elements:
+            cls.objects.bulk_update(changed_elements, ['_status'])
+
+        elements_of_sweep = {}
+        for element in elements:
+            elements_of_sweep.setdefault(element.task_id, []).append(element)
+        return elements_of_sweep, {element.task_id for element in changed_elements}
+
+    def __str__(self):
+        return "{} [{}]".format(self.task, self.index)
+
+    class Meta:
+        ordering = ['index']
+        constraints = [models.UniqueConstraint(fields=["task", "index"], name="task_element_index")]
+
+
+# Shared by all the requests served by this process
+status_cache = JobStatusCache(get_job_status, ttl=DRM_STATUS_CACHE_TTL, terminal_ttl=DRM_STATUS_CACHE_TERMINAL_TTL,
+                              terminal_statuses={Task.Status.DONE.value, Task.Status.FAILED.value})
 
 
 class TaskFilterSet(FilterSet):
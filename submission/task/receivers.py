@@ -0,0 +1,19 @@
+from django.dispatch import receiver
+
+from submission.task.models import ResourceUsageCollection, TaskStatusTransition, WebhookDelivery
+from submission.task.signals import task_status_changed
+
+
+@receiver(task_status_changed)
+def record_transitions(sender, tasks, **kwargs):
+    TaskStatusTransition.record(tasks)
+
+
+@receiver(task_status_changed)
+def enqueue_webhooks(sender, tasks, **kwargs):
+    WebhookDelivery.enqueue(tasks)
+
+
+@receiver(task_status_changed)
+def enqueue_resource_usage(sender, tasks, **kwargs):
+    ResourceUsageCollection.enqueue(tasks)
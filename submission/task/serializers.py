@@ -1,19 +1,39 @@
 import logging
+import uuid
 
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
 from rest_framework import exceptions, serializers
 
-from server.settings import SUBMISSION_OUTPUT_DIR, SUBMISSION_SCRIPT_DIR
-from submission.drm_job_template.models import DRMJobTemplate
-from submission.parameter.models import Parameter
+from server.settings import ASYNC_SUBMISSION, MAX_BATCH_SIZE, MAX_SWEEP_SIZE, MAX_WORKFLOW_SIZE
+from submission.drm import session
+from submission.parameter.models import TaskParameter
 from submission.parameter.serializers import TaskParameterSerializer
 from submission.script.models import Script
-from submission.task.models import Task
-from submission.utils import create_task_folder, format_task_params, get_ip, get_params
-from submission_lib.manage import start_job
+from submission.script.plan import get_plan
+from submission.task.models import Task, TaskResourceUsage, TaskSubmission
+from submission.task.submit import start_task
+from submission.task.sweep import create_sweep
+from submission.task.webhooks import check_url
+from submission.utils import create_task_folder, get_ip, get_params
 
 logger = logging.getLogger(__name__)
 
 
+def validate_callback_url(url):
+    if url:
+        try:
+            URLValidator(schemes=['http', 'https'])(url)
+        except DjangoValidationError:
+            raise exceptions.NotAcceptable("The callback_url is not a valid URL")
+        try:
+            check_url(url)
+        except ValueError as e:
+            raise exceptions.NotAcceptable("The callback_url cannot be used: {}".format(e))
+
+
 class TaskParentField(serializers.RelatedField):
     """
     Serializer for the nested relationship of a task with another task through the task UUID
@@ -48,32 +68,63 @@ class TaskSerializer(serializers.ModelSerializer):
 
     task_description = serializers.CharField(required=False, allow_blank=True)
 
+    # Parameter sweep, passed as a JSON list of parameter sets, one for each element of the array job
+    sweep = serializers.JSONField(required=False, write_only=True)
+    elements = serializers.SerializerMethodField(read_only=True)
+
     class Meta:
         model = Task
         fields = ["uuid", "task_name", "descendants", "dependencies", "depends_on", "dependency_type",
                   "task_description",
                   "parent_task", "creation_date", "status",
-                  "files_name", "params"]
+                  "files_name", "params", "sweep", "elements", "callback_url"]
 
     def get_descendants(self, task):
         """
-        Get all the descendants of a task
+        Get all the descendants of a task, from the context if they have been loaded for the whole page
         """
-        descendants = []
-        for child in Task.objects.filter(parent_task=task):
-            descendants.append(child.uuid)
-            next_descendants = self.get_descendants(child)
-            if next_descendants:
-                descendants.extend(next_descendants)
+        descendants = self.context.get('descendants')
+        if descendants is None or task.id not in descendants:
+            descendants = Task.get_descendants_of([task])
 
-        return descendants if descendants else None
+        return descendants[task.id] or None
+
+    def get_elements(self, task):
+        """
+        Get the status and output files of each element of a parameter sweep
+        """
+        if not task.is_sweep:
+            return None
+        return [{'index' : element.index,
+                 'status': element.status,
+                 'params': element.params,
+                 'stdout': element.stdout_file,
+                 'stderr': element.stderr_file} for element in task.elements.all()]
+
+    def validate_sweep(self, sweep):
+        if not isinstance(sweep, list) or len(sweep) == 0:
+            raise serializers.ValidationError("The sweep has to be a non empty list of parameter sets")
+        if len(sweep) > MAX_SWEEP_SIZE:
+            raise serializers.ValidationError("The sweep can have at most {} elements".format(MAX_SWEEP_SIZE))
+        return sweep
+
+    def get_fields(self):
+        """
+        Only the fields requested through the context, all of them if it does not specify any
+        """
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        if requested is not None:
+            fields = {name: field for name, field in fields.items() if name in requested}
+        return fields
 
     def to_representation(self, instance):
         """
         Modify the task representation removing k:v pairs with v=None and null items in the param list
         """
         data = super().to_representation(instance)
-        data["params"] = [p for p in data["params"] if p is not None]
+        if "params" in data:
+            data["params"] = [p for p in data["params"] if p is not None]
         return {k: v for k, v in data.items() if v is not None}
 
     def create(self, validated_data):
@@ -87,91 +138,140 @@ class TaskSerializer(serializers.ModelSerializer):
         The task can be associated to a user if a user is passed.
 
         A task can have a parent if necessary, in this case the working directory of the new task is the same as the parent task.
+
+        With ASYNC_SUBMISSION the task is returned as RECEIVED and queued, it is sent to the DRM by the submission workers.
         """
 
         # Check if user passed the params keyword
         if "task_name" not in validated_data.keys():
             raise exceptions.NotAcceptable("The task_name parameter needs to be specified")
 
-        script = Script.objects.get(name=validated_data["task_name"])
-
         # Check if script has a group, then user must satisfy the group hierarchy
-        if script.groups.count() > 0:
-            user = validated_data.get("user")
-            if not user or (user and not user.is_admin() and not script.groups.filter(name=user.group_name()).exists()):
-                raise exceptions.NotFound(detail="Script not found")
+        if not Script.objects.visible_to(validated_data.get("user")).filter(pk=validated_data["task_name"].pk).exists():
+            raise exceptions.NotFound(detail="Script not found")
 
         parent_task = None
         if "parent_task" in validated_data.keys():
             parent_task = validated_data["parent_task"]
 
-        # Create the task with the name
-        task = Task.objects.create(task_name=validated_data["task_name"], user=validated_data.get("user"),
-                                   parent_task=parent_task)
+        # The dependencies are checked before anything is created
+        dependencies, dependency_type = [], None
+        if "dependencies" in validated_data.keys():
+            dependency_type = validated_data.get("dependency_type", Task.DependencyTypes.AFTER_ANY)
+            if dependency_type not in Task.DependencyTypes.values:
+                raise exceptions.NotAcceptable("The dependency_type parameter is not valid")
+            dependencies = self.get_dependencies(validated_data["dependencies"], validated_data.get("user"),
+                                                 dependency_type)
+
+        # Create the task with the name, description and sender address with a single insert
+        task = Task(task_name=validated_data["task_name"], user=validated_data.get("user"), parent_task=parent_task,
+                    root_task_id=parent_task.get_root_id() if parent_task else None,
+                    _task_description=validated_data.get("task_description"),
+                    _sender_ip_addr=get_ip(self.context.get('request')),
+                    callback_url=validated_data.get("callback_url"), dependency_type=dependency_type)
+        task.save()
 
-        if "task_description" in validated_data.keys():
-            task.task_description = validated_data["task_description"]
+        # The fields set from now on are written with a single update at the end of the block
+        with task.deferred_save():
+            task_params, plan = self.prepare(task, validated_data, dependencies)
+            if not ASYNC_SUBMISSION:
+                self.start(task, task_params, plan)
 
-        task.sender_ip_addr = get_ip(self.context.get('request'))
+        if ASYNC_SUBMISSION:
+            # The task stays RECEIVED until one of the submission workers sends it to the DRM
+            TaskSubmission.objects.create(task=task)
 
-        if task.parent_task is None:
-            create_task_folder(str(task.uuid))
+        return task
 
-        parameters_of_task = Parameter.objects.filter(script=task.task_name)
+    def get_dependencies(self, value, user, dependency_type):
+        """
+        The tasks with the UUIDs separated by commas, loaded with a single query
 
+        They must be visible to the user and already sent to the DRM, or waiting in the submission queue with
+        ASYNC_SUBMISSION, and it must still be possible for them to end in the way required by the dependency type.
+        """
         try:
-            task_params, renamed_files = get_params(self.initial_data, task, parameters_of_task)
-        except (exceptions.NotAcceptable, Exception) as e:
-            task.delete_from_file_system()
-            raise e
-
-        # task.files_name = renamed_files
+            uuids = {uuid.UUID(dep.strip()) for dep in value.split(",") if dep.strip()}
+        except ValueError:
+            raise exceptions.NotAcceptable("The dependencies must be task UUIDs separated by commas")
+
+        dependencies = Task.objects.filter(uuid__in=uuids, deleted=False) \
+            .only('id', 'uuid', 'user', '_status', '_drm_job_id') \
+            .annotate(queued=Exists(TaskSubmission.objects.filter(task=OuterRef('pk'))))
+        if user is None or not user.is_admin():
+            visible = Q(user__isnull=True)
+            if user is not None:
+                visible |= Q(user=user)
+            dependencies = dependencies.filter(visible)
+        dependencies = list(dependencies)
+
+        missing = uuids - {dep.uuid for dep in dependencies}
+        if missing:
+            raise exceptions.NotFound("The dependencies {} do not exist".format(", ".join(sorted(map(str, missing)))))
+
+        for dep in dependencies:
+            # The submission workers send the queued tasks to the DRM after their dependencies
+            if dep.drm_job_id is None and not (ASYNC_SUBMISSION and dep.queued):
+                raise exceptions.NotAcceptable("The dependency {} has not been sent to the DRM".format(dep.uuid))
+            if dependency_type == Task.DependencyTypes.AFTER_OK and dep.status == Task.Status.FAILED.value:
+                raise exceptions.NotAcceptable("The dependency {} has already failed".format(dep.uuid))
+            if dependency_type == Task.DependencyTypes.AFTER_NOT_OK and dep.status == Task.Status.DONE.value:
+                raise exceptions.NotAcceptable("The dependency {} has already finished normally".format(dep.uuid))
+
+        return dependencies
+
+    def prepare(self, task, validated_data, dependencies=()):
+        """
+        Creates the working directory, the parameters and the dependencies of the task, returns the parameters and the
+        submission plan of the script
+        """
+        if task.parent_task is None:
+            create_task_folder(str(task.uuid))
 
-        formatted_params = format_task_params(task_params)
+        # The values of the task are validated in memory against the plan
+        plan = get_plan(task.task_name_id, script=task.task_name)
 
-        drm_params = DRMJobTemplate.objects.get(name=task.task_name.job).__dict__
+        if "sweep" in validated_data.keys():
+            task_params = self.prepare_sweep(task, validated_data["sweep"], plan)
+        else:
+            try:
+                task_params, renamed_files = get_params(self.initial_data, task, plan)
+            except (exceptions.NotAcceptable, Exception) as e:
+                task.delete_from_file_system()
+                raise e
 
-        p_task = task.get_first_ancestor()
+        # The dependencies are already checked, they are written with a single insert
+        Task.dependencies.through.objects.bulk_create(
+                [Task.dependencies.through(from_task_id=task.id, to_task_id=dep.id) for dep in dependencies])
 
-        # Take the first 8 characters of the task uuid to use as outfile names
-        out_file = "{}_out.txt".format(str(task.uuid)[:8])
-        err_file = "{}_err.txt".format(str(task.uuid)[:8])
+        return task_params, plan
 
-        # Get all the dependencies of the task and the type of dependency
-        if "dependencies" in validated_data.keys():
-            task.dependencies.set([Task.objects.get(uuid=dep) for dep in validated_data["dependencies"].split(",")])
+    def prepare_sweep(self, task, sweep, plan):
+        """
+        Creates the elements of a parameter sweep, the values passed outside the sweep are used for all the elements
+        """
+        if task.task_name.is_array:
+            task.delete_from_file_system()
+            task.delete()
+            raise exceptions.NotAcceptable("The script is already an array job, it cannot be used in a sweep")
 
-            if "dependency_type" in validated_data.keys():
-                dependency_type = validated_data["dependency_type"]
-                if dependency_type in Task.DependencyTypes.values:
-                    task.dependency_type = dependency_type
-                else:
-                    raise exceptions.NotAcceptable("The dependency_type parameter is not valid")
-            else:
-                task.dependency_type = Task.DependencyTypes.AFTER_ANY
+        common_params = {name: value for name, value in self.initial_data.items() if isinstance(value, str)}
+        try:
+            create_sweep(task, sweep, common_params, plan)
+        except Exception as e:
+            task.delete_from_file_system()
+            task.delete()
+            raise e
 
-        dependencies = [t.drm_job_id for t in task.dependencies.all()] if task.dependencies.exists() else None
-        dependency_type = task.dependency_type if dependencies else None
+        # The parameters are in the elements of the sweep, the array job has none
+        return []
 
+    def start(self, task, task_params, plan):
+        """
+        Sends the task to the DRM inside the request
+        """
         try:
-            j_id, name = start_job(**drm_params,
-                                   task_name=task.task_name.name,
-                                   # if the command is defined as absolute then do not add the submission script dir first
-                                   script_dir='' if task.task_name.command[0] == '/' else SUBMISSION_SCRIPT_DIR,
-                                   out_dir=SUBMISSION_OUTPUT_DIR,
-                                   command=task.task_name.command,
-                                   script_args=formatted_params,
-                                   working_dir=p_task.uuid,
-                                   dependencies=dependencies,
-                                   dependency_type=dependency_type,
-                                   clock_time_limit=bytes(task.task_name.max_clock_time, encoding='utf8'),
-                                   is_array=task.task_name.is_array,
-                                   begin_index=task.task_name.begin_index,
-                                   end_index=task.task_name.end_index,
-                                   step_index=task.task_name.step_index,
-                                   account=task.user.group_name() if task.user else None,
-                                   stdout_file=out_file,
-                                   stderr_file=err_file)
+            start_task(task, task_params, request=self.context.get('request'), plan=plan)
         except Exception as e:
             task.delete_from_file_system()
             logger.warning(
@@ -179,22 +279,11 @@ class TaskSerializer(serializers.ModelSerializer):
                 extra={'request': self.context.get('request')})
             raise exceptions.APIException(detail='An error occurred while starting the task')
 
-        if j_id is None:
-            # If the start of the job had some problem then j_id is none, set the status of the task as rejected
-            task.status = Task.Status.REJECTED.value
-            logger.warning("Task {}, {}, was rejected".format(task.uuid, task.task_name.name),
-                           extra={'request': self.context.get('request')})
 
-        else:
-            # Otherwise, we associate the job id of the DRM and set the status to CREATED
-            task.drm_job_id = j_id
-            task.status = Task.Status.CREATED.value
-            logger.info("Task {} ({}) was created, DRM {}".format(task.uuid, task.task_name.name, j_id),
-                        extra={'request': self.context.get('request')})
-
-        task.save()
-
-        return task
+class TaskResourceUsageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TaskResourceUsage
+        fields = ["cpu_time", "wall_time", "max_rss", "exit_status", "signal"]
 
 
 class SuperTaskSerializer(TaskSerializer):
@@ -203,6 +292,7 @@ class SuperTaskSerializer(TaskSerializer):
     """
     drm_job_id = serializers.CharField(read_only=True)
     user = serializers.CharField(source="user.username", read_only=True)
+    resource_usage = TaskResourceUsageSerializer(read_only=True)
 
     class Meta:
         model = Task
@@ -210,4 +300,303 @@ class SuperTaskSerializer(TaskSerializer):
                   "depends_on",
                   "dependency_type",
                   "sender_ip_addr", "status", "deleted",
-                  "drm_job_id", "files_name", "user", "creation_date", "update_date", "params"]
+                  "drm_job_id", "files_name", "user", "creation_date", "update_date", "params", "sweep", "elements",
+                  "callback_url", "resource_usage"]
+
+
+class TaskBatchSerializer(serializers.Serializer):
+    """
+    Creates many tasks with a single request
+
+    Every task is passed as an object with the task_name, the params and optionally the task_description and the
+    parent_task. The tasks are validated together, the valid ones are inserted in bulk and sent to the DRM through
+    a single session. The result of each task is returned in the same order, with the error if it was not created.
+    """
+    tasks = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=MAX_BATCH_SIZE)
+
+    def create(self, validated_data):
+        request = self.context.get('request')
+        user = validated_data.get('user')
+        items = validated_data['tasks']
+
+        # Load all the scripts with their parameters and groups, and the parent tasks at once
+        scripts = {script.name: script for script in Script.objects
+                   .filter(name__in={str(item.get('task_name')) for item in items})
+                   .select_related('job').prefetch_related('groups', 'param')}
+        parents = {str(task.uuid): task for task in Task.objects.filter(
+                uuid__in=[item['parent_task'] for item in items if self.is_uuid(item.get('parent_task'))])}
+
+        results = [None] * len(items)
+        created = []
+        # Submission plan of each script, compiled once from the scripts already loaded
+        plans = {}
+        sender_ip_addr = get_ip(request)
+        for i, item in enumerate(items):
+            try:
+                script = scripts.get(str(item.get('task_name')))
+                if script is None or not script.is_visible_to(user):
+                    raise exceptions.NotFound(detail="Script not found")
+
+                parent_task = None
+                if item.get('parent_task'):
+                    parent_task = parents.get(str(item['parent_task']))
+                    if parent_task is None:
+                        raise exceptions.NotAcceptable("Specified parent task does not exists")
+
+                validate_callback_url(item.get('callback_url'))
+
+                if not isinstance(item.get('params', {}), dict):
+                    raise exceptions.NotAcceptable("The params have to be an object")
+                if script.name not in plans:
+                    plans[script.name] = get_plan(script.name, script=script)
+                task_params = plans[script.name].build_params(item.get('params', {}))
+            except exceptions.APIException as e:
+                results[i] = {'index': i, 'error': e.detail}
+                continue
+
+            task = Task(task_name=script, user=user, parent_task=parent_task,
+                        root_task_id=parent_task.get_root_id() if parent_task else None,
+                        _task_description=item.get('task_description'), _sender_ip_addr=sender_ip_addr,
+                        callback_url=item.get('callback_url'))
+            created.append((i, task, task_params))
+
+        if not created:
+            return results
+
+        tasks = [task for _, task, _ in created]
+        with transaction.atomic():
+            Task.objects.bulk_create(tasks)
+            # MySQL does not return the primary keys of the inserted rows, get them back through the uuids
+            ids = dict(Task.objects.filter(uuid__in=[task.uuid for task in tasks]).values_list('uuid', 'id'))
+            for _, task, task_params in created:
+                task.id = ids[task.uuid]
+                for task_param in task_params:
+                    task_param.task = task
+            TaskParameter.objects.bulk_create([p for _, _, task_params in created for p in task_params])
+
+            if ASYNC_SUBMISSION:
+                TaskSubmission.objects.bulk_create([TaskSubmission(task=task) for task in tasks])
+
+        for task in tasks:
+            if task.parent_task is None:
+                create_task_folder(str(task.uuid))
+
+        if not ASYNC_SUBMISSION:
+            self.start(created, results, plans)
+
+        for i, task, _ in created:
+            results[i] = {**(results[i] or {}), 'index': i, 'uuid': task.uuid, 'status': task.status}
+
+        return results
+
+    def start(self, created, results, plans):
+        """
+        Sends the tasks to the DRM through a single session, the status of all of them is written with one update
+        """
+        request = self.context.get('request')
+        tasks = [task for _, task, _ in created]
+        try:
+            with session(), Task.deferred_save_all(tasks):
+                for i, task, task_params in created:
+                    try:
+                        start_task(task, task_params, request=request, plan=plans[task.task_name_id])
+                    except Exception as e:
+                        task.status = Task.Status.REJECTED.value
+                        task.delete_from_file_system()
+                        results[i] = {'error': 'An error occurred while starting the task'}
+                        logger.warning("Task {}, {}, something went wrong starting this job: {}"
+                                       .format(task.uuid, task.task_name.name, e), extra={'request': request})
+        except Exception as e:
+            logger.warning("Something went wrong opening the DRM session: {}".format(e), extra={'request': request})
+            # Nothing has been written, the tasks that have not been sent to the DRM must not stay RECEIVED
+            with Task.deferred_save_all(tasks):
+                for task in tasks:
+                    if task.drm_job_id is None:
+                        task.status = Task.Status.REJECTED.value
+                        task.delete_from_file_system()
+                    else:
+                        task.save_fields('_status', '_drm_job_id')
+            raise exceptions.APIException(detail='An error occurred while starting the tasks')
+
+    @staticmethod
+    def is_uuid(value):
+        try:
+            uuid.UUID(str(value))
+            return True
+        except ValueError:
+            return False
+
+
+class TaskWorkflowSerializer(serializers.Serializer):
+    """
+    Creates the tasks of a whole workflow with a single request
+
+    The workflow is a DAG of nodes, every node is passed as an object with a local id, the task_name, the params and
+    optionally the task_description, the callback_url, the ids of the nodes it depends on and the dependency_type.
+    All the tasks share the working directory of the parent_task if given, otherwise of the first task. The workflow
+    is created only if all the nodes are valid, the tasks and their dependencies are inserted in a single transaction
+    and sent to the DRM in topological order through a single session, each with the DRM jobs of its dependencies.
+    """
+    nodes = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=MAX_WORKFLOW_SIZE)
+    parent_task = TaskParentField(queryset=Task.objects.all(), required=False, allow_null=True)
+
+    def validate_nodes(self, nodes):
+        ids = set()
+        for node in nodes:
+            if not isinstance(node.get('id'), str) or not node['id']:
+                raise serializers.ValidationError("Every node must have a string id")
+            if node['id'] in ids:
+                raise serializers.ValidationError("The node id {} is not unique".format(node['id']))
+            ids.add(node['id'])
+
+        for node in nodes:
+            depends_on = node.get('depends_on', [])
+            if not isinstance(depends_on, list) or not all(isinstance(dep, str) for dep in depends_on):
+                raise serializers.ValidationError(
+                        "The depends_on of node {} has to be a list of node ids".format(node['id']))
+            unknown = set(depends_on) - ids
+            if unknown:
+                raise serializers.ValidationError("Node {} depends on the unknown nodes {}".format(
+                        node['id'], ", ".join(sorted(unknown))))
+            if node.get('dependency_type', Task.DependencyTypes.AFTER_ANY) not in Task.DependencyTypes.values:
+                raise serializers.ValidationError("The dependency_type of node {} is not valid".format(node['id']))
+
+        self.get_order(nodes)
+        return nodes
+
+    @staticmethod
+    def get_order(nodes):
+        """
+        Ids of the nodes in topological order, each node comes after all the nodes it depends on
+        """
+        remaining = {node['id']: set(node.get('depends_on', [])) for node in nodes}
+        dependents = {node_id: [] for node_id in remaining}
+        for node_id, depends_on in remaining.items():
+            for dep in depends_on:
+                dependents[dep].append(node_id)
+
+        # Kahn's algorithm, keeping the order of the request among the nodes that are ready at the same time
+        ready = [node['id'] for node in nodes if not remaining[node['id']]]
+        order = []
+        while ready:
+            node_id = ready.pop(0)
+            order.append(node_id)
+            for dependent in dependents[node_id]:
+                remaining[dependent].discard(node_id)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+
+        if len(order) < len(nodes):
+            cycle = sorted(node_id for node_id, depends_on in remaining.items() if depends_on)
+            raise serializers.ValidationError("The workflow has a cycle among the nodes {}".format(", ".join(cycle)))
+        return order
+
+    def create(self, validated_data):
+        request = self.context.get('request')
+        user = validated_data.get('user')
+        nodes = {node['id']: node for node in validated_data['nodes']}
+        order = self.get_order(validated_data['nodes'])
+        parent_task = validated_data.get('parent_task')
+
+        # Load all the scripts with their parameters and groups at once
+        scripts = {script.name: script for script in Script.objects
+                   .filter(name__in={str(node.get('task_name')) for node in nodes.values()})
+                   .select_related('job').prefetch_related('groups', 'param')}
+
+        tasks = {}
+        # Submission plan of each script, compiled once from the scripts already loaded
+        plans = {}
+        sender_ip_addr = get_ip(request)
+        for node_id in order:
+            node = nodes[node_id]
+            try:
+                script = scripts.get(str(node.get('task_name')))
+                if script is None or not script.is_visible_to(user):
+                    raise exceptions.NotFound(detail="Script not found")
+                validate_callback_url(node.get('callback_url'))
+                if not isinstance(node.get('params', {}), dict):
+                    raise exceptions.NotAcceptable("The params have to be an object")
+                if script.name not in plans:
+                    plans[script.name] = get_plan(script.name, script=script)
+                task_params = plans[script.name].build_params(node.get('params', {}))
+            except exceptions.APIException as e:
+                detail = e.detail if isinstance(e.detail, str) else " ".join(str(d) for d in e.detail)
+                raise e.__class__("Node {}: {}".format(node_id, detail))
+
+            depends_on = node.get('depends_on', [])
+            task = Task(task_name=script, user=user, _task_description=node.get('task_description'),
+                        _sender_ip_addr=sender_ip_addr, callback_url=node.get('callback_url'),
+                        dependency_type=node.get('dependency_type', Task.DependencyTypes.AFTER_ANY)
+                        if depends_on else None)
+            tasks[node_id] = (task, task_params)
+
+        with transaction.atomic():
+            if parent_task is None:
+                # The first task is the parent of the others, they all run in its working directory
+                parent_task = tasks[order[0]][0]
+                parent_task.save()
+            others = [task for task, _ in tasks.values() if task is not parent_task]
+            for task in others:
+                task.parent_task = parent_task
+                task.root_task_id = parent_task.get_root_id()
+            Task.objects.bulk_create(others)
+            # MySQL does not return the primary keys of the inserted rows, get them back through the uuids
+            ids = dict(Task.objects.filter(uuid__in=[task.uuid for task in others]).values_list('uuid', 'id'))
+            for task in others:
+                task.id = ids[task.uuid]
+
+            task_params = []
+            for task, params in tasks.values():
+                for task_param in params:
+                    task_param.task = task
+                task_params.extend(params)
+            TaskParameter.objects.bulk_create(task_params)
+            Task.dependencies.through.objects.bulk_create([
+                    Task.dependencies.through(from_task_id=tasks[node_id][0].id, to_task_id=tasks[dep][0].id)
+                    for node_id in order for dep in nodes[node_id].get('depends_on', [])])
+
+            if ASYNC_SUBMISSION:
+                # Queued in topological order, the workers wait for the dependencies to be sent to the DRM
+                TaskSubmission.objects.bulk_create([TaskSubmission(task=tasks[node_id][0]) for node_id in order])
+
+        if parent_task.parent_task is None:
+            create_task_folder(str(parent_task.uuid))
+
+        if not ASYNC_SUBMISSION:
+            self.start(order, nodes, tasks, plans)
+
+        return {'tasks': {node_id: {'uuid': tasks[node_id][0].uuid, 'status': tasks[node_id][0].status}
+                          for node_id in order}}
+
+    def start(self, order, nodes, tasks, plans):
+        """
+        Sends the tasks to the DRM in topological order through a single session, with the job ids of their
+        dependencies. The tasks depending on a task that could not be started are rejected.
+        """
+        request = self.context.get('request')
+        job_ids = {}
+        all_tasks = [task for task, _ in tasks.values()]
+        try:
+            with session(), Task.deferred_save_all(all_tasks):
+                for node_id in order:
+                    task, task_params = tasks[node_id]
+                    dependencies = [job_ids.get(dep) for dep in nodes[node_id].get('depends_on', [])]
+                    try:
+                        job_ids[node_id] = start_task(task, task_params, request=request, dependencies=dependencies,
+                                                      plan=plans[task.task_name_id])
+                    except Exception as e:
+                        task.status = Task.Status.REJECTED.value
+                        job_ids[node_id] = None
+                        logger.warning("Task {}, {}, something went wrong starting this job: {}"
+                                       .format(task.uuid, task.task_name.name, e), extra={'request': request})
+        except Exception as e:
+            logger.warning("Something went wrong opening the DRM session: {}".format(e), extra={'request': request})
+            # Nothing has been written, the tasks that have not been sent to the DRM must not stay RECEIVED
+            with Task.deferred_save_all(all_tasks):
+                for task in all_tasks:
+                    if task.drm_job_id is None:
+                        task.status = Task.Status.REJECTED.value
+                        task.delete_from_file_system()
+                    else:
+                        task.save_fields('_status', '_drm_job_id')
+            raise exceptions.APIException(detail='An error occurred while starting the tasks')
@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent with the list of tasks whose status has been written, once for each write of one or many tasks
+task_status_changed = Signal()
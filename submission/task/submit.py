@@ -0,0 +1,81 @@
+import logging
+
+from server.settings import SUBMISSION_OUTPUT_DIR
+from submission.drm import start_job
+from submission.drm_job_template.models import DRMJobTemplate
+from submission.parameter.models import TaskParameter
+from submission.script.plan import get_plan
+from submission.task.models import Task
+from submission.task.sweep import get_sweep_job_args
+
+logger = logging.getLogger(__name__)
+
+
+def start_task(task: Task, task_params=None, request=None, dependencies=None, plan=None):
+    """
+    Sends a task, whose parameters and dependencies are already stored, to the DRM
+
+    The DRM returns an ID that is associated to the task in order to check the status on the DRM, and the task is set
+    as CREATED. If the DRM does not return an ID the task is set as REJECTED. Exceptions raised while starting the job
+    are propagated to the caller.
+
+    The DRM job ids of the dependencies can be passed when they are not stored yet. A task whose dependencies have no
+    DRM job is rejected. The submission plan of the script can be passed when the caller already has it.
+    """
+    if task_params is None:
+        task_params = TaskParameter.objects.filter(task=task).only('param_id', 'value')
+
+    if plan is None:
+        plan = get_plan(task.task_name_id, [task_param.param_id for task_param in task_params],
+                        script=task.task_name if Task.task_name.is_cached(task) else None)
+    if plan.drm_params is None:
+        raise DRMJobTemplate.DoesNotExist("The script {} has no job template".format(plan.script_name))
+
+    p_task = task.get_first_ancestor()
+
+    # Take the first 8 characters of the task uuid to use as outfile names
+    out_file = "{}_out.txt".format(str(task.uuid)[:8])
+    err_file = "{}_err.txt".format(str(task.uuid)[:8])
+
+    if dependencies is None:
+        dependencies = list(task.dependencies.values_list('_drm_job_id', flat=True))
+    if None in dependencies:
+        task.status = Task.Status.REJECTED.value
+        logger.warning("Task {}, {}, was rejected, some of its dependencies were not sent to the DRM"
+                       .format(task.uuid, plan.script_name), extra={'request': request} if request else {})
+        return None
+    dependencies = dependencies or None
+    dependency_type = task.dependency_type if dependencies else None
+
+    job_args = dict(plan.get_job_args(),
+                    out_dir=SUBMISSION_OUTPUT_DIR,
+                    script_args=plan.format_args(task_params),
+                    working_dir=p_task.uuid,
+                    dependencies=dependencies,
+                    dependency_type=dependency_type,
+                    account=task.user.group_name() if task.user else None,
+                    stdout_file=out_file,
+                    stderr_file=err_file)
+
+    if task.is_sweep:
+        # The elements of the sweep are the indexes of a single array job
+        job_args.update(get_sweep_job_args(task))
+
+    j_id, name = start_job(**plan.drm_params, **job_args)
+
+    if j_id is None:
+        # If the start of the job had some problem then j_id is none, set the status of the task as rejected
+        task.status = Task.Status.REJECTED.value
+        logger.warning("Task {}, {}, was rejected".format(task.uuid, plan.script_name),
+                       extra={'request': request} if request else {})
+
+    else:
+        # Otherwise, we associate the job id of the DRM and set the status to CREATED
+        task.drm_job_id = j_id
+        task.status = Task.Status.CREATED.value
+        if task.is_sweep:
+            task.elements.update(_status=Task.Status.CREATED.value)
+        logger.info("Task {} ({}) was created, DRM {}".format(task.uuid, plan.script_name, j_id),
+                    extra={'request': request} if request else {})
+
+    return j_id
@@ -0,0 +1,80 @@
+import json
+import os
+import shlex
+
+from rest_framework import exceptions
+
+from server.settings import SUBMISSION_OUTPUT_DIR
+from submission.drm import PARAMETRIC_INDEX
+from submission.task.models import Task, TaskArrayElement
+
+
+def get_sweep_dir(task: Task):
+    """
+    Directory, relative to the working directory, with the manifest and the arguments of each element of the sweep
+    """
+    return "{}_sweep".format(str(task.uuid)[:8])
+
+
+def create_sweep(task: Task, parameter_sets, common_params, plan):
+    """
+    Creates the elements of a parameter sweep and writes its manifest into the working directory
+
+    Each parameter set is validated together with the common parameters, that are used for all the elements. The
+    arguments of the element with index i are written to <sweep dir>/<i>.args, separated by NUL characters, and read
+    by the wrapper script that is submitted as array job.
+    """
+    if not isinstance(parameter_sets, list) or not all(isinstance(p, dict) for p in parameter_sets):
+        raise exceptions.NotAcceptable("The sweep has to be a list of objects with the parameters of each element")
+
+    elements, args = [], []
+    for index, parameter_set in enumerate(parameter_sets, start=1):
+        try:
+            task_params = plan.build_params({**common_params, **parameter_set})
+        except exceptions.APIException as e:
+            detail = e.detail if isinstance(e.detail, str) else " ".join(str(d) for d in e.detail)
+            raise exceptions.NotAcceptable("Element {} of the sweep: {}".format(index, detail))
+        elements.append(TaskArrayElement(task=task, index=index, params=parameter_set))
+        args.append(plan.format_args(task_params))
+
+    sweep_dir = os.path.join(SUBMISSION_OUTPUT_DIR, str(task.get_first_ancestor().uuid), get_sweep_dir(task))
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    for element, element_args in zip(elements, args):
+        with open(os.path.join(sweep_dir, "{}.args".format(element.index)), "w") as f:
+            f.write("".join("{}\0".format(arg) for arg in element_args))
+
+    with open(os.path.join(sweep_dir, "manifest.json"), "w") as f:
+        json.dump({element.index: element.params for element in elements}, f)
+
+    # The script is given the arguments of the index of the array that is running
+    command = os.path.join(plan.script_dir, plan.command)
+    wrapper = os.path.join(sweep_dir, "run.sh")
+    with open(wrapper, "w") as f:
+        f.write("#!/bin/bash\n"
+                "mapfile -d '' ARGS < {}/\"${{SLURM_ARRAY_TASK_ID}}.args\"\n"
+                "exec {} \"${{ARGS[@]}}\"\n".format(shlex.quote(get_sweep_dir(task)), shlex.quote(command)))
+    os.chmod(wrapper, 0o755)
+
+    TaskArrayElement.objects.bulk_create(elements)
+    task.is_sweep = True
+    task.save_fields('is_sweep')
+
+    return elements
+
+
+def get_sweep_job_args(task: Task):
+    """
+    Arguments of start_job to submit the sweep as a single array job with one index for each element
+    """
+    return {
+            'command'    : os.path.join(get_sweep_dir(task), "run.sh"),
+            'script_dir' : os.path.join(SUBMISSION_OUTPUT_DIR, str(task.get_first_ancestor().uuid)),
+            'script_args': [],
+            'is_array'   : True,
+            'begin_index': 1,
+            'end_index'  : task.elements.count(),
+            'step_index' : 1,
+            'stdout_file': "{}_out_{}.txt".format(str(task.uuid)[:8], PARAMETRIC_INDEX),
+            'stderr_file': "{}_err_{}.txt".format(str(task.uuid)[:8], PARAMETRIC_INDEX),
+    }
@@ -1,22 +1,32 @@
 import mimetypes
 import os
+import uuid
+from datetime import timedelta
 
+from django.db.models import Prefetch, Q
 from django.http import FileResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import exceptions, filters, status, viewsets
 from rest_framework.decorators import action, throttle_classes
-from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 
-from server.settings import SUBMISSION_OUTPUT_DIR
+from server.settings import ASYNC_SUBMISSION, MAX_PAGE_SIZE, MAX_STATUS_IDS, SUBMISSION_OUTPUT_DIR
 from submission.authentication import BearerAuthentication
+from submission.drm import session_manager, terminate_job
+from submission.pagination import TaskCursorPagination
+from submission.parameter.models import TaskParameter
 from submission.permissions import IsOutputAccessible, IsOwner, IsSuper
-from submission.task.models import Task, TaskFilterSet
-from submission.task.serializers import SuperTaskSerializer, TaskSerializer
+from submission.task.idempotency import claim_key, get_request_hash, release_key, store_task
+from submission.task.models import IdempotencyKey, Task, TaskFilterSet, status_cache
+from submission.task.serializers import SuperTaskSerializer, TaskBatchSerializer, TaskSerializer, \
+    TaskWorkflowSerializer
 from submission.throttles import *
 from submission.utils import request_by_admin
-from submission_lib.manage import terminate_job
 
 
 class TaskViewSet(viewsets.ModelViewSet):
@@ -35,6 +45,78 @@ class TaskViewSet(viewsets.ModelViewSet):
     paginate_by = 5
     max_page_size = 10
 
+    # Overlap between consecutive requests of changed tasks
+    changes_overlap = timedelta(seconds=5)
+
+    @property
+    def pagination_class(self):
+        # The cursor pagination is requested with ?pagination=cursor, its links keep the parameter
+        if self.request is not None and self.request.query_params.get('pagination') == 'cursor':
+            return TaskCursorPagination
+        return api_settings.DEFAULT_PAGINATION_CLASS
+
+    def get_queryset(self):
+        """
+        Load along with the tasks everything the serializer reads, so that the number of queries does not depend on the
+        number of serialized tasks. The fields that are not requested are not loaded.
+        """
+        queryset = super().get_queryset()
+        if self.action in ("list", "retrieve"):
+            # The user is always needed to check the permissions
+            queryset = queryset.select_related('user')
+            if self.is_field_requested('task_name'):
+                queryset = queryset.select_related('task_name')
+            if self.is_field_requested('parent_task'):
+                queryset = queryset.select_related('parent_task')
+            if self.is_field_requested('params'):
+                queryset = queryset.prefetch_related(
+                        Prefetch('params', queryset=TaskParameter.objects.select_related('param')))
+            if self.is_field_requested('depends_on'):
+                queryset = queryset.prefetch_related(Prefetch('dependencies', queryset=Task.objects.only('id', 'uuid')))
+            if self.is_field_requested('elements'):
+                queryset = queryset.prefetch_related('elements')
+            if self.is_field_requested('resource_usage'):
+                queryset = queryset.select_related('resource_usage')
+        return queryset
+
+    def get_requested_fields(self):
+        """
+        Fields of the tasks requested with ?fields=a,b or excluded with ?omit=a,b, None if all the fields are requested
+        """
+        if self.action not in ("list", "retrieve"):
+            return None
+
+        fields = self.request.query_params.get('fields')
+        omit = self.request.query_params.get('omit')
+        if not fields and not omit:
+            return None
+
+        available = self.get_serializer_class().Meta.fields
+        requested = set(fields.split(',')) if fields else set(available)
+        if omit:
+            requested -= set(omit.split(','))
+
+        unknown = requested - set(available)
+        if unknown:
+            raise exceptions.ParseError("Unknown fields: {}".format(", ".join(sorted(unknown))))
+        return requested
+
+    def is_field_requested(self, field):
+        if field not in self.get_serializer_class().Meta.fields:
+            return False
+        requested = self.get_requested_fields()
+        return requested is None or field in requested
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_requested_fields()
+        return context
+
+    def refresh_drm_statuses(self, tasks):
+        # The DRM is queried only if the status is requested
+        if self.is_field_requested('status') or self.is_field_requested('elements'):
+            Task.refresh_drm_statuses(tasks)
+
     def get_serializer_class(self):
         if self.request and self.request.user and self.request.user.is_admin():
             return SuperTaskSerializer
@@ -48,27 +130,184 @@ class TaskViewSet(viewsets.ModelViewSet):
             return super().get_permissions()
 
     def get_throttles(self):
-        if self.action == "create":
+        if self.action in ("create", "batch", "workflow"):
             _throttle_classes = [IPRateThrottleBurst, IPRateThrottleSustained,
                                  UserBasedThrottleBurst, UserBasedThrottleSustained]
         else:
             _throttle_classes = [IPRateThrottleBurst, UserBasedThrottleBurst]
         return [throttle() for throttle in _throttle_classes]
 
+    def get_throttle_cost(self, request):
+        """
+        A batch or workflow request counts as many requests as the tasks it creates for the sustained throttles
+        """
+        if self.action == "batch":
+            tasks = self.get_batch_data(request)["tasks"]
+            return len(tasks) if isinstance(tasks, list) else 1
+        if self.action == "workflow":
+            nodes = request.data.get("nodes") if isinstance(request.data, dict) else None
+            return len(nodes) if isinstance(nodes, list) else 1
+        return 1
+
+    @staticmethod
+    def get_batch_data(request):
+        # The tasks can be passed as a list or inside the tasks key
+        if isinstance(request.data, list):
+            return {"tasks": request.data}
+        if not isinstance(request.data, dict):
+            raise exceptions.ValidationError({"tasks": "The tasks have to be a list"})
+        return {"tasks": request.data.get("tasks")}
+
+    def create(self, request, *args, **kwargs):
+        """
+        Create a task, the retries of a request with the same Idempotency-Key header return the task created by the
+        first one without submitting another job
+        """
+        # The task has been accepted, but it is sent to the DRM later by the submission workers
+        created_status = status.HTTP_202_ACCEPTED if ASYNC_SUBMISSION else status.HTTP_201_CREATED
+
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            response = super().create(request, *args, **kwargs)
+            response.status_code = created_status
+            return response
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            raise exceptions.ValidationError({'Idempotency-Key': "The key is too long"})
+
+        record, claimed = claim_key(request, key)
+        if not claimed:
+            return self.get_replayed_response(request, record, created_status)
+
+        try:
+            serializer = self.get_serializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            self.perform_create(serializer)
+        except BaseException:
+            # Release the key, the request can be retried
+            release_key(record)
+            raise
+        store_task(record, serializer.instance)
+
+        return Response(serializer.data, status=created_status, headers=self.get_success_headers(serializer.data))
+
+    def get_replayed_response(self, request, record, created_status):
+        if record is None or record.task is None:
+            return Response({'detail': "A request with the same Idempotency-Key is in progress"},
+                            status=status.HTTP_409_CONFLICT)
+        if record.request_hash != get_request_hash(request):
+            return Response({'detail': "The Idempotency-Key has already been used for a different request"},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        response = Response(self.get_serializer(record.task).data, status=created_status)
+        response['Idempotent-Replayed'] = 'true'
+        return response
+
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    @action(methods=['POST'], detail=False, parser_classes=[JSONParser])
+    def batch(self, request, **kwargs):
+        """
+        Create many tasks with a single request, returning the result of each task
+        """
+        serializer = TaskBatchSerializer(data=self.get_batch_data(request), context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save(user=request.user)
+
+        if not any('uuid' in result for result in results):
+            return Response(results, status=status.HTTP_400_BAD_REQUEST)
+        if all(result['status'] == Task.Status.REJECTED.value for result in results if 'uuid' in result):
+            # None of the valid tasks has been accepted by the DRM
+            return Response(results, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(results, status=status.HTTP_202_ACCEPTED if ASYNC_SUBMISSION else status.HTTP_201_CREATED)
+
+    @action(methods=['POST'], detail=False, parser_classes=[JSONParser])
+    def workflow(self, request, **kwargs):
+        """
+        Create the tasks of a workflow with a single request, returning the UUID of the task of each node
+        """
+        serializer = TaskWorkflowSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        result = serializer.save(user=request.user)
+        return Response(result, status=status.HTTP_202_ACCEPTED if ASYNC_SUBMISSION else status.HTTP_201_CREATED)
+
     def get_response(self, queryset):
         page = self.paginate_queryset(queryset)
         if page is not None:
-            # If pagination is enabled, return the paginated response
-            serializer = self.get_serializer(page, many=True)
+            # If pagination is enabled, update the drm status only of the tasks in the page and return it
+            self.refresh_drm_statuses(page)
+            serializer = self.get_serializer(page, many=True, context=self.get_list_context(page))
             return self.get_paginated_response(serializer.data)
         else:
             # If pagination is disabled, return the serialized data
-            serializer = self.get_serializer(queryset, many=True)
+            tasks = list(queryset)
+            self.refresh_drm_statuses(tasks)
+            serializer = self.get_serializer(tasks, many=True, context=self.get_list_context(tasks))
             return Response(serializer.data)
 
+    def get_changes_response(self, queryset, token):
+        """
+        Tasks changed since the token, from the least recently changed, with the token to get the next changes
+
+        At most MAX_PAGE_SIZE tasks are returned, more is true if the next changes can be requested right away. The
+        tasks deleted by a user are returned to them only by UUID.
+        """
+        since, after_id = self.parse_changes_token(token)
+        now = timezone.now()
+
+        tasks = list(queryset.filter(Q(update_date__gt=since) | Q(update_date=since, id__gt=after_id))
+                     .order_by('update_date', 'id')[:MAX_PAGE_SIZE + 1])
+        more = len(tasks) > MAX_PAGE_SIZE
+        tasks = tasks[:MAX_PAGE_SIZE]
+        # The token is taken before the refresh, which moves the update date of the changed tasks to now
+        if more:
+            next_token = self.get_changes_token(tasks[-1].update_date, tasks[-1].id)
+        else:
+            # Go back a little, not to miss the changes of the transactions still running. The tasks changed meanwhile
+            # are returned again the next time.
+            next_token = self.get_changes_token(now - self.changes_overlap, 0)
+        # Only the returned tasks are refreshed, the other changes of the DRM statuses are written by the poller. The
+        # refreshed tasks are returned again with the next token.
+        self.refresh_drm_statuses(tasks)
+
+        deleted = []
+        if not request_by_admin(self.request):
+            deleted = [task.uuid for task in tasks if task.deleted]
+            tasks = [task for task in tasks if not task.deleted]
+
+        serializer = self.get_serializer(tasks, many=True, context=self.get_list_context(tasks))
+        return Response({'changed_since': next_token, 'more': more, 'results': serializer.data, 'deleted': deleted})
+
+    @staticmethod
+    def get_changes_token(update_date, task_id):
+        return urlsafe_base64_encode("{}|{}".format(update_date.isoformat(), task_id).encode())
+
+    @staticmethod
+    def parse_changes_token(token):
+        """
+        Returns the time and the task id of a token, a plain ISO 8601 time is accepted as well
+        """
+        try:
+            since, task_id = parse_datetime(token), 0
+            if since is None:
+                since, task_id = urlsafe_base64_decode(token).decode().split('|')
+                since, task_id = parse_datetime(since), int(task_id)
+            if since is None:
+                raise ValueError
+        except (ValueError, UnicodeDecodeError):
+            raise exceptions.ValidationError({'changed_since': "Not a valid time or token"})
+
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since, task_id
+
+    def get_list_context(self, tasks):
+        # The descendants of all the listed tasks are loaded at once
+        context = self.get_serializer_context()
+        if self.is_field_requested('descendants'):
+            context['descendants'] = Task.get_descendants_of(tasks)
+        return context
+
     @throttle_classes([IPRateThrottleBurst, UserBasedThrottleBurst])
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
@@ -87,22 +326,21 @@ class TaskViewSet(viewsets.ModelViewSet):
                 queryset = queryset.filter(
                     uuid__in=uuids, user=request.user, deleted=False)
 
-            for task in queryset:
-                task.update_drm_status()
-
             return self.get_response(queryset)
 
         elif request.user is not None:
             # If the request is made by a user, then return all the tasks owned by the user
 
             if not request_by_admin(request):
-                # If the user is not an admin, only return tasks that are not deleted and belong to the user
                 queryset = queryset.filter(user=request.user)
-                queryset = queryset.filter(deleted=False)
 
-            # Update the drm status of the task
-            for task in queryset:
-                task.update_drm_status()
+            if 'changed_since' in request.query_params:
+                # Only the tasks changed since the last request of the client, deleted ones included
+                return self.get_changes_response(queryset, request.query_params['changed_since'])
+
+            if not request_by_admin(request):
+                # If the user is not an admin, only return tasks that are not deleted and belong to the user
+                queryset = queryset.filter(deleted=False)
 
             return self.get_response(queryset)
         else:
@@ -116,7 +354,7 @@ class TaskViewSet(viewsets.ModelViewSet):
         """
         task: Task = self.get_object()
         # Update the drm status before returning the task
-        task.update_drm_status()
+        self.refresh_drm_statuses([task])
 
         if not task.deleted or request_by_admin(request):
             serializer = self.get_serializer(task)
@@ -132,6 +370,7 @@ class TaskViewSet(viewsets.ModelViewSet):
 
         if not task.has_finished():
             terminate_job(task.drm_job_id)
+            status_cache.invalidate(task.drm_job_id)
 
         task.delete_from_user()
 
@@ -141,11 +380,62 @@ class TaskViewSet(viewsets.ModelViewSet):
         # self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(methods=['GET', 'POST'], detail=False, url_path='status', parser_classes=[JSONParser, FormParser])
+    def statuses(self, request, **kwargs):
+        """
+        Status and last update of many tasks by UUID, loaded with a single query
+
+        The UUIDs are passed as ?ids=a,b,c or in the ids key of the body. Tasks that do not exist or cannot be seen by
+        the user are left out of the response.
+        """
+        uuids = self.get_status_ids(request)
+        if len(uuids) > MAX_STATUS_IDS:
+            raise exceptions.ValidationError({'ids': "At most {} tasks can be requested at once".format(MAX_STATUS_IDS)})
+        try:
+            uuids = [uuid.UUID(str(u)) for u in uuids]
+        except ValueError:
+            raise exceptions.ValidationError({'ids': "The ids have to be task UUIDs"})
+
+        tasks = Task.objects.filter(uuid__in=uuids) \
+            .only('id', 'uuid', '_status', 'update_date', '_drm_job_id', 'deleted', 'is_sweep', 'user', 'callback_url')
+        if not request_by_admin(request):
+            # Users see their own tasks, anonymous users the tasks without an owner
+            tasks = tasks.filter(user=request.user, deleted=False) if request.user \
+                else tasks.filter(user__isnull=True, deleted=False)
+        tasks = list(tasks)
+        Task.refresh_drm_statuses(tasks)
+
+        return Response({str(task.uuid): {'status': task.status, 'update_date': task.update_date} for task in tasks})
+
+    @staticmethod
+    def get_status_ids(request):
+        if request.method == 'GET':
+            ids = request.query_params.get('ids', '')
+        elif isinstance(request.data, list):
+            ids = request.data
+        else:
+            ids = request.data.get('ids', '')
+        if isinstance(ids, str):
+            ids = [i for i in ids.split(',') if i]
+        if not isinstance(ids, list):
+            raise exceptions.ValidationError({'ids': "The ids have to be a list of task UUIDs"})
+        return ids
+
+    @action(methods=['GET'], detail=False, url_path='drm-stats')
+    def drm_stats(self, request, **kwargs):
+        """
+        Statistics of the DRM status cache and session of the process serving the request, only for admins
+        """
+        if not request_by_admin(request):
+            raise exceptions.PermissionDenied()
+
+        return Response({'status_cache': status_cache.stats(), 'session': session_manager.stats()})
+
     @action(methods=['GET'], detail=True)
     def download(self, request, **kwargs):
         task: Task = self.get_object()
 
-        task.update_drm_status()
+        Task.refresh_drm_statuses([task])
 
         if task.has_finished():
             p_task = task.get_first_ancestor()
@@ -0,0 +1,108 @@
+import hashlib
+import hmac
+import ipaddress
+import json
+import socket
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from server.settings import WEBHOOK_ALLOWED_HOSTS, WEBHOOK_SECRET
+
+
+def sign(body, timestamp, secret):
+    """
+    HMAC-SHA256 of the timestamp and the body, as sent in the X-Webhook-Signature header
+    """
+    message = "{}.".format(timestamp).encode() + body
+    return "sha256=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def build_request(deliveries):
+    """
+    Body and headers of the request delivering many status changes to the same endpoint
+    """
+    body = json.dumps({'events': [delivery.payload for delivery in deliveries]}).encode()
+    headers = {'Content-Type': 'application/json'}
+    if WEBHOOK_SECRET:
+        timestamp = str(int(time.time()))
+        headers['X-Webhook-Timestamp'] = timestamp
+        headers['X-Webhook-Signature'] = sign(body, timestamp, WEBHOOK_SECRET)
+    return body, headers
+
+
+def check_url(url):
+    """
+    Raises ValueError if the status changes cannot be sent to the URL, otherwise returns the address to connect to
+
+    Only http and https are allowed, and the host must resolve only to public addresses, unless it is one of the
+    WEBHOOK_ALLOWED_HOSTS, for which None is returned. The request must be sent to the returned address with pin_url,
+    resolving the host again could give another address.
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError:
+        raise ValueError("The URL is not valid")
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("Only http and https URLs are allowed")
+    if parts.hostname in WEBHOOK_ALLOWED_HOSTS:
+        return None
+
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)]
+    except (socket.gaierror, UnicodeError):
+        raise ValueError("The host cannot be resolved")
+    for address in addresses:
+        # Drop the scope of the IPv6 link-local addresses
+        address = ipaddress.ip_address(address.split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError("The host resolves to a loopback, private or reserved address")
+    # The first address is the preferred one
+    return addresses[0]
+
+
+def pin_url(url, address):
+    """
+    URL connecting to the address returned by check_url, and the Host header of the original URL
+
+    The requests to the pinned URLs are sent with a session from get_session, which checks the TLS certificate against
+    the host in the Host header.
+    """
+    if address is None:
+        return url, None
+    parts = urlsplit(url)
+    userinfo, _, host = parts.netloc.rpartition('@')
+    netloc = '[{}]'.format(address) if ':' in address else address
+    if parts.port:
+        netloc = '{}:{}'.format(netloc, parts.port)
+    if userinfo:
+        netloc = '{}@{}'.format(userinfo, netloc)
+    return urlunsplit(parts._replace(netloc=netloc)), host
+
+
+class PinnedAddressAdapter(HTTPAdapter):
+    """
+    Transport adapter for the URLs pinned to an address, the TLS connections send the host in the Host header as
+    server name and check the certificate against it instead of the address
+    """
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        host = request.headers.get('Host')
+        if host_params['scheme'] == 'https' and host:
+            hostname = urlsplit('//' + host).hostname
+            pool_kwargs['server_hostname'] = hostname
+            pool_kwargs['assert_hostname'] = hostname
+        return host_params, pool_kwargs
+
+
+def get_session():
+    """
+    Session for the webhook requests, it keeps the connections open between the deliveries
+    """
+    session = requests.Session()
+    session.mount('https://', PinnedAddressAdapter())
+    return session
@@ -1,16 +1,49 @@
 # from rest_framework.test import APIRequestFactory
+import asyncio
+import io
+import json
+import shutil
+import socket
+import threading
 import time
+import uuid
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
-from django.test import TestCase
-from rest_framework import status
+import requests
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.http import QueryDict
+from django.test import AsyncClient, SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework import exceptions, status
+from rest_framework.exceptions import NotAcceptable, NotFound, ValidationError
 from rest_framework.test import APIClient
 
-from .models import Token, User
+from .drm import JobStatusCache, get_jobs_accounting, start_job
+from .models import Group, Token, User, get_anon_user_throttle
 from .drm_job_template.models import DRMJobTemplate
 from .script.models import Script
-from .parameter.models import Parameter
-from .task.models import Task
+from .script.catalog import VERSION_KEY as CATALOG_VERSION_KEY
+from .script.plan import VERSION_KEY, SubmissionPlan, get_plan, is_cache_shared
+from .parameter.models import Parameter, TaskParameter
+from .management.commands.collect_resource_usage import Command as CollectResourceUsage
+from .management.commands.deliver_webhooks import Command as DeliverWebhooks
+from .management.commands.resource_report import Command as ResourceReport
+from .management.commands.run_submission_workers import Command as RunSubmissionWorkers
+from .management.commands.task_timings import Command as TaskTimings, get_timed_tasks
+from .task import events
+from .task.events import TaskEventHub
+from .task.models import IdempotencyKey, ResourceUsageCollection, Task, TaskResourceUsage, TaskStatusTransition, \
+    TaskSubmission, WebhookDelivery
+from .task.serializers import TaskSerializer, validate_callback_url
+from .task.views import TaskViewSet
+from .task.webhooks import PinnedAddressAdapter, get_session, pin_url, sign
+from .utils import create_task_folder, get_params
 
 # # Define request factory
 # factory = APIRequestFactory()
@@ -175,3 +208,1025 @@ class TaskViewSetTest(TestCase):
     # # TODO Test task hierarchy (dependent task must be executed after dependency task)
     # def test_task_hierarchy(self) -> None:
     #     raise NotImplementedError
+
+
+# Test DRM status cache
+class JobStatusCacheTest(SimpleTestCase):
+
+    # Set up tests
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    # Fake DRM lookup, counting calls and blocking until released
+    def lookup(self, job_id):
+        self.calls.append(job_id)
+        self.release.wait(5)
+        return Task.Status.RUNNING.value
+
+    # Test repeated lookups are served from the cache
+    def test_hit(self):
+        self.release.set()
+        cache = JobStatusCache(self.lookup, ttl=60, terminal_ttl=60)
+        for _ in range(3):
+            self.assertEqual(cache.get(1), Task.Status.RUNNING.value)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    # Test expired entries are looked up again
+    def test_expired(self):
+        self.release.set()
+        cache = JobStatusCache(self.lookup, ttl=0, terminal_ttl=60)
+        cache.get(1)
+        cache.get(1)
+        self.assertEqual(len(self.calls), 2)
+
+    # Test concurrent lookups of the same job share a single DRM call
+    def test_coalesced(self):
+        cache = JobStatusCache(self.lookup, ttl=60, terminal_ttl=60)
+        threads = [threading.Thread(target=cache.get, args=(1,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # Wait for all the threads to ask for the job
+        while cache.stats()['misses'] + cache.stats()['coalesced'] < 5:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+
+# Test task hierarchy
+class TaskTreeTest(TestCase):
+
+    # Set up tests, a tree root -> (a -> b, c)
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        script = Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.root = Task.objects.create(task_name=script)
+        self.a = Task.objects.create(task_name=script, parent_task=self.root, root_task=self.root)
+        self.b = Task.objects.create(task_name=script, parent_task=self.a, root_task=self.root)
+        self.c = Task.objects.create(task_name=script, parent_task=self.root, root_task=self.root)
+
+    # Test the descendants of many tasks are loaded with a single query
+    def test_descendants(self):
+        with self.assertNumQueries(1):
+            descendants = Task.get_descendants_of([self.root, self.a, self.b, self.c])
+        self.assertCountEqual(descendants[self.root.id], [self.a.uuid, self.b.uuid, self.c.uuid])
+        self.assertEqual(descendants[self.a.id], [self.b.uuid])
+        self.assertEqual(descendants[self.b.id], [])
+
+    # Test the first ancestor is the stored root task
+    def test_first_ancestor(self):
+        task = Task.objects.get(id=self.b.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(task.get_first_ancestor(), self.root)
+        self.assertEqual(self.root.get_first_ancestor(), self.root)
+
+
+# Test the number of queries of the task endpoint does not depend on the number of tasks
+class TaskQueryBudgetTest(TestCase):
+
+    # Set up tests, tasks with parameters, parent and dependencies
+    def setUp(self):
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, active=True)
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        script = Script.objects.create(name='blast', job=job, command='blast.sh')
+        query = Parameter.objects.create(name='query', flag='--query', type=Parameter.Type.STRING.value,
+                                         script=script)
+        threads = Parameter.objects.create(name='num_threads', flag='-n', type=Parameter.Type.INTEGER.value,
+                                           private=True, script=script)
+        self.root = Task.objects.create(task_name=script, user=self.user)
+        for i in range(20):
+            task = Task.objects.create(task_name=script, user=self.user, parent_task=self.root, root_task=self.root)
+            TaskParameter.objects.create(task=task, param=query, value='seq{}'.format(i))
+            TaskParameter.objects.create(task=task, param=threads, value='4')
+            task.dependencies.add(self.root)
+        # Throttling rates of the users without a group, read once for each request
+        get_anon_user_throttle()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    # Reset the throttles
+    def tearDown(self):
+        cache.clear()
+
+    # Test a page of tasks is listed with a fixed number of queries
+    def test_list(self):
+        for page_size in (2, 20):
+            with self.assertNumQueries(7):
+                response = self.client.get('/task/', {'page_size': page_size})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data['results']), page_size)
+
+    # Test the cursor pagination walks all the tasks without counting them
+    def test_cursor(self):
+        uuids, url = [], '/task/?pagination=cursor&page_size=5'
+        while url:
+            with self.assertNumQueries(6):
+                response = self.client.get(url)
+            self.assertNotIn('count', response.data)
+            uuids.extend(task['uuid'] for task in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(uuids, [str(u) for u in Task.objects.order_by('-creation_date', '-id')
+                                 .values_list('uuid', flat=True)])
+
+    # Test the fields that are not requested are not loaded
+    def test_fields(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/task/', {'fields': 'uuid,task_name,status'})
+        self.assertEqual(set(response.data['results'][0]), {'uuid', 'task_name', 'status'})
+        with self.assertNumQueries(4):
+            response = self.client.get('/task/{}/'.format(self.root.uuid), {'omit': 'params,depends_on'})
+        self.assertNotIn('params', response.data)
+        self.assertEqual(len(response.data['descendants']), 20)
+        response = self.client.get('/task/', {'fields': 'uuid,secret'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Test the statuses of many tasks are returned with a single query, only for the tasks of the user
+    def test_statuses(self):
+        other = Task.objects.create(task_name=self.root.task_name,
+                                    user=User.objects.create(username='other', source=User.ORCID))
+        uuids = [str(u) for u in Task.objects.values_list('uuid', flat=True)]
+        with self.assertNumQueries(2):
+            response = self.client.post('/task/status/', {'ids': uuids}, format='json')
+        self.assertEqual(len(response.data), 21)
+        self.assertNotIn(str(other.uuid), response.data)
+        response = self.client.get('/task/status/', {'ids': str(self.root.uuid)})
+        self.assertEqual(response.data[str(self.root.uuid)]['status'], Task.Status.RECEIVED.value)
+        response = self.client.get('/task/status/', {'ids': 'not-a-uuid'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Test only the tasks changed since the token are returned, and the status updates are changes
+    def test_changed_since(self):
+        Task.objects.update(update_date=timezone.now() - timedelta(days=1))
+        response = self.client.get('/task/', {'changed_since': '2000-01-01T00:00:00Z', 'fields': 'uuid'})
+        self.assertEqual(len(response.data['results']), 21)
+        self.assertFalse(response.data['more'])
+
+        tasks = list(Task.objects.exclude(id=self.root.id)[:2])
+        tasks[0].status = Task.Status.RUNNING.value
+        tasks[1].delete_from_user()
+
+        response = self.client.get('/task/', {'changed_since': response.data['changed_since'], 'fields': 'uuid'})
+        self.assertEqual([t['uuid'] for t in response.data['results']], [str(tasks[0].uuid)])
+        self.assertEqual(response.data['deleted'], [tasks[1].uuid])
+
+        response = self.client.get('/task/', {'changed_since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Test only the returned changes are refreshed from the DRM
+    def test_changed_since_refresh(self):
+        Task.objects.update(_drm_job_id=1, update_date=timezone.now() - timedelta(days=1))
+        token = TaskViewSet.get_changes_token(timezone.now() - timedelta(hours=1), 0)
+        task = Task.objects.exclude(id=self.root.id).first()
+        Task.objects.filter(id=task.id).update(_drm_job_id=2, update_date=timezone.now())
+        with mock.patch('submission.task.models.status_cache.get', return_value=Task.Status.RUNNING.value) as get:
+            response = self.client.get('/task/', {'changed_since': token, 'fields': 'uuid,status'})
+        self.assertEqual([t['uuid'] for t in response.data['results']], [str(task.uuid)])
+        get.assert_called_once_with(2)
+
+    # Test the token of a full page is not moved forward by the refresh of its last task
+    def test_changed_since_full_page(self):
+        yesterday = timezone.now() - timedelta(days=1)
+        tasks = list(Task.objects.exclude(id=self.root.id).order_by('id')[:3])
+        for i, task in enumerate(tasks):
+            Task.objects.filter(id=task.id).update(_drm_job_id=i + 1, update_date=yesterday + timedelta(minutes=i))
+        Task.objects.exclude(id__in=[task.id for task in tasks]).update(update_date=yesterday - timedelta(days=1))
+        token = TaskViewSet.get_changes_token(yesterday - timedelta(hours=1), 0)
+
+        # Only the second task, the last of the page, changes its status
+        statuses = {1: Task.Status.RECEIVED.value, 2: Task.Status.RUNNING.value, 3: Task.Status.RECEIVED.value}
+        with mock.patch('submission.task.views.MAX_PAGE_SIZE', 2), \
+                mock.patch('submission.task.models.status_cache.get', side_effect=statuses.get):
+            response = self.client.get('/task/', {'changed_since': token, 'fields': 'uuid,status'})
+            self.assertTrue(response.data['more'])
+            self.assertEqual(response.data['results'][1]['status'], Task.Status.RUNNING.value)
+            self.assertEqual(TaskViewSet.parse_changes_token(response.data['changed_since']),
+                             (yesterday + timedelta(minutes=1), tasks[1].id))
+
+            response = self.client.get('/task/', {'changed_since': response.data['changed_since'], 'fields': 'uuid'})
+        self.assertEqual([t['uuid'] for t in response.data['results']], [str(tasks[2].uuid), str(tasks[1].uuid)])
+
+    # Test a single task is retrieved with a fixed number of queries
+    def test_retrieve(self):
+        with self.assertNumQueries(6):
+            response = self.client.get('/task/{}/'.format(self.root.uuid))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['descendants']), 20)
+
+    # Test the parameters of a task are validated in memory and stored with a single insert
+    def test_get_params(self):
+        script = self.root.task_name
+        for i in range(30):
+            Parameter.objects.create(name='opt{}'.format(i), flag='--opt{}'.format(i),
+                                     type=Parameter.Type.INTEGER.value, required=False, script=script)
+        parameters_of_task = list(Parameter.objects.filter(script=script))
+        values = QueryDict(mutable=True)
+        values.update({'query': 'seq', 'num_threads': '1', **{'opt{}'.format(i): str(i) for i in range(30)}})
+
+        create_task_folder(str(self.root.uuid))
+        try:
+            # The insert of the parameters and the update of the file names
+            plan = SubmissionPlan(script, parameters_of_task)
+            with self.assertNumQueries(2):
+                task_params, _ = get_params(values, self.root, plan)
+            self.assertEqual(len(task_params), 32)
+            self.assertEqual(self.root.params.count(), 32)
+
+            values['opt0'] = 'not a number'
+            task = Task.objects.create(task_name=script, parent_task=self.root)
+            with self.assertRaises(ValidationError):
+                get_params(values, task, plan)
+            self.assertFalse(Task.objects.filter(id=task.id).exists())
+
+            # The uploaded files are saved in the working directory, the other values are validated the same way
+            database = Parameter.objects.create(name='db', type=Parameter.Type.FILE.value, script=script)
+            values['opt0'] = '0'
+            values['db'] = SimpleUploadedFile('proteins.fasta', b'>seq')
+            task = Task.objects.create(task_name=script, parent_task=self.root)
+            plan = SubmissionPlan(script, parameters_of_task + [database])
+            task_params, renamed_files = get_params(values, task, plan)
+            self.assertEqual(len(task_params), 33)
+            self.assertEqual(renamed_files, {'db.fasta': 'proteins.fasta'})
+            self.assertEqual(task.params.get(param=database).value, 'db.fasta')
+        finally:
+            shutil.rmtree(self.root.get_task_path(), ignore_errors=True)
+
+
+# Test the dependencies of a new task are resolved and checked with a single query
+class TaskDependencyTest(TestCase):
+
+    # Set up tests, tasks of the user already sent to the DRM and a task of another user
+    def setUp(self):
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, active=True)
+        other = User.objects.create(username='Another-fake-username', source=User.ORCID, active=True)
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        self.script = Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.tasks = [Task.objects.create(task_name=self.script, user=self.user, _drm_job_id=i + 1,
+                                          _status=Task.Status.RUNNING.value) for i in range(30)]
+        self.other = Task.objects.create(task_name=self.script, user=other, _drm_job_id=100)
+
+    def get_dependencies(self, tasks, dependency_type=Task.DependencyTypes.AFTER_ANY):
+        value = ",".join(str(task.uuid) for task in tasks)
+        return TaskSerializer().get_dependencies(value, self.user, dependency_type)
+
+    # Test the number of queries does not depend on the number of dependencies
+    def test_resolve(self):
+        with self.assertNumQueries(1):
+            dependencies = self.get_dependencies(self.tasks)
+        self.assertEqual(len(dependencies), 30)
+
+    # Test the dependencies of other users, not sent to the DRM or already failed are refused
+    def test_checks(self):
+        with self.assertRaises(NotFound):
+            self.get_dependencies([self.tasks[0], self.other])
+        Task.objects.filter(id=self.tasks[0].id).update(_drm_job_id=None)
+        with self.assertRaises(NotAcceptable):
+            self.get_dependencies(self.tasks[:2])
+        Task.objects.filter(id=self.tasks[1].id).update(_status=Task.Status.FAILED.value)
+        self.get_dependencies(self.tasks[1:3])
+        with self.assertRaises(NotAcceptable):
+            self.get_dependencies(self.tasks[1:3], Task.DependencyTypes.AFTER_OK)
+
+    # Test a dependency still waiting in the submission queue is accepted with the asynchronous submission
+    def test_queued(self):
+        Task.objects.filter(id=self.tasks[0].id).update(_drm_job_id=None, _status=Task.Status.RECEIVED.value)
+        TaskSubmission.objects.create(task=self.tasks[0])
+        with self.assertNumQueries(1), mock.patch('submission.task.serializers.ASYNC_SUBMISSION', True):
+            self.assertEqual(len(self.get_dependencies(self.tasks[:2])), 2)
+        with self.assertRaises(NotAcceptable):
+            self.get_dependencies(self.tasks[:2])
+
+
+# Test a whole workflow is created with a single request and sent to the DRM in topological order
+class TaskWorkflowTest(TestCase):
+
+    # Set up tests
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    # Reset the throttles
+    def tearDown(self):
+        cache.clear()
+
+    def post(self, nodes):
+        return self.client.post('/task/workflow/', {'nodes': nodes}, format='json')
+
+    # Test the tasks are started after their dependencies, with the DRM job ids of the dependencies
+    def test_create(self):
+        job_ids = iter(range(1, 4))
+        with mock.patch('submission.task.submit.start_job', side_effect=lambda **kwargs: (next(job_ids), 'blast')) \
+                as start_job, mock.patch('submission.task.serializers.create_task_folder'):
+            response = self.post([{'id': 'report', 'task_name': 'blast', 'depends_on': ['search', 'fetch']},
+                                  {'id': 'fetch', 'task_name': 'blast'},
+                                  {'id': 'search', 'task_name': 'blast', 'depends_on': ['fetch'],
+                                   'dependency_type': 'afterok'}])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(list(response.data['tasks']), ['fetch', 'search', 'report'])
+        self.assertEqual([call.kwargs['dependencies'] for call in start_job.call_args_list], [None, [1], [2, 1]])
+
+        report = Task.objects.get(uuid=response.data['tasks']['report']['uuid'])
+        self.assertEqual(report.parent_task.uuid, response.data['tasks']['fetch']['uuid'])
+        self.assertEqual(sorted(report.dependencies.values_list('_drm_job_id', flat=True)), [1, 2])
+
+    # Test a workflow with a cycle is refused without creating any task
+    def test_cycle(self):
+        response = self.post([{'id': 'a', 'task_name': 'blast', 'depends_on': ['c']},
+                              {'id': 'b', 'task_name': 'blast', 'depends_on': ['a']},
+                              {'id': 'c', 'task_name': 'blast', 'depends_on': ['b']}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Task.objects.exists())
+
+    # Test the tasks are rejected if the DRM session cannot be opened
+    def test_session_error(self):
+        with mock.patch('submission.task.serializers.session', side_effect=Exception('DRM error')), \
+                mock.patch('submission.task.serializers.create_task_folder'):
+            response = self.post([{'id': 'fetch', 'task_name': 'blast'},
+                                  {'id': 'search', 'task_name': 'blast', 'depends_on': ['fetch']}])
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(set(Task.objects.values_list('_status', flat=True)), {Task.Status.REJECTED.value})
+
+    # Test a workflow counts as many requests as its nodes for the sustained throttles
+    def test_throttle_cost(self):
+        view = TaskViewSet(action='workflow')
+        self.assertEqual(view.get_throttle_cost(mock.Mock(data={'nodes': [{}, {}, {}]})), 3)
+        self.assertEqual(view.get_throttle_cost(mock.Mock(data=[])), 1)
+
+
+# Test the submission workers start the job of each queued task once, also when it cannot be recorded
+class SubmissionWorkerTest(TestCase):
+
+    # Set up tests, a task waiting in the submission queue
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        script = Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.task = Task.objects.create(task_name=script)
+        TaskSubmission.objects.create(task=self.task)
+
+    # Test the job is started and recorded, and the task leaves the queue
+    def test_submit(self):
+        with mock.patch('submission.task.submit.start_job', return_value=(42, 'blast')) as start_job:
+            self.assertTrue(RunSubmissionWorkers.process_next())
+            self.assertFalse(RunSubmissionWorkers.process_next())
+        start_job.assert_called_once()
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.drm_job_id, self.task.status), (42, Task.Status.CREATED.value))
+
+    # Test the task is released to be retried later when its job cannot be started
+    def test_retry(self):
+        with mock.patch('submission.task.submit.start_job', side_effect=RuntimeError("DRM unavailable")):
+            self.assertTrue(RunSubmissionWorkers.process_next())
+        submission = TaskSubmission.objects.get()
+        self.assertEqual((submission.attempts, submission.claimed), (1, False))
+        self.assertGreater(submission.not_before, timezone.now())
+
+    # Test a job started but not recorded is not started again, the task is rejected when its claim expires
+    def test_not_recorded(self):
+        with mock.patch('submission.task.submit.start_job', return_value=(42, 'blast')) as start_job:
+            with mock.patch.object(Task, 'save_deferred', side_effect=DatabaseError("Lost connection")), \
+                    self.assertRaises(DatabaseError):
+                RunSubmissionWorkers.process_next()
+            self.assertTrue(TaskSubmission.objects.get().claimed)
+            self.assertFalse(RunSubmissionWorkers.process_next())
+            TaskSubmission.objects.update(not_before=timezone.now())
+            self.assertTrue(RunSubmissionWorkers.process_next())
+        start_job.assert_called_once()
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.drm_job_id, self.task.status), (None, Task.Status.REJECTED.value))
+        self.assertFalse(TaskSubmission.objects.exists())
+
+
+# Test the retries of a task creation with the same Idempotency-Key return the first task
+class IdempotencyKeyTest(TestCase):
+
+    # Set up tests
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def post(self, key, **data):
+        return self.client.post('/task/', {'task_name': 'blast', **data}, HTTP_IDEMPOTENCY_KEY=key)
+
+    # Test a retry returns the same task without starting another job
+    def test_retry(self):
+        with mock.patch('submission.task.submit.start_job', return_value=(1, 'blast')) as start_job, \
+                mock.patch('submission.task.serializers.create_task_folder'), \
+                mock.patch('submission.task.serializers.get_params', return_value=([], {})):
+            first = self.post('key-1')
+            retry = self.post('key-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['uuid'], first.data['uuid'])
+        self.assertEqual(start_job.call_count, 1)
+        self.assertEqual(Task.objects.count(), 1)
+
+        # The same key cannot be used for another request
+        self.assertEqual(self.post('key-1', task_description='other').status_code,
+                         status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    # Test a retry is refused while the first request is in progress, and accepted once the key has expired
+    def test_in_progress(self):
+        IdempotencyKey.objects.create(scope='user:{}'.format(self.user.id), key='key-1', request_hash='',
+                                      expiry_date=timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.post('key-1').status_code, status.HTTP_409_CONFLICT)
+
+        IdempotencyKey.objects.update(expiry_date=timezone.now())
+        with mock.patch('submission.task.submit.start_job', return_value=(1, 'blast')), \
+                mock.patch('submission.task.serializers.create_task_folder'), \
+                mock.patch('submission.task.serializers.get_params', return_value=([], {})):
+            self.assertEqual(self.post('key-1').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.get().task, Task.objects.get())
+
+    # Test the key of a request that has not created its task within the lease is taken over by a retry
+    def test_lease(self):
+        record = IdempotencyKey.objects.create(scope='user:{}'.format(self.user.id), key='key-1', request_hash='',
+                                               expiry_date=timezone.now() + timedelta(hours=1))
+        IdempotencyKey.objects.update(creation_date=timezone.now() - timedelta(minutes=5))
+        with mock.patch('submission.task.submit.start_job', return_value=(1, 'blast')), \
+                mock.patch('submission.task.serializers.create_task_folder'), \
+                mock.patch('submission.task.serializers.get_params', return_value=([], {})):
+            self.assertEqual(self.post('key-1').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.get(id=record.id).task, Task.objects.get())
+
+    # Test a request whose key has been taken over by a retry neither releases the key nor stores its task in it
+    def test_taken_over(self):
+        def take_over():
+            IdempotencyKey.objects.update(creation_date=timezone.now() + timedelta(seconds=1))
+
+        def fail(serializer):
+            take_over()
+            raise exceptions.APIException("DRM error")
+
+        def start_job(**kwargs):
+            take_over()
+            return 1, 'blast'
+
+        with mock.patch.object(TaskViewSet, 'perform_create', side_effect=fail):
+            self.assertEqual(self.post('key-1').status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertTrue(IdempotencyKey.objects.exists())
+
+        IdempotencyKey.objects.all().delete()
+        with mock.patch('submission.task.submit.start_job', side_effect=start_job), \
+                mock.patch('submission.task.serializers.create_task_folder'), \
+                mock.patch('submission.task.serializers.get_params', return_value=([], {})):
+            self.assertEqual(self.post('key-1').status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(IdempotencyKey.objects.get().task)
+
+    # Test only the expired keys are purged
+    def test_purge(self):
+        for i, expiry_date in enumerate([timezone.now() - timedelta(seconds=1), timezone.now() + timedelta(hours=1)]):
+            IdempotencyKey.objects.create(scope='ip:127.0.0.1', key='key-{}'.format(i), request_hash='',
+                                          expiry_date=expiry_date)
+        call_command('purge_idempotency_keys', stdout=io.StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['key-1'])
+
+
+# Test the script catalog is served with a fixed number of queries and the group visibility
+class ScriptCatalogTest(TestCase):
+
+    # Set up tests, the scripts of even index belong to a group
+    def setUp(self):
+        self.job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        self.group = Group.objects.create(name='lab')
+        get_anon_user_throttle()
+        self.create_scripts(0, 10)
+        cache.clear()
+        # The catalogs are cached only in a shared cache
+        patcher = mock.patch('submission.script.catalog.is_cache_shared', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_scripts(self, start, end):
+        scripts = Script.objects.bulk_create([Script(name='script_{:04d}'.format(i), job=self.job, command='run.sh')
+                                              for i in range(start, end)])
+        scripts = Script.objects.filter(name__in=[script.name for script in scripts])
+        Parameter.objects.bulk_create([Parameter(name=name, flag='--' + name, type=Parameter.Type.STRING.value,
+                                                 private=name == 'secret', script=script)
+                                       for script in scripts for name in ('query', 'secret')])
+        Script.groups.through.objects.bulk_create([Script.groups.through(script=script, group=self.group)
+                                                   for script in scripts if int(script.name[-4:]) % 2 == 0])
+
+    # Test the number of queries does not grow with the catalog
+    def test_list(self):
+        for end in (10, 2000):
+            self.create_scripts(Script.objects.count(), end)
+            # The bulk inserts do not send the signals that discard the cached catalog
+            cache.clear()
+            with self.assertNumQueries(3):
+                response = client.get('/script/', {'page_size': 1000})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['count'], end // 2)
+            self.assertEqual([p['name'] for p in response.data['results'][0]['param']], ['query'])
+
+    # Test the scripts of a group are visible only to its users
+    def test_visibility(self):
+        user = User.objects.create(username='This-username-is-fake', source=User.ORCID, group=self.group)
+        self.assertEqual(Script.objects.visible_to(None).count(), 5)
+        self.assertEqual(Script.objects.visible_to(user).count(), 10)
+        self.assertEqual(client.get('/script/script_0000/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(client.get('/script/script_0001/').status_code, status.HTTP_200_OK)
+
+    # Test the catalog is served from the cache, validated by its ETag and discarded when a script changes
+    def test_cache(self):
+        etag = client.get('/script/')['ETag']
+        with self.assertNumQueries(0):
+            response = client.get('/script/')
+        self.assertEqual(response['ETag'], etag)
+        response = client.get('/script/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Script.objects.create(name='new_script', job=self.job, command='run.sh')
+        response = client.get('/script/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 6)
+
+    # Test the parameters that do not change the catalog do not create new cache entries
+    def test_cache_key(self):
+        client.get('/script/', {'page': '1', 'page_size': '10'})
+        with self.assertNumQueries(0):
+            for query in ({}, {'page': '01'}, {'page_size': 'many'}, {'_': '1700000000'}):
+                self.assertEqual(client.get('/script/', query).status_code, status.HTTP_200_OK)
+
+    # Test the catalog is not served stale when the version is evicted from the cache
+    def test_evicted_version(self):
+        client.get('/script/')
+        cache.delete(CATALOG_VERSION_KEY)
+        Script.objects.create(name='new_script', job=self.job, command='run.sh')
+        self.assertEqual(client.get('/script/').data['count'], 6)
+
+    # Test the links to the other pages are built for each request from the cached page
+    def test_page_links(self):
+        response = client.get('/script/', {'page': '2', 'page_size': '2'}, HTTP_HOST='first.example.org')
+        self.assertEqual(response.data['next'], 'http://first.example.org/script/?page=3&page_size=2')
+        self.assertEqual(response.data['previous'], 'http://first.example.org/script/?page_size=2')
+        with self.assertNumQueries(0):
+            response = client.get('/script/', {'page': '02', 'page_size': '2', 'search': 'x'},
+                                  HTTP_HOST='second.example.org')
+        self.assertEqual(response.data['next'], 'http://second.example.org/script/?page=3&page_size=2&search=x')
+        self.assertEqual(response.data['previous'], 'http://second.example.org/script/?page_size=2&search=x')
+        response = client.get('/script/', {'page': 'last', 'page_size': '2'})
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(response.data['previous'], 'http://testserver/script/?page=2&page_size=2')
+
+    # Test the catalog is not cached in a cache local to the process, but it is still validated by its ETag
+    def test_local_cache(self):
+        with mock.patch('submission.script.catalog.is_cache_shared', return_value=False):
+            etag = client.get('/script/')['ETag']
+            self.assertEqual(client.get('/script/', HTTP_IF_NONE_MATCH=etag).status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+            Script.objects.create(name='new_script', job=self.job, command='run.sh')
+            response = client.get('/script/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 6)
+
+
+# Test the submission plan of a script is cached and compiled again when the script changes
+class SubmissionPlanTest(TestCase):
+
+    # Set up tests, a script with positional, flagged and boolean parameters
+    def setUp(self):
+        self.job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        script = Script.objects.create(name='blast', job=self.job, command='blast.sh', _max_clock_time='90 minutes')
+        self.params = {name: Parameter.objects.create(name=name, flag=flag, type=param_type, script=script)
+                       for name, flag, param_type in (('query', '--query', Parameter.Type.STRING.value),
+                                                      ('input', '', Parameter.Type.FILE.value),
+                                                      ('evalue', '-e=', Parameter.Type.FLOAT.value),
+                                                      ('verbose', '-v', Parameter.Type.BOOL.value))}
+        cache.clear()
+        # The plans are cached only in a shared cache
+        patcher = mock.patch('submission.script.plan.is_cache_shared', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_args(self, plan, **values):
+        return plan.format_args([TaskParameter(param=self.params[name], value=value) for name, value in values.items()])
+
+    # Test the arguments are built in the order of the flags, from a plan read once from the database
+    def test_format_args(self):
+        plan = get_plan('blast')
+        self.assertEqual(plan.clock_time_limit, b'01:30')
+        self.assertEqual(plan.drm_params['queue'], 'local')
+        with self.assertNumQueries(0):
+            plan = get_plan('blast', [param.id for param in self.params.values()])
+        self.assertEqual(self.get_args(plan, query=" it's ", input='seq.fa', evalue='0.1', verbose='true'),
+                         ['seq.fa', '--query', "it\''s", '-e=0.1', '-v'])
+
+    # Test the plan is compiled again when the parameters or the job template change
+    def test_invalidate(self):
+        get_plan('blast')
+        self.params['query'].flag = '-q'
+        self.params['query'].save()
+        self.assertEqual(self.get_args(get_plan('blast'), query='seq'), ['-q', 'seq'])
+        self.job.queue = 'long'
+        self.job.save()
+        self.assertEqual(get_plan('blast').drm_params['queue'], 'long')
+
+    # Test the plans are not served stale when the version is evicted from the cache
+    def test_evicted_version(self):
+        get_plan('blast')
+        cache.delete(VERSION_KEY)
+        self.params['query'].flag = '-q'
+        self.params['query'].save()
+        self.assertEqual(self.get_args(get_plan('blast'), query='seq'), ['-q', 'seq'])
+
+    # Test the plans are not cached in the local memory of a process, they are compiled from the loaded script
+    def test_local_cache(self):
+        self.assertFalse(is_cache_shared())
+        with mock.patch('submission.script.plan.is_cache_shared', return_value=False):
+            get_plan('blast')
+            with self.assertNumQueries(2):
+                get_plan('blast')
+            script = Script.objects.select_related('job').prefetch_related('param').get(name='blast')
+            with self.assertNumQueries(0):
+                self.assertEqual(get_plan('blast', script=script).drm_params['queue'], 'local')
+
+    # Test the values of the parameters are validated by the plan
+    def test_build_params(self):
+        plan = get_plan('blast')
+        # The file is uploaded separately
+        skip = {self.params['input'].id}
+        task_params = plan.build_params({'query': 'seq', 'evalue': 0.1, 'verbose': 'true'}, skip=skip)
+        self.assertEqual({p.param_id: p.value for p in task_params}, {self.params['query'].id: 'seq',
+                                                                       self.params['evalue'].id: '0.1',
+                                                                       self.params['verbose'].id: 'true'})
+        for values in ({'evalue': 'small'}, {'verbose': 'x' * 5001}):
+            with self.assertRaises(exceptions.APIException):
+                plan.build_params({'query': 'seq', 'evalue': '0.1', 'verbose': 'true', **values}, skip=skip)
+        with self.assertRaises(exceptions.NotAcceptable):
+            plan.build_params({'query': 'seq', 'evalue': '0.1', 'verbose': 'true', 'input': 'seq.fa'})
+
+
+# Test the status changes are delivered to the callback URLs
+class WebhookTest(TestCase):
+
+    # Local endpoint collecting the requests
+    class Handler(BaseHTTPRequestHandler):
+        received = []
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            self.received.append((self.headers['X-Webhook-Timestamp'], self.headers['X-Webhook-Signature'], body))
+            self.send_response(self.status)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    # Set up tests, a stub endpoint and a group whose tasks call it
+    def setUp(self):
+        self.Handler.received = []
+        self.Handler.status = 200
+        self.server = HTTPServer(('127.0.0.1', 0), self.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/hook'.format(self.server.server_port)
+        # The stub endpoint is on a loopback address
+        patcher = mock.patch('submission.task.webhooks.WEBHOOK_ALLOWED_HOSTS', ['127.0.0.1'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        group = Group.objects.create(name='lab', callback_url=self.url)
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, group=group)
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        self.script = Script.objects.create(name='blast', job=job, command='blast.sh')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Test the changes of many tasks are sent to the group endpoint with a single signed request
+    @mock.patch('submission.task.webhooks.WEBHOOK_SECRET', 'secret')
+    def test_delivery(self):
+        tasks = [Task.objects.create(task_name=self.script, user=self.user) for _ in range(3)]
+        Task.objects.create(task_name=self.script)
+        with Task.deferred_save_all(tasks):
+            for task in tasks:
+                task.status = Task.Status.RUNNING.value
+        self.assertEqual(WebhookDelivery.objects.count(), 3)
+
+        with get_session() as session:
+            self.assertTrue(DeliverWebhooks.process_next(session))
+            self.assertFalse(DeliverWebhooks.process_next(session))
+        self.assertEqual(len(self.Handler.received), 1)
+        timestamp, signature, body = self.Handler.received[0]
+        self.assertEqual(signature, sign(body, timestamp, 'secret'))
+        events = json.loads(body)['events']
+        self.assertEqual({event['uuid'] for event in events}, {str(task.uuid) for task in tasks})
+        self.assertEqual(WebhookDelivery.objects.count(), 0)
+
+    # Test failed deliveries are retried later
+    def test_retry(self):
+        self.Handler.status = 500
+        task = Task.objects.create(task_name=self.script, user=self.user, callback_url=self.url + '/task')
+        task.status = Task.Status.DONE.value
+        with get_session() as session:
+            self.assertTrue(DeliverWebhooks.process_next(session))
+            self.assertFalse(DeliverWebhooks.process_next(session))
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual((delivery.url, delivery.attempts), (self.url + '/task', 1))
+        self.assertGreater(delivery.not_before, timezone.now())
+
+    # Test the URLs on internal addresses are refused, when the task is created and when the change is delivered
+    def test_internal_url(self):
+        for url in ['ftp://93.184.216.34/hook', 'http://localhost/hook', 'http://10.0.0.1/hook',
+                    'http://169.254.169.254/latest/meta-data', 'http://[::1]:8000/hook']:
+            with self.assertRaises(NotAcceptable):
+                validate_callback_url(url)
+        validate_callback_url('https://93.184.216.34/hook')
+
+        task = Task.objects.create(task_name=self.script, callback_url='http://10.0.0.1/hook')
+        task.status = Task.Status.DONE.value
+        with get_session() as session:
+            self.assertTrue(DeliverWebhooks.process_next(session))
+        self.assertEqual(self.Handler.received, [])
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    # Test the request is sent to the address checked for the host, which is not resolved again
+    def test_pinned_address(self):
+        task = Task.objects.create(task_name=self.script, callback_url='https://hooks.example.org:8443/hook')
+        task.status = Task.Status.DONE.value
+        addresses = [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('93.184.216.34', 8443))]
+        with get_session() as session, \
+                mock.patch('submission.task.webhooks.socket.getaddrinfo', return_value=addresses) as getaddrinfo, \
+                mock.patch.object(session, 'post', return_value=mock.Mock(is_redirect=False)) as post:
+            self.assertTrue(DeliverWebhooks.process_next(session))
+        getaddrinfo.assert_called_once()
+        self.assertEqual(post.call_args.args, ('https://93.184.216.34:8443/hook',))
+        self.assertEqual(post.call_args.kwargs['headers']['Host'], 'hooks.example.org:8443')
+
+        # The TLS connection checks the certificate of the host
+        request = requests.Request('POST', 'https://93.184.216.34:8443/hook',
+                                   headers={'Host': 'hooks.example.org:8443'}).prepare()
+        host_params, pool_kwargs = PinnedAddressAdapter().build_connection_pool_key_attributes(request, True)
+        self.assertEqual(host_params['host'], '93.184.216.34')
+        self.assertEqual((pool_kwargs['server_hostname'], pool_kwargs['assert_hostname']),
+                         ('hooks.example.org', 'hooks.example.org'))
+        self.assertEqual(pin_url('http://user@[2001:db8::1]/hook', '2001:db8::2'),
+                         ('http://user@[2001:db8::2]/hook', '[2001:db8::1]'))
+
+
+# Test the timings of the tasks are computed from the status transitions
+class TaskTimingsTest(TestCase):
+
+    # Set up tests, tasks waiting 10 seconds in the queue and running 60 seconds after i seconds from the creation
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        script = Script.objects.create(name='blast', job=job, command='blast.sh')
+        for i in range(4):
+            task = Task.objects.create(task_name=script)
+            created = task.creation_date + timedelta(seconds=i)
+            TaskStatusTransition.objects.bulk_create([
+                    TaskStatusTransition(task=task, status=Task.Status.CREATED.value, date=created),
+                    TaskStatusTransition(task=task, status=Task.Status.RUNNING.value,
+                                         date=created + timedelta(seconds=10 * (i + 1))),
+                    TaskStatusTransition(task=task, status=Task.Status.DONE.value,
+                                         date=created + timedelta(seconds=10 * (i + 1) + 60)),
+            ])
+
+    # Test the percentiles of each metric
+    def test_report(self):
+        since = timezone.now() - timedelta(days=1)
+        # The aggregates, then the percentiles of each metric
+        with self.assertNumQueries(4):
+            report = TaskTimings.report(get_timed_tasks(since, timezone.now()), 'task_name__name', [0, 50, 100])
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['queue_wait'], {'count': 4, 'avg': 25.0, 'p0': 10.0, 'p50': 20.0, 'p100': 40.0})
+        self.assertEqual(report[0]['run_time']['p50'], 60.0)
+        self.assertEqual(report[0]['end_to_end']['p100'], 103.0)
+
+        # The times of each group are ranked separately, the groups without times have no percentiles
+        other = Script.objects.create(name='hmmer', job=Script.objects.get().job, command='hmmer.sh')
+        Task.objects.create(task_name=other)
+        report = TaskTimings.report(get_timed_tasks(since, timezone.now()), 'task_name__name', [50])
+        self.assertEqual([row['name'] for row in report], ['blast', 'hmmer'])
+        self.assertEqual(report[0]['queue_wait']['p50'], 20.0)
+        self.assertEqual(report[1]['queue_wait'], {'count': 0, 'avg': None, 'p50': None})
+
+    # Test the transitions are recorded when the status changes
+    def test_record(self):
+        task = Task.objects.first()
+        task.status = Task.Status.FAILED.value
+        self.assertEqual(task.transitions.latest('id').status, Task.Status.FAILED.value)
+
+
+# Test the resource usage of the finished tasks
+class TaskResourceUsageTest(TestCase):
+
+    # Set up tests, a job template asking for 4 cpus and 4000 MB of memory
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='4_cores_local', queue='local', cpus_per_task=4, mem_per_cpu='1000')
+        self.script = Script.objects.create(name='blast', job=job, command='blast.sh', _max_clock_time='1 hour')
+
+    # Test the usage of the finished tasks is read once from the accounting, the jobs not found are tried again later
+    def test_collect(self):
+        done = Task.objects.create(task_name=self.script, _drm_job_id=42)
+        done.status = Task.Status.DONE.value
+        running = Task.objects.create(task_name=self.script, _drm_job_id=43)
+        running.status = Task.Status.RUNNING.value
+        missing = Task.objects.create(task_name=self.script, _drm_job_id=44)
+        missing.status = Task.Status.FAILED.value
+        self.assertEqual(ResourceUsageCollection.objects.count(), 2)
+
+        usage = {'cpu_time': 120.5, 'wall_time': 60.0, 'max_rss': 2.0, 'exit_status': 0, 'signal': ''}
+        with mock.patch('submission.task.models.get_jobs_accounting', return_value={42: usage}) as accounting:
+            self.assertEqual(CollectResourceUsage.collect(500), 1)
+            # The missing job is not due yet
+            self.assertEqual(CollectResourceUsage.collect(500), 0)
+        accounting.assert_called_once_with([42, 44])
+        stored = TaskResourceUsage.objects.get(task=done)
+        self.assertEqual((stored.cpu_time, stored.wall_time, stored.max_rss, stored.exit_status), (120.5, 60, 2, 0))
+        self.assertFalse(TaskResourceUsage.objects.filter(task=missing).exists())
+
+        # No empty usage is stored, the job is dropped after the last attempt
+        with mock.patch('submission.task.models.RESOURCE_USAGE_MAX_ATTEMPTS', 2), \
+                mock.patch('submission.task.models.get_jobs_accounting', side_effect=OSError):
+            ResourceUsageCollection.objects.update(not_before=None)
+            self.assertEqual(CollectResourceUsage.collect(500), 0)
+        self.assertFalse(ResourceUsageCollection.objects.exists())
+        self.assertFalse(TaskResourceUsage.objects.filter(task=missing).exists())
+
+    # Test the usage of the ended jobs is parsed from sacct, with the memory of the steps in MB
+    @mock.patch('submission.drm.subprocess.run')
+    def test_accounting(self, run):
+        run.return_value.stdout = "\n".join([
+                "42|COMPLETED|60|02:00.500||0:0",
+                "42.batch|COMPLETED|60|02:00.500|2048K|0:0",
+                "42.extern|COMPLETED|60|00:00:00|1024K|0:0",
+                "43|CANCELLED by 1000|3600|1-00:00:00||0:9",
+                "44|RUNNING|10|00:05.000||0:0",
+        ])
+        accounting = get_jobs_accounting([42, 43, 44])
+        self.assertEqual(accounting[42], {'cpu_time': 120.5, 'wall_time': 60.0, 'max_rss': 2.0, 'exit_status': 0,
+                                          'signal': ''})
+        self.assertEqual(accounting[43], {'cpu_time': 86400.0, 'wall_time': 3600.0, 'max_rss': None,
+                                          'exit_status': None, 'signal': 'SIGKILL'})
+        self.assertNotIn(44, accounting)
+        self.assertIn('--jobs=42,43,44', run.call_args.args[0])
+
+    # Test the job template and the script are flagged when their tasks use a small part of what they ask for
+    def test_report(self):
+        for i in range(3):
+            task = Task.objects.create(task_name=self.script, _status=Task.Status.DONE.value)
+            TaskResourceUsage.objects.create(task=task, cpu_time=60, wall_time=60, max_rss=3500)
+
+        report = ResourceReport.report_jobs(TaskResourceUsage.objects.all(), 0.5, 3)
+        self.assertEqual(report[0]['peak_cpus'], 1)
+        self.assertEqual(report[0]['flags'], ['cpus'])
+        report = ResourceReport.report_scripts(TaskResourceUsage.objects.all(), 0.5, 3)
+        self.assertEqual(report[0]['flags'], ['max_clock_time'])
+
+
+# Test the job template sent to the DRM
+class StartJobTest(SimpleTestCase):
+
+    # Test the resources are passed to DRMAA, with the clock time limit in seconds
+    @mock.patch('submission.drm.drmaa.Session')
+    def test_start_job(self, session):
+        session.runJob.return_value = '42'
+        job_id, name = start_job(task_name='blast', script_dir='/scripts', out_dir='/out', command='blast.sh',
+                                 script_args=['--db', 1], working_dir='a1b2', queue='local', clock_time_limit=b'02:30',
+                                 dependencies=[1, 2], dependency_type='afterok', stdout_file='out.txt')
+        self.assertEqual((job_id, name), (42, 'blast'))
+
+        jt = session.createJobTemplate.return_value
+        self.assertEqual(jt.remoteCommand, '/scripts/blast.sh')
+        self.assertEqual(jt.args, ['--db', '1'])
+        self.assertEqual(jt.outputPath, ':/out/a1b2/out.txt')
+        self.assertEqual(jt.hardWallclockTimeLimit, 9000)
+        self.assertIn('--partition=local', jt.nativeSpecification)
+        self.assertIn('--dependency=afterok:1:2', jt.nativeSpecification)
+        session.deleteJobTemplate.assert_called_once_with(jt)
+
+
+# Test many tasks are created with a single request
+class TaskBatchTest(TestCase):
+
+    # Set up tests
+    def setUp(self):
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    # Reset the throttles
+    def tearDown(self):
+        cache.clear()
+
+    def post(self, data):
+        with mock.patch('submission.task.serializers.create_task_folder'):
+            return self.client.post('/task/batch/', data, format='json')
+
+    # Test the batch fails if none of its valid tasks has been sent to the DRM
+    def test_rejected(self):
+        with mock.patch('submission.task.submit.start_job', side_effect=Exception('DRM error')):
+            response = self.post([{'task_name': 'blast'}, {'task_name': 'blast'}])
+            self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+            response = self.post([{'task_name': 'blast'}, {'task_name': 'missing'}])
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertNotIn('uuid', response.data[1])
+        self.assertEqual(set(Task.objects.values_list('_status', flat=True)), {Task.Status.REJECTED.value})
+
+    # Test the tasks are rejected if the DRM session cannot be opened
+    def test_session_error(self):
+        with mock.patch('submission.task.serializers.session', side_effect=Exception('DRM error')):
+            response = self.post({'tasks': [{'task_name': 'blast'}]})
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(Task.objects.get().status, Task.Status.REJECTED.value)
+
+    # Test a body that is neither a list nor an object is refused
+    def test_invalid(self):
+        self.assertEqual(self.post(5).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post({'tasks': 5}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+# Test the task changes are dispatched to the event streams
+class TaskEventHubTest(TestCase):
+
+    # Set up tests, tasks of a user
+    def setUp(self):
+        self.user = User.objects.create(username='This-username-is-fake', source=User.ORCID, active=True)
+        job = DRMJobTemplate.objects.create(name='1_core_local', queue='local', cpus_per_task=1)
+        self.script = Script.objects.create(name='blast', job=job, command='blast.sh')
+        self.tasks = [Task.objects.create(task_name=self.script, user=self.user, _drm_job_id=i + 1)
+                      for i in range(3)]
+        self.hub = TaskEventHub(0.01)
+        self.hub._since = timezone.now()
+
+    # Test each change is returned once, starting from the last change seen
+    def test_poll(self):
+        self.tasks[0].status = Task.Status.RUNNING.value
+        changes = self.hub.poll({self.tasks[0].id}, set())
+        self.assertEqual([change['id'] for change in changes], [self.tasks[0].id])
+        self.assertEqual(self.hub.poll({self.tasks[0].id}, set()), [])
+
+        self.tasks[1].status = Task.Status.RUNNING.value
+        changes = self.hub.poll(set(), {self.user.id})
+        self.assertEqual([change['id'] for change in changes], [self.tasks[1].id])
+
+    # Test the changes committed late with an update date before the last change seen are not missed
+    def test_overlap(self):
+        Task.objects.update(update_date=timezone.now() - timedelta(hours=1))
+        self.hub._since = timezone.now() - timedelta(minutes=1)
+        self.tasks[0].status = Task.Status.RUNNING.value
+        self.assertEqual(len(self.hub.poll(set(), {self.user.id})), 1)
+        late = self.tasks[0].update_date - timedelta(seconds=1)
+        Task.objects.filter(id=self.tasks[1].id).update(_status=Task.Status.RUNNING.value, update_date=late)
+        changes = self.hub.poll(set(), {self.user.id})
+        self.assertEqual([change['id'] for change in changes], [self.tasks[1].id])
+        self.assertEqual(self.hub.poll(set(), {self.user.id}), [])
+
+    # Test only the tasks watched one by one are refreshed from the DRM
+    def test_refresh(self):
+        with mock.patch.object(Task, 'refresh_drm_statuses') as refresh:
+            self.hub.poll({self.tasks[0].id}, {self.user.id})
+        self.assertEqual(refresh.call_args.args[0], [self.tasks[0]])
+
+    # Test the stream of a finished task sends its status and is closed
+    async def test_task_events(self):
+        task = await Task.objects.acreate(task_name=self.script, _status=Task.Status.DONE.value)
+        with mock.patch('submission.task.events.hub', self.hub):
+            response = await AsyncClient().get('/task/{}/events/'.format(task.uuid))
+            content = b''.join([chunk async for chunk in response.streaming_content]).decode()
+            await self.hub._loop_task
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn('event: status', content)
+        self.assertIn(Task.Status.DONE.value, content)
+
+        response = await AsyncClient().get('/task/{}/events/'.format(uuid.uuid4()))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    # Test a task finishing between the read of its initial state and the subscription closes its stream
+    async def test_task_events_gap(self):
+        task = await Task.objects.acreate(task_name=self.script, _status=Task.Status.RUNNING.value)
+        read_task = events.get_task
+
+        def get_task(request, uuid):
+            initial = read_task(request, uuid)
+            Task.objects.filter(id=task.id).update(_status=Task.Status.DONE.value, update_date=timezone.now())
+            return initial
+
+        with mock.patch('submission.task.events.hub', self.hub), \
+                mock.patch('submission.task.events.get_task', get_task):
+            response = await AsyncClient().get('/task/{}/events/'.format(task.uuid))
+            content = await asyncio.wait_for(self.read(response), 5)
+        self.assertIn(Task.Status.RUNNING.value, content)
+        self.assertIn(Task.Status.DONE.value, content)
+
+    @staticmethod
+    async def read(response):
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    # Test the stream of the tasks of a user requires the authentication token
+    async def test_user_events(self):
+        response = await AsyncClient().get('/task/events/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
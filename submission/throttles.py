@@ -7,6 +7,34 @@ from submission.models import Group, get_anon_user_throttle
 
 logger = logging.getLogger(__name__)
 
+
+class ThrottleCostMixin:
+    """
+    Counts a request as many requests as the cost given by the get_throttle_cost method of the view, e.g. the number
+    of tasks created by a batch request
+    """
+
+    def allow_request(self, request, view):
+        cost = view.get_throttle_cost(request) if hasattr(view, 'get_throttle_cost') else 1
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.history = self.cache.get(self.key, [])
+        self.now = self.timer()
+
+        # Drop any requests from the history which have now passed the throttle duration
+        while self.history and self.history[-1] <= self.now - self.duration:
+            self.history.pop()
+        if len(self.history) + cost > self.num_requests:
+            return self.throttle_failure()
+
+        self.history[:0] = [self.now] * cost
+        self.cache.set(self.key, self.history, self.duration)
+        return True
+
+
 class IPRateThrottleBurst(AnonRateThrottle):
     scope = 'ipBurst'
     THROTTLE_RATES = {'ipBurst': '10/s'}
@@ -32,7 +60,7 @@ class IPRateThrottleBurst(AnonRateThrottle):
         logger.warning('Request was throttled', extra={'ip': self.ident})
 
 
-class IPRateThrottleSustained(AnonRateThrottle):
+class IPRateThrottleSustained(ThrottleCostMixin, AnonRateThrottle):
     scope = 'ipSustained'
     THROTTLE_RATES = {'ipSustained': '100/d'}
 
@@ -80,7 +108,7 @@ class UserBasedThrottleBurst(SimpleRateThrottle):
         logger.warning('Request was throttled', extra={'ip': self.ident})
 
 
-class UserBasedThrottleSustained(SimpleRateThrottle):
+class UserBasedThrottleSustained(ThrottleCostMixin, SimpleRateThrottle):
     scope = 'userSustained'
     THROTTLE_RATES = {'userSustained': '1000/d'}
 
@@ -1,6 +1,7 @@
 from django.urls import include, path, re_path
 from rest_framework.routers import DefaultRouter
 
+import submission.task.events
 import submission.task.views
 import submission.script.views
 from submission import views
@@ -20,6 +21,9 @@ TaskDownloadView = submission.task.views.TaskViewSet.as_view({'get': 'download'}
 urlpatterns = [
         # Register custom view for download
         re_path(r'^task/(?P<uuid>[^/.]+)/download/$', TaskDownloadView),
+        # Register the streams of the task changes, served asynchronously
+        re_path(r'^task/events/$', submission.task.events.user_events),
+        path('task/<uuid:uuid>/events/', submission.task.events.task_events),
         # Register custom route for files
         re_path(r'^task/(?P<uuid>[^/.]+)/file/(?P<path>.*)$', TaskFileView),
         # Register default router
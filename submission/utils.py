@@ -3,10 +3,9 @@ import logging
 import os
 import zipfile
 from pathlib import Path
-from typing import List, Union
+from typing import Union
 
 from rest_framework import exceptions
-from rest_framework.exceptions import ValidationError
 from rest_framework.settings import api_settings
 
 from server.settings import SUBMISSION_OUTPUT_DIR
@@ -23,31 +22,6 @@ def format_value(value, param_type):
     return value
 
 
-def format_task_params(passed_params: List[TaskParameter]):
-    formatted_params = []
-    # Filter the parameters that are not supposed to go to the script, flag to_script = False
-    passed_params = list(
-            sorted(passed_params, key=lambda param: param.param.flag if param.param.flag else 0, reverse=False))
-    for passed_param in passed_params:
-        if passed_param.param.flag:
-            # If the param is of type Bool and is positive, no value has to be passed, only the flag
-            if passed_param.param.type == Parameter.Type.BOOL.value:
-                formatted_params.append(passed_param.param.flag)
-                continue
-
-            value = format_value(passed_param.value, passed_param.param.type)
-            if passed_param.param.flag[-1] == '=':
-                formatted_params.append("{}{}".format(passed_param.param.flag, value))
-            else:
-                formatted_params.append(passed_param.param.flag)
-                formatted_params.append(value)
-
-        else:
-            formatted_params.append(passed_param.value)
-
-    return formatted_params
-
-
 def get_extension(param_name, file_name):
     if '.' not in file_name:
         raise exceptions.NotAcceptable("The file parameter {} must have a file extension".format(param_name))
@@ -61,67 +35,32 @@ def get_extension(param_name, file_name):
         return extension[-1]
 
 
-def get_params(user_param, task: Task, parameters_of_task):
-    created_params = set()
-    renamed_files = dict()
+def get_params(user_param, task: Task, plan):
+    """
+    Validate the values passed for the parameters of a script against its submission plan and store them with a single
+    insert, saving the uploaded files in the working directory of the task
 
+    The values are validated by the plan, only the uploaded files are handled here. Nothing is stored if a value is not
+    valid, the task is deleted instead.
+    """
     p_task = task.get_first_ancestor()
-    for param in parameters_of_task:
-        param = Parameter.objects.get(script=task.task_name, name=param.name)
-        # Param not private and user has set it
-        if not param.private and param.name in user_param.keys():
-            # If the validation on the creation fails then the task (and all related param) will be deleted
-            try:
-                if param.type == Parameter.Type.FILE.value:
-                    files = []
-                    num_files = len(list(filter(None, user_param.getlist(param.name))))
-
-                    if num_files == 0:
-                        raise exceptions.NotAcceptable(
-                                "The file for the parameter {} was not uploaded".format(param.name))
-
-                    for file_idx, file in enumerate(user_param.getlist(param.name)):
-                        ext = get_extension(param.name, file.name)
-                        # If multiple files are passed on the same input name, then save them with different names
-                        if num_files > 1:
-                            file_name = "{}_{}.{}".format(param.name, file_idx, ext)
-                        else:
-                            file_name = "{}.{}".format(param.name, ext)
-
-                        # Save original file name and new file name to a dict
-                        renamed_files.setdefault(file_name, file.name)
-                        # Manage multiple files for a single parameter
-                        files.append(file_name)
-                        file_pth = os.path.join(SUBMISSION_OUTPUT_DIR, str(p_task.uuid), file_name)
-                        # Save the file to the output directory
-                        with open(file_pth, "wb+") as f:
-                            for chunk in file.chunks():
-                                f.write(chunk)
-
-                    files = ','.join(files)
-                    new_param = TaskParameter.objects.create(task=task, param=param, value=files)
-                else:
-                    # Check that the length of the value is not greater than the max length of the field (5000)
-                    if len(user_param[param.name]) > 5000:
-                        raise exceptions.NotAcceptable(
-                                "The value for the parameter {} is too long, the maximum permitted length is 5000"
-                                .format(param.name)
-                        )
-                    new_param = TaskParameter.objects.create(task=task, param=param,
-                                                             value=user_param[param.name])
-                created_params.add(new_param)
-            except ValidationError as e:
-                task.delete()
-                raise e
-        # Param is required and user did not set it
-        elif param.required and param.name not in user_param.keys():
-            task.delete()  # The submitted task was not created with proper params, destroy it
-            raise exceptions.NotAcceptable("The parameter {} must be specified for the {} task"
-                                           .format(param.name, task.task_name))
-        # Param is private and has to be set
-        elif param.private:
-            new_param = TaskParameter.objects.create(task=task, param=param, value=param.default)
-            created_params.add(new_param)
+    uploaded = [spec for spec in plan.parameters.values()
+                if spec.type == Parameter.Type.FILE.value and not spec.private and spec.name in user_param.keys()]
+    renamed_files = dict()
+
+    try:
+        task_params = plan.build_params(user_param, skip={spec.id for spec in uploaded})
+        for spec in uploaded:
+            files = save_files(user_param, spec, p_task, renamed_files)
+            task_params.append(TaskParameter(param_id=spec.id, value=files))
+    except exceptions.APIException as e:
+        # The submitted task was not created with proper params, destroy it
+        task.delete()
+        raise e
+
+    for task_param in task_params:
+        task_param.task = task
+    TaskParameter.objects.bulk_create(task_params)
 
     task.files_name = renamed_files
 
@@ -129,7 +68,38 @@ def get_params(user_param, task: Task, parameters_of_task):
     with open(os.path.join(SUBMISSION_OUTPUT_DIR, str(p_task.uuid), "files.json"), 'a') as f:
         json.dump(renamed_files, f)
 
-    return created_params, renamed_files
+    return task_params, renamed_files
+
+
+def save_files(user_param, param, p_task: Task, renamed_files):
+    """
+    Save the files uploaded for a file parameter in the working directory, returns the value of the parameter
+    """
+    files = []
+    num_files = len(list(filter(None, user_param.getlist(param.name))))
+
+    if num_files == 0:
+        raise exceptions.NotAcceptable("The file for the parameter {} was not uploaded".format(param.name))
+
+    for file_idx, file in enumerate(user_param.getlist(param.name)):
+        ext = get_extension(param.name, file.name)
+        # If multiple files are passed on the same input name, then save them with different names
+        if num_files > 1:
+            file_name = "{}_{}.{}".format(param.name, file_idx, ext)
+        else:
+            file_name = "{}.{}".format(param.name, ext)
+
+        # Save original file name and new file name to a dict
+        renamed_files.setdefault(file_name, file.name)
+        # Manage multiple files for a single parameter
+        files.append(file_name)
+        file_pth = os.path.join(SUBMISSION_OUTPUT_DIR, str(p_task.uuid), file_name)
+        # Save the file to the output directory
+        with open(file_pth, "wb+") as f:
+            for chunk in file.chunks():
+                f.write(chunk)
+
+    return ','.join(files)
 
 
 def create_task_folder(wd):